@@ -1,15 +1,315 @@
+import threading
 import time
-from dotenv import load_dotenv
-from database import db
+from collections import deque, OrderedDict
+from database import db, VERSIONS_NATURAL_KEY
+from migrations import ensure_history_partitions
+import configurations
 import os
 
-load_dotenv('.env')
-WEBSITE1 = os.getenv('WEBSITE1')
+class IdAllocator:
+    """
+    Hands out primary keys for new rows. Keys are reserved from the database in
+    blocks (see Database.reserve_ids), so allocating an id usually costs no query,
+    and ids are never shared between concurrent scrapers or pending batches. A
+    block reserved inside a transaction which is rolled back is dropped, since
+    its reservation was undone and other processes can reserve it again.
+    """
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next_id(self, table, column, block_size=None):
+        """
+        Return an unused id for the primary key `column` of `table`.
+
+        :param block_size: number of ids to reserve when the current block is exhausted.
+        """
+        with self._lock:
+            block = self._blocks.setdefault((table, column), deque())
+            if not block:
+                ids = db.reserve_ids(table, column, block_size or self.block_size)
+                block.extend(ids)
+                db.on_rollback(lambda: self._discard((table, column), ids))
+            return block.popleft()
+
+    def _discard(self, key, ids):
+        ids = set(ids)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block:
+                self._blocks[key] = deque(id for id in block if id not in ids)
+
+
+id_allocator = IdAllocator()
+
+
+class LRUCache:
+    """
+    Thread-safe mapping bounded to `capacity` entries, evicting the least recently
+    used one when full.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.evicted = False
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evicted = True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.evicted = False
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IdentityMap:
+    """
+    In-process map of the rows already in the database, so known entities are
+    resolved without queries:
+        - versions: natural key (see Version.natural_key) -> version_id
+        - cars: (identifier, website) -> cars row (dict)
+
+    Both maps are bulk-loaded at the start of every scrape (`load`), kept in sync
+    as rows are written, and bounded by an LRU policy. While no row has been left
+    out or evicted, and no other process writes (configurations.SINGLE_WRITER), a
+    key missing from a map is known not to be in the database.
+    """
+    version_columns = [
+        'version_id', 'brand', 'model', 'version_name', 'year_prod', 'body_style',
+        'engine_displacement', 'transmission_type'
+    ]
+    car_columns = ['car_id', 'identifier', 'website', 'url', 'image_url', 'version_id']
+
+    def __init__(self, capacity=None):
+        capacity = capacity or configurations.IDENTITY_MAP_CAPACITY
+        self.versions = LRUCache(capacity)
+        self.version_keys = LRUCache(capacity)
+        self.cars = LRUCache(capacity)
+        self._versions_complete = False
+        self._cars_complete = False
+
+    def load(self):
+        """
+        Load the most recent versions and cars (up to the capacity of the maps).
+        """
+        self.versions.clear()
+        self.version_keys.clear()
+        self.cars.clear()
+        Version._allocated_ids.clear()
+        rows = db.select(
+            'versions', self.version_columns, order_by='version_id DESC', limit=self.versions.capacity
+        )
+        for row in reversed(rows):
+            row = dict(zip(self.version_columns, row))
+            self._put_version(Version.natural_key_of(row), row['version_id'])
+        self._versions_complete = len(rows) < self.versions.capacity
+
+        rows = db.select('cars', self.car_columns, order_by='car_id DESC', limit=self.cars.capacity)
+        for row in reversed(rows):
+            row = dict(zip(self.car_columns, row))
+            self.cars.put((str(row['identifier']), row['website']), row)
+        self._cars_complete = len(rows) < self.cars.capacity
+
+    @property
+    def versions_complete(self):
+        return configurations.SINGLE_WRITER and self._versions_complete and not self.versions.evicted
+
+    @property
+    def cars_complete(self):
+        return configurations.SINGLE_WRITER and self._cars_complete and not self.cars.evicted
+
+    def _put_version(self, natural_key, version_id):
+        self.versions.put(natural_key, version_id)
+        self.version_keys.put(version_id, natural_key)
+
+    def version_id(self, natural_key):
+        return self.versions.get(natural_key)
+
+    def version(self, version_id):
+        """
+        Return the versions row of a version, or None if it isn't in the map.
+        """
+        natural_key = self.version_keys.get(version_id)
+        if natural_key is None:
+            return None
+        return {'version_id': version_id, **dict(zip(self.version_columns[1:], natural_key))}
+
+    def car(self, identifier, website):
+        """
+        Return the cars row of the car, or None if it isn't in the map.
+        """
+        return self.cars.get((str(identifier), website))
+
+    def register(self, obj):
+        """
+        Add a written Version or Car to the map.
+        """
+        if isinstance(obj, Version):
+            self._put_version(obj.natural_key(), obj.version_id)
+        elif isinstance(obj, Car):
+            row = obj.row()
+            self.cars.put((str(row['identifier']), row['website']), {column: row.get(column) for column in self.car_columns})
+
+
+class Dimension:
+    """
+    Interned names of a dimension table (e.g. cities): every distinct name is
+    stored once with an integer key, which the rows reference instead. Names are
+    resolved from an in-memory cache, loaded on first use, so only new names cost
+    a write.
+    """
+
+    def __init__(self, table_name, id_column, name_column='name'):
+        self.table_name = table_name
+        self.id_column = id_column
+        self.name_column = name_column
+        self._ids = {}
+        self._names = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        for id, name in db.select(self.table_name, [self.id_column, self.name_column]):
+            self._ids[name] = id
+            self._names[id] = name
+        self._loaded = True
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._names.clear()
+            self._loaded = False
+
+    def id_for(self, name):
+        """
+        Return the key of `name`, inserting it if new (None for a None name).
+        """
+        if name is None:
+            return None
+        with self._lock:
+            if not self._loaded:
+                self.load()
+            if name not in self._ids:
+                id = self._insert(name)
+                self._ids[name] = id
+                self._names[id] = name
+            return self._ids[name]
+
+    def name_of(self, id):
+        if id is None:
+            return None
+        with self._lock:
+            if id not in self._names:
+                self.load()
+            return self._names[id]
+
+    def _insert(self, name):
+        values = {
+            self.id_column: id_allocator.next_id(self.table_name, self.id_column, block_size=10),
+            self.name_column: name,
+        }
+        if upsert_writes():
+            return db.upsert(self.table_name, values, [self.name_column], returning=self.id_column)
+        db.insert(self.table_name, values)
+        return values[self.id_column]
+
+
+class LabelSets(Dimension):
+    """
+    Dimension of the label sets of the cars: a set of labels is stored once, keyed
+    by the sorted ids of its labels, with one `label_set_labels` row per label (so
+    rows with a label are found by comparing integers).
+    """
+
+    def __init__(self, labels):
+        super().__init__('label_sets', 'label_set_id', 'label_key')
+        self.labels = labels
+
+    @staticmethod
+    def normalize(names):
+        """
+        Return the set of label `names`, stripped of whitespace and empty names.
+        """
+        if isinstance(names, str):
+            names = (names,)
+        return frozenset(name.strip() for name in names or () if name and name.strip())
+
+    def id_for(self, names):
+        """
+        Return the key of the set of label `names` (None if there are no labels).
+        """
+        names = self.normalize(names)
+        if not names:
+            return None
+        label_ids = sorted(self.labels.id_for(name) for name in names)
+        return super().id_for(','.join(str(label_id) for label_id in label_ids))
+
+    def clear(self):
+        super().clear()
+        self.labels.clear()
+
+    def names_of(self, label_set_id):
+        """
+        Return the label names of a label set, sorted.
+        """
+        if label_set_id is None:
+            return ()
+        label_key = self.name_of(label_set_id)
+        return tuple(sorted(self.labels.name_of(int(label_id)) for label_id in label_key.split(',')))
+
+    def _insert(self, label_key):
+        label_set_id = super()._insert(label_key)
+        db.insert_many(
+            'label_set_labels',
+            [{'label_set_id': label_set_id, 'label_id': int(label_id)} for label_id in label_key.split(',')],
+            conflict_columns=['label_set_id', 'label_id'] if upsert_writes() else None,
+        )
+        return label_set_id
+
+
+def delta_history():
+    """
+    Whether history rows are only written when the price or labels of a car change.
+    """
+    return configurations.HISTORY_MODE == 'delta'
+
+
+def upsert_writes():
+    """
+    Whether objects are written with upserts (see ObjectModel.upsert) instead of
+    checking first whether their rows exist.
+    """
+    return configurations.UPSERT_WRITES and db.supports_upsert
+
 
 class ObjectModel:
     table_name = ''
     table_id = []
     table_columns = []
+    # Unique constraint used by upserts, and column of the key they return
+    conflict_columns = []
+    returning_id = None
+    # Columns copied from linked objects when the row is written: {column: attribute}
+    foreign_keys = {}
 
     """
     A base  class for Object-Relational Mapping (ORM) models.
@@ -40,10 +340,80 @@ class ObjectModel:
            This method uses the `table_name` attribute to determine the target table
            and inserts the object's attributes (`__dict__`) as column values.
         """
+        if not self.needs_dump():
+            return
+        self.resolve_dimensions()
+        if upsert_writes() and self.conflict_columns:
+            self.upsert()
+            return
         db.insert(
             table=self.table_name,
-            values=self.__dict__
+            values=self.row()
         )
+        self._already_exists = True
+        identity_map.register(self)
+
+    def upsert(self):
+        """
+        Write the object with a single INSERT ... ON CONFLICT statement on its
+        `conflict_columns`. If the class has a `returning_id`, the key of the row
+        (inserted or already existing) is stored in the object.
+        """
+        resolved_id = db.upsert(
+            table=self.table_name,
+            values=self.row(),
+            conflict_columns=self.conflict_columns,
+            returning=self.returning_id
+        )
+        if self.returning_id:
+            setattr(self, self.returning_id, resolved_id)
+            self.id_resolved()
+        self._already_exists = True
+        identity_map.register(self)
+
+    def id_resolved(self):
+        """
+        Hook called once an upsert has resolved the key of the object.
+        """
+        pass
+
+    def committed(self):
+        """
+        Hook called once the transaction writing the object is committed.
+        """
+        pass
+
+    def resolve_dimensions(self):
+        """
+        Hook setting the keys of the dimension rows (see Dimension) referenced by
+        the object, right before it is written: new dimension rows are then
+        inserted in the same transaction as the object.
+        """
+        pass
+
+    def needs_dump(self):
+        """
+        Whether the object still has to be inserted in the database.
+        """
+        return not getattr(self, '_already_exists', False)
+
+    def row(self):
+        """
+        Return the column values of the object (its public attributes), after
+        refreshing its `foreign_keys` from the linked objects.
+        """
+        for column, attribute in self.foreign_keys.items():
+            linked_object = self.__dict__.get(attribute)
+            if linked_object is not None:
+                self.__dict__[column] = getattr(linked_object, column)
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    @classmethod
+    def filter_new(cls, objects):
+        """
+        Return the objects of the list which still have to be inserted.
+        """
+        return [obj for obj in objects if obj.needs_dump()]
 
     @classmethod
     def from_parser(cls, parser_obj, **kwargs):
@@ -57,8 +427,16 @@ class ObjectModel:
             An instance of the ORM class with fields populated from the parser.
         """
 
-        for field in cls.table_columns:
-            kwargs[field] = getattr(parser_obj, field)
+        return cls.from_record(parser_obj.extract_record(cls.table_columns), **kwargs)
+
+    @classmethod
+    def from_record(cls, record, **kwargs):
+        """
+        Create an instance of the ORM class from a dictionary of extracted fields
+        (e.g. returned by a parser_pool.ParserPool), ignoring the fields that are
+        not in `table_columns`.
+        """
+        kwargs.update({column: record.get(column) for column in cls.table_columns})
 
         return cls(**kwargs)
 
@@ -71,8 +449,24 @@ class ObjectModel:
             table_name=cls.table_name,
             item_values=dict(zip(cls.table_id, column_id)))
 
-        return cls(**item_values, **kwargs)
+        return cls.from_row(item_values, **kwargs)
 
+    @classmethod
+    def from_row(cls, row, **kwargs):
+        """
+        Create an instance of the ORM class from a row already in the database,
+        without running the constructor (so no query is made).
+
+        Args:
+            row (dict): Column values of the row.
+            kwargs: linked objects (e.g. `version_object`), stored as protected attributes.
+        """
+        obj = cls.__new__(cls)
+        obj.__dict__.update(row)
+        for key, value in kwargs.items():
+            setattr(obj, f'_{key}', value)
+        obj._already_exists = True
+        return obj
 
 
 class Scrape(ObjectModel):
@@ -86,21 +480,21 @@ class Scrape(ObjectModel):
         self.datetime_end = None
         self.finish_ok = False
         self.error_type = ''
+        # Delta history mode: last (price, labels) of every car, and cars seen
+        self._last_history = {}
+        self._present_cars = []
+        self._present_ids = set()
 
     def _get_id(self):
-        scrape_ids = db.select(
-            table='scrapes',
-            columns=['scrape_id'],
-        )
-        if scrape_ids:
-            scrape_id = max(scrape_ids, key=lambda x: x[0])[0] + 1
-        else:
-            scrape_id = 0
-        return scrape_id
+        return id_allocator.next_id(self.table_name, 'scrape_id', block_size=1)
 
 
     def __enter__(self):
         self.dump()
+        ensure_history_partitions(db, self.datetime_start)
+        identity_map.load()
+        if delta_history():
+            self._last_history = ScrapeHistory.latest_states()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -112,9 +506,48 @@ class Scrape(ObjectModel):
             self.error_type = exc_type.__name__
             self.error_msg = str(exc_val)
             db.connection.rollback()
+        self.dump_presence()
         self.dump_update()
         return True
 
+    def mark_present(self, car_object):
+        """
+        Record that a car was seen in this scrape (delta history mode).
+        """
+        self._present_cars.append(car_object)
+
+    def dump_presence(self):
+        """
+        Write the cars marked as present since the last call, as ranges of
+        consecutive car ids in `scrape_presence`. The cars must already be written.
+        """
+        car_ids = {car.car_id for car in self._present_cars} - self._present_ids
+        self._present_cars = []
+        if not car_ids:
+            return
+        self._present_ids.update(car_ids)
+        db.insert_many('scrape_presence', [
+            {'scrape_id': self.scrape_id, 'first_car_id': first, 'last_car_id': last}
+            for first, last in id_ranges(car_ids)
+        ], conflict_columns=['scrape_id', 'first_car_id'] if upsert_writes() else None)
+
+    @classmethod
+    def attach(cls, scrape_id):
+        """
+        Return the Scrape object of a scrape started by another process (e.g. the
+        one queueing its detail pages), to write items of the scrape. The scrape
+        row is left to its owner, which closes it.
+        """
+        scrape = cls.from_db(scrape_id)
+        if not isinstance(scrape.datetime_start, str):
+            scrape.datetime_start = scrape.datetime_start.strftime('%Y-%m-%d %H:%M:%S')
+        scrape._last_history = ScrapeHistory.latest_states() if delta_history() else {}
+        scrape._present_cars = []
+        scrape._present_ids = set()
+        ensure_history_partitions(db, scrape.datetime_start)
+        identity_map.load()
+        return scrape
+
     def dump_update(self):
         db.update(
             table=self.table_name,
@@ -131,6 +564,11 @@ class Version(ObjectModel):
         'brand', 'model', 'version_name', 'year_prod', 'body_style', 'engine_displacement',
         'transmission_type'
     ]
+    conflict_columns = VERSIONS_NATURAL_KEY
+    returning_id = 'version_id'
+    # Ids allocated to new versions, by natural key (cleared at every identity map
+    # load, once the versions written are in the map)
+    _allocated_ids = LRUCache(configurations.IDENTITY_MAP_CAPACITY)
 
     def __init__(self, brand, model, version_name, year_prod, body_style, engine_displacement, transmission_type, **kwargs):
         self.brand = brand.capitalize()
@@ -138,11 +576,20 @@ class Version(ObjectModel):
         self.version_name = version_name.capitalize()
         self.year_prod = year_prod
         self.body_style = body_style.upper() if body_style else None
-        self.engine_displacement = engine_displacement if engine_displacement else None
+        self.engine_displacement = round(float(engine_displacement), 1) if engine_displacement else None
         self.transmission_type = transmission_type.capitalize() if transmission_type else None
         self.version_id = self._get_id()
 
     def _get_id(self):
+        id = identity_map.version_id(self.natural_key())
+        if id is not None:
+            self._already_exists = True
+            return id
+        if upsert_writes() or identity_map.versions_complete:
+            # The key of an existing version is resolved by the upsert
+            self._already_exists = False
+            return self._allocate_id()
+
         ids = db.select(
             table='versions',
             columns=['version_id'],
@@ -151,9 +598,9 @@ class Version(ObjectModel):
                 AND model = ? 
                 AND version_name = ?
                 AND year_prod = ? 
-                AND body_style = ?
-                AND engine_displacement = ?
-                AND transmission_type = ?
+                AND COALESCE(body_style, '') = COALESCE(?, '')
+                AND COALESCE(engine_displacement, -1) = COALESCE(?, -1)
+                AND COALESCE(transmission_type, '') = COALESCE(?, '')
             """,
             where_params=(self.brand, self.model, self.version_name, self.year_prod,
              self.body_style, self.engine_displacement, self.transmission_type)
@@ -163,24 +610,46 @@ class Version(ObjectModel):
             self._already_exists = True
         else:
             self._already_exists = False
-            all_ids = db.select(
-                table='versions',
-                columns=['version_id'],
-            )
-            if all_ids:
-                id = max(all_ids, key=lambda x: x[0])[0] + 1
-            else:
-                id = 0
+            id = self._allocate_id()
         return id
 
-    def dump(self):
-        if not self._already_exists:
-            super().dump()
+    def _allocate_id(self):
+        # A new version may already have an id while its row is waiting in a batch
+        key = self.natural_key()
+        id = Version._allocated_ids.get(key)
+        if id is None:
+            id = id_allocator.next_id(self.table_name, 'version_id')
+            Version._allocated_ids.put(key, id)
+        return id
+
+    def id_resolved(self):
+        Version._allocated_ids.put(self.natural_key(), self.version_id)
+
+    def natural_key(self):
+        return self.natural_key_of(self.__dict__)
+
+    @staticmethod
+    def natural_key_of(values):
+        """
+        Return the natural key of a version from its column values, normalized so
+        parsed values and values read from the database give the same key.
+        """
+        year_prod = values['year_prod']
+        engine_displacement = values['engine_displacement']
+        return (
+            values['brand'], values['model'], values['version_name'],
+            int(year_prod) if year_prod is not None else None,
+            values['body_style'],
+            float(engine_displacement) if engine_displacement is not None else None,
+            values['transmission_type'],
+        )
 
 
 class VersionDetails(ObjectModel):
     table_name = 'version_details'
     table_id = ['version_id']
+    conflict_columns = ['version_id']
+    foreign_keys = {'version_id': '_version_object'}
     table_columns = [
         'mileage', 'cylinders', 'num_of_gears', 'fuel_range', 'engine_type',
         'fuel_type', 'horsepower', 'rim_inches', 'rim_material', 'num_of_doors',
@@ -249,6 +718,10 @@ class VersionDetails(ObjectModel):
         self.weight_kg = int(weight_kg) if weight_kg else None
 
     def _get_id(self, version_id):
+        if upsert_writes():
+            self._already_exists = False
+            return version_id
+
         ids = db.select(
             table=self.table_name,
             columns=self.table_id,
@@ -264,16 +737,13 @@ class VersionDetails(ObjectModel):
 
         return version_id
 
-    def dump(self):
-        if self._already_exists:
-            return
-        super().dump()
-
-
 
 class Car(ObjectModel):
     table_name = 'cars'
     table_id = ['car_id']
+    conflict_columns = ['identifier', 'website']
+    returning_id = 'car_id'
+    foreign_keys = {'version_id': '_version_object'}
     table_columns = [
         'url', 'image_url', 'report_url', 'website', 'identifier', 'car_id', 'version_id'
     ]
@@ -284,19 +754,28 @@ class Car(ObjectModel):
             version_object,
             url,
             image_url,
-            website=WEBSITE1,
+            website=None,
             **kwargs,
         ):
 
         self._version_object = version_object
         self.url = url
         self.image_url = image_url
-        self.website = website
+        self.website = website or configurations.env('WEBSITE1')
         self.identifier = identifier
         self.car_id = self._get_id()
         self.version_id = version_object.version_id
 
     def _get_id(self):
+        known_car = identity_map.car(self.identifier, self.website)
+        if known_car:
+            self._already_exists = True
+            return known_car['car_id']
+        if upsert_writes() or identity_map.cars_complete:
+            # The key of an existing car is resolved by the upsert
+            self._already_exists = False
+            return id_allocator.next_id(self.table_name, 'car_id')
+
         car_id = db.select(
             table=self.table_name,
             columns=self.table_id,
@@ -311,25 +790,15 @@ class Car(ObjectModel):
             return car_id[0][0]
         else:
             self._already_exists = False
-            all_ids = db.select(
-                table=self.table_name,
-                columns=self.table_id,
-            )
-
-            if all_ids:
-                return max(all_ids, key=lambda x: x[0])[0] + 1
-            else:
-                return 0
-
-    def dump(self):
-        if not self._already_exists:
-            super().dump()
+            return id_allocator.next_id(self.table_name, 'car_id')
 
 
 class CarInfo(ObjectModel):
     table_name = 'car_info'
     table_id = ['car_id']
-    table_columns = ['city', 'odometer', 'image_path', 'report_path']
+    conflict_columns = ['car_id']
+    foreign_keys = {'car_id': '_car_object'}
+    table_columns = ['city_id', 'odometer', 'image_path', 'report_path']
 
     def __init__(
             self,
@@ -339,7 +808,8 @@ class CarInfo(ObjectModel):
         ):
         self._car_object = car_object
         self.car_id = car_object.car_id
-        self.city = city
+        self._city = city
+        self.city_id = None
         self.odometer = odometer
         image_format = self._car_object.image_url.split('.')[-1]
         if image_format not in ['jpg', 'jpeg', 'png']:
@@ -359,7 +829,15 @@ class CarInfo(ObjectModel):
             f'{self._car_object.identifier}.{report_format}'
         )
 
-    def dump(self):
+    def resolve_dimensions(self):
+        if '_city' in self.__dict__:
+            self.city_id = cities.id_for(self._city)
+
+    def needs_dump(self):
+        if getattr(self, '_already_exists', False):
+            return False
+        if upsert_writes():
+            return True
         id = db.select(
             table=self.table_name,
             columns=self.table_id,
@@ -368,14 +846,34 @@ class CarInfo(ObjectModel):
             """,
             where_params=(self.car_id,)
         )
-        if id:
-            return
-        else:
-            super().dump()
+        self._already_exists = bool(id)
+        return not self._already_exists
+
+    @classmethod
+    def filter_new(cls, objects):
+        """
+        Same as ObjectModel.filter_new, checking every car_id with a single query.
+        """
+        objects = [obj for obj in objects if not getattr(obj, '_already_exists', False)]
+        if not objects or upsert_writes():
+            return objects
+        car_ids = [obj.row()['car_id'] for obj in objects]
+        existing = db.select(
+            table=cls.table_name,
+            columns=cls.table_id,
+            where_clause='car_id IN (' + ', '.join('?' * len(car_ids)) + ')',
+            where_params=car_ids
+        )
+        existing = {row[0] for row in existing}
+        return [obj for obj in objects if obj.car_id not in existing]
 
 
 class ScrapeHistory(ObjectModel):
     table_name = 'scrape_history'
+    table_id = ['scrape_id', 'car_id']
+    # scrape_date is the partition key of the table, so it must be in its unique keys
+    conflict_columns = ['scrape_date', 'scrape_id', 'car_id']
+    foreign_keys = {'car_id': '_car_object', 'scrape_id': '_scrape_object'}
 
     def __init__(
             self,
@@ -388,6 +886,301 @@ class ScrapeHistory(ObjectModel):
         self._scrape_object = scrape_object
         self.car_id = car_object.car_id
         self.scrape_id = scrape_object.scrape_id
-        self.labels = labels
+        self.scrape_date = scrape_object.datetime_start[:10]
+        self._labels = label_sets.normalize(labels)
+        self.label_set_id = None
         self.price = price
 
+    def resolve_dimensions(self):
+        if '_labels' in self.__dict__:
+            self.label_set_id = label_sets.id_for(self._labels)
+
+    def committed(self):
+        # The row is now the last history row of the car (delta history mode)
+        if delta_history():
+            self._scrape_object._last_history[self.car_id] = (self.price, self._labels)
+
+    @classmethod
+    def record(cls, car_object, scrape_object, labels, price):
+        """
+        Create the history row of a car seen in a scrape. In delta history mode the
+        car is marked as present in the scrape instead, and the row is only created
+        (otherwise None is returned) if its price or labels changed since its last
+        row written (the last state of the car is updated once the row is committed).
+        """
+        history = cls(car_object, scrape_object, labels, price)
+        if not delta_history():
+            return history
+
+        scrape_object.mark_present(car_object)
+        if scrape_object._last_history.get(car_object.car_id) == (price, history._labels):
+            return None
+        return history
+
+    @classmethod
+    def latest_states(cls):
+        """
+        Return the (price, label names set) of the last history row of every car, by car_id.
+        """
+        rows = db.select(
+            table=(
+                'scrape_history h JOIN (SELECT car_id, MAX(scrape_id) AS scrape_id '
+                'FROM scrape_history GROUP BY car_id) l '
+                'ON l.car_id = h.car_id AND l.scrape_id = h.scrape_id'
+            ),
+            columns=['h.car_id', 'h.price', 'h.label_set_id'],
+        )
+        return {car_id: (price, frozenset(label_sets.names_of(label_set_id))) for car_id, price, label_set_id in rows}
+
+
+class BatchWriter:
+    """
+    Unit of work collecting ORM objects and writing them in batches: every flush
+    inserts the pending objects of each table with a single bulk statement
+    (`COPY` for the tables in `copy_tables` on PostgreSQL), all in one transaction.
+    With upserts enabled, conflicting rows are skipped (`ON CONFLICT DO NOTHING`,
+    after a COPY into a staging table for the `copy_tables`), and tables with a
+    `returning_id` are written with one upsert per row.
+
+    Objects are written in `write_order`, so rows are inserted after the rows
+    they reference. Objects with the same primary key are written once.
+    """
+    write_order = ['Version', 'VersionDetails', 'Car', 'CarInfo', 'ScrapeHistory']
+    copy_tables = ('scrape_history', 'car_info')
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._pending = {}
+        self._n_pending = 0
+
+    def add(self, *objects):
+        """
+        Queue objects to be written, flushing when the batch is full.
+        """
+        for obj in objects:
+            self._pending.setdefault(type(obj), []).append(obj)
+            self._n_pending += 1
+        if self._n_pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every pending object in a single transaction.
+        """
+        if not self._n_pending:
+            return
+
+        def write_rank(cls):
+            return self.write_order.index(cls.__name__) if cls.__name__ in self.write_order else len(self.write_order)
+
+        upsert = upsert_writes()
+        written = []
+        try:
+            self._write(sorted(self._pending, key=write_rank), upsert, written)
+        except BaseException:
+            # The rows of the batch, and the dimension rows it inserted, were rolled back
+            for obj in written:
+                obj._already_exists = False
+            cities.clear()
+            label_sets.clear()
+            identity_map.load()
+            raise
+
+        self._pending = {}
+        self._n_pending = 0
+
+    def _write(self, classes, upsert, written):
+        with db.transaction():
+            for cls in classes:
+                unique_objects = {}
+                duplicates = []
+                for obj in self._pending[cls]:
+                    obj.resolve_dimensions()
+                    row = obj.row()
+                    key = tuple(row[column] for column in cls.table_id) if cls.table_id else id(obj)
+                    if key in unique_objects:
+                        duplicates.append((obj, unique_objects[key]))
+                    else:
+                        unique_objects[key] = obj
+
+                objects = cls.filter_new(list(unique_objects.values()))
+                if cls.committed is not ObjectModel.committed:
+                    db.on_commit(lambda objects=objects: [obj.committed() for obj in objects])
+                written.extend(objects)
+                written.extend(obj for obj, _ in duplicates if not getattr(obj, '_already_exists', False))
+                if upsert and cls.returning_id:
+                    # Each upsert returns the key of its row
+                    for obj in objects:
+                        obj.upsert()
+                elif cls.table_name in self.copy_tables:
+                    db.copy_rows(cls.table_name, [obj.row() for obj in objects],
+                                 cls.conflict_columns if upsert else None)
+                elif upsert and cls.conflict_columns:
+                    db.insert_many(cls.table_name, [obj.row() for obj in objects], cls.conflict_columns)
+                else:
+                    db.insert_many(cls.table_name, [obj.row() for obj in objects])
+                for obj in objects:
+                    obj._already_exists = True
+                    identity_map.register(obj)
+
+                # Duplicated objects take the key resolved for the object written
+                for obj, written_obj in duplicates:
+                    for column in cls.table_id:
+                        setattr(obj, column, getattr(written_obj, column))
+                    obj._already_exists = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not exc_type:
+            self.flush()
+
+
+def id_ranges(ids):
+    """
+    Compress integer ids into sorted (first, last) ranges of consecutive ids.
+    """
+    ranges = []
+    for id in sorted(ids):
+        if ranges and ranges[-1][1] == id - 1:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return [tuple(id_range) for id_range in ranges]
+
+
+# Scrapes in which a car was seen: the scrapes of its history rows (every scrape in
+# full history mode) and the ones whose presence ranges include it (delta mode).
+_PRESENT_SCRAPES = (
+    '(SELECT scrape_id FROM scrape_history WHERE car_id = ? '
+    'UNION SELECT scrape_id FROM scrape_presence WHERE first_car_id <= ? AND last_car_id >= ?)'
+)
+
+
+def price_series(car_id):
+    """
+    Reconstruct the full price series of a car, from history rows written in
+    either history mode: its price and labels in every scrape in which it was
+    seen are those of its last history row up to that scrape.
+
+    Returns:
+        list: (scrape_id, datetime_start, price, label names) tuples, by scrape.
+    """
+    scrapes = db.select(
+        table=f'{_PRESENT_SCRAPES} p JOIN scrapes s ON s.scrape_id = p.scrape_id',
+        columns=['p.scrape_id', 's.datetime_start'],
+        where_params=[car_id, car_id, car_id],
+        order_by='p.scrape_id',
+    )
+    changes = deque(db.select(
+        table='scrape_history',
+        columns=['scrape_id', 'price', 'label_set_id'],
+        where_clause='car_id = ?',
+        where_params=[car_id],
+        order_by='scrape_id',
+    ))
+
+    series = []
+    price, label_set_id = None, None
+    for scrape_id, datetime_start in scrapes:
+        while changes and changes[0][0] <= scrape_id:
+            price, label_set_id = changes.popleft()[1:]
+        series.append((scrape_id, datetime_start, price, label_sets.names_of(label_set_id)))
+    return series
+
+
+def scrape_snapshot(scrape_id):
+    """
+    Reconstruct the prices of every car seen in a scrape, from history rows
+    written in either history mode.
+
+    Returns:
+        dict: {car_id: (price, label names)}.
+    """
+    rows = db.select(
+        table=(
+            '(SELECT car_id FROM scrape_history WHERE scrape_id = ? '
+            'UNION SELECT c.car_id FROM cars c JOIN scrape_presence p '
+            'ON c.car_id BETWEEN p.first_car_id AND p.last_car_id WHERE p.scrape_id = ?) s '
+            'JOIN scrape_history h ON h.car_id = s.car_id'
+        ),
+        columns=['s.car_id', 'h.price', 'h.label_set_id'],
+        where_clause=(
+            'h.scrape_id = (SELECT MAX(scrape_id) FROM scrape_history '
+            'WHERE car_id = s.car_id AND scrape_id <= ?)'
+        ),
+        where_params=[scrape_id, scrape_id, scrape_id],
+    )
+    return {car_id: (price, label_sets.names_of(label_set_id)) for car_id, price, label_set_id in rows}
+
+
+def resolve_known_cars(identifiers, website, chunk_size=500):
+    """
+    Hydrate the ORM objects of the cars of a listing page already in the database.
+    Cars (and their version) held by the identity map are built from it without
+    queries, with no VersionDetails (a known car doesn't write them); the others
+    are read with a single joined query (per `chunk_size` identifiers), instead of
+    reading every car, version and version details separately.
+
+    Args:
+        identifiers (list): Identifiers of the cars on the page.
+        website (str): Website of the cars.
+
+    Returns:
+        dict: {identifier: (Car, Version, VersionDetails or None)} of the known cars.
+    """
+    known_cars = {}
+    missing = []
+    for identifier in identifiers:
+        car_row = identity_map.car(identifier, website)
+        version_row = identity_map.version(car_row['version_id']) if car_row else None
+        if version_row is None:
+            missing.append(identifier)
+            continue
+        version = Version.from_row(version_row)
+        known_cars[str(identifier)] = (Car.from_row(car_row, version_object=version), version, None)
+    if identity_map.cars_complete:
+        # The identity map knows every car in the database
+        missing = [identifier for identifier in missing if identity_map.car(identifier, website)]
+    identifiers = missing
+    car_columns = IdentityMap.car_columns
+    version_columns = IdentityMap.version_columns
+    details_columns = ['version_id'] + VersionDetails.table_columns
+    columns = (
+        [f'c.{column}' for column in car_columns]
+        + [f'v.{column}' for column in version_columns]
+        + [f'd.{column}' for column in details_columns]
+    )
+
+    for start in range(0, len(identifiers), chunk_size):
+        chunk = [str(identifier) for identifier in identifiers[start:start + chunk_size]]
+        rows = db.select(
+            table=(
+                'cars c JOIN versions v ON v.version_id = c.version_id '
+                'LEFT JOIN version_details d ON d.version_id = c.version_id'
+            ),
+            columns=columns,
+            where_clause='c.website = ? AND c.identifier IN (' + ', '.join('?' * len(chunk)) + ')',
+            where_params=[website] + chunk,
+        )
+        for row in rows:
+            car_row = dict(zip(car_columns, row[:len(car_columns)]))
+            row = row[len(car_columns):]
+            version_row = dict(zip(version_columns, row[:len(version_columns)]))
+            details_row = dict(zip(details_columns, row[len(version_columns):]))
+
+            version = Version.from_row(version_row)
+            car = Car.from_row(car_row, version_object=version)
+            details = None
+            if details_row['version_id'] is not None:
+                details = VersionDetails.from_row(details_row, version_object=version)
+            identity_map.register(version)
+            identity_map.register(car)
+            known_cars[str(car_row['identifier'])] = (car, version, details)
+    return known_cars
+
+
+identity_map = IdentityMap()
+cities = Dimension('cities', 'city_id')
+label_sets = LabelSets(Dimension('labels', 'label_id'))
@@ -0,0 +1,111 @@
+import asyncio
+from urllib.parse import urlsplit
+import configurations
+
+
+class HostLimiter:
+    """
+    Limits the requests sent to a single host: at most `max_concurrency` requests
+    in flight, and new requests start no faster than `requests_per_second` (if set).
+    """
+
+    def __init__(self, max_concurrency, requests_per_second):
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pace_lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        try:
+            await self._wait_turn()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._semaphore.release()
+
+    async def _wait_turn(self):
+        """
+        Sleeps until the next request slot for the host is available.
+        """
+        if not self.requests_per_second:
+            return
+        async with self._pace_lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            wait = self._next_start - now
+            self._next_start = max(now, self._next_start) + 1 / self.requests_per_second
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncCrawler:
+    """
+    Runs blocking Scraper constructions (fetch + parse) concurrently from an asyncio
+    event loop, applying the per-host limits from `configurations.HOST_LIMITS`.
+    Requests are paced by the adaptive rate limiters of the HTTP client, shared
+    with every other fetcher of the process.
+    """
+
+    def __init__(self, host_limits=None, max_concurrency=None, requests_per_second=None):
+        self.host_limits = host_limits if host_limits is not None else configurations.HOST_LIMITS
+        self.max_concurrency = max_concurrency or configurations.DEFAULT_MAX_CONCURRENCY
+        self.requests_per_second = (
+            requests_per_second if requests_per_second is not None
+            else configurations.DEFAULT_REQUESTS_PER_SECOND
+        )
+        self._limiters = {}
+
+    def limiter_for(self, url):
+        """
+        Return the HostLimiter shared by every request to the host of `url`.
+        """
+        host = urlsplit(url).netloc
+        if host not in self._limiters:
+            limits = self.host_limits.get(host, {})
+            self._limiters[host] = HostLimiter(
+                max_concurrency=limits.get('max_concurrency', self.max_concurrency),
+                requests_per_second=limits.get('requests_per_second', self.requests_per_second),
+            )
+        return self._limiters[host]
+
+    async def run_limited(self, url, func, *args, **kwargs):
+        """
+        Run the blocking callable `func` in a worker thread once the host of `url`
+        has a free request slot.
+        """
+        async with self.limiter_for(url):
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def fetch(self, scraper_cls, url, **kwargs):
+        """
+        Fetch and parse `url` into an instance of `scraper_cls`.
+
+        :param scraper_cls: Scraper subclass to instantiate.
+        :param url: url of the page to scrape.
+        :return: scraper_cls instance.
+        """
+        return await self.run_limited(url, scraper_cls, url, **kwargs)
+
+    async def fetch_many(self, scraper_cls, urls):
+        """
+        Fetch every page of `urls` concurrently, yielding them as they complete.
+
+        :param scraper_cls: Scraper subclass to instantiate for every page.
+        :param urls: dictionary mapping a key (e.g. the item identifier) to its url.
+        :return: async generator of (key, scraper_cls instance) tuples.
+        """
+        async def fetch_keyed(key, url):
+            return key, await self.fetch(scraper_cls, url)
+
+        tasks = [asyncio.create_task(fetch_keyed(key, url)) for key, url in urls.items()]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
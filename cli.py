@@ -0,0 +1,178 @@
+"""
+Command-line entry point of the scraper:
+
+    python cli.py scrape [--async | --pipeline [--processes N]] [--sqlite]
+    python cli.py enqueue [--no-wait] [--sqlite]
+    python cli.py work [--scrape-id ID] [--worker ID] [--batch-size N] [--sqlite]
+    python cli.py reparse URL [--field FIELD ...]
+    python cli.py export TABLE [--output FILE] [--format csv|jsonl]
+    python cli.py maintenance cache-prune [--max-age SECONDS]
+    python cli.py maintenance migrate [--target VERSION]
+    python cli.py maintenance retire-history [--before DATE] [--no-archive]
+
+The modules of every command are imported when the command runs, so commands
+that don't need the database or the scraping stack start without loading them.
+"""
+import argparse
+import sys
+
+
+def scrape(args):
+    from database import db
+    from main import Main
+
+    if args.sqlite:
+        db.configure(use_postgres=False)
+    main = Main()
+    if args.use_async:
+        import asyncio
+        asyncio.run(main.run_async())
+    elif args.pipeline:
+        main.run_pipeline(parse_processes=args.processes)
+    else:
+        main.run()
+
+
+def enqueue(args):
+    from database import db
+    from main import Main
+
+    if args.sqlite:
+        db.configure(use_postgres=False)
+    Main().enqueue_scrape(wait=not args.no_wait)
+
+
+def work(args):
+    from database import db
+    from main import Main
+
+    if args.sqlite:
+        db.configure(use_postgres=False)
+    Main().work(scrape_id=args.scrape_id, worker=args.worker, batch_size=args.batch_size)
+
+
+def reparse(args):
+    import json
+    from webpage_parsers import KavakItem
+
+    item = KavakItem(args.url)
+    record = item.extract_record(args.field or None)
+    json.dump(record, sys.stdout, ensure_ascii=False, indent=2, default=str)
+    print()
+
+
+def export(args):
+    import csv
+    import json
+    from database import db
+
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        column_names, rows = db.iter_select(args.table, order_by=args.order_by)
+        if args.format == 'csv':
+            writer = csv.writer(output)
+            writer.writerow(column_names)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                output.write(json.dumps(dict(zip(column_names, row)), ensure_ascii=False, default=str) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def cache_prune(args):
+    from page_cache import PageCache
+
+    removed = PageCache().prune(args.max_age)
+    print(f'Removed {removed} cached pages')
+
+
+def migrate(args):
+    from database import db
+
+    db.migrate(args.target)
+    for version, name in sorted(db.migrator.applied().items()):
+        print(f'{version:>4} {name}')
+
+
+def retire_history(args):
+    import datetime
+    import configurations
+    from database import db
+    from migrations import retire_history
+
+    if args.before:
+        before = datetime.date.fromisoformat(args.before)
+    elif configurations.HISTORY_RETENTION_DAYS:
+        before = datetime.date.today() - datetime.timedelta(days=configurations.HISTORY_RETENTION_DAYS)
+    else:
+        print('No retention configured, use --before')
+        return
+    retired = retire_history(db.get(), before, archive=not args.no_archive)
+    print(f'Retired {", ".join(retired) or "nothing"}')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Car prices web scraper')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scrape_parser = commands.add_parser('scrape', help='scrape every listing page and store the items')
+    scrape_parser.add_argument('--async', dest='use_async', action='store_true',
+                               help='fetch the detail pages concurrently')
+    scrape_parser.add_argument('--pipeline', action='store_true',
+                               help='run fetching, parsing and writing as concurrent stages')
+    scrape_parser.add_argument('--processes', type=int,
+                               help='parse the pages of the pipeline in this many processes (0: in threads)')
+    scrape_parser.add_argument('--sqlite', action='store_true', help='use the SQLite database')
+    scrape_parser.set_defaults(func=scrape)
+
+    enqueue_parser = commands.add_parser('enqueue', help='start a scrape, queueing its new items for the workers')
+    enqueue_parser.add_argument('--no-wait', action='store_true',
+                                help="don't wait for the workers to process the queued items")
+    enqueue_parser.add_argument('--sqlite', action='store_true', help='use the SQLite database')
+    enqueue_parser.set_defaults(func=enqueue)
+
+    work_parser = commands.add_parser('work', help='process the queued items of a scrape')
+    work_parser.add_argument('--scrape-id', type=int,
+                             help='scrape to work on (the last one still being queued or with items left)')
+    work_parser.add_argument('--worker', help='worker id (host:pid by default)')
+    work_parser.add_argument('--batch-size', type=int, help='items claimed at once')
+    work_parser.add_argument('--sqlite', action='store_true', help='use the SQLite database')
+    work_parser.set_defaults(func=work)
+
+    reparse_parser = commands.add_parser('reparse', help='parse a single item page and print its fields')
+    reparse_parser.add_argument('url')
+    reparse_parser.add_argument('--field', action='append', help='field to extract (all by default)')
+    reparse_parser.set_defaults(func=reparse)
+
+    export_parser = commands.add_parser('export', help='export a table as CSV or JSON lines')
+    export_parser.add_argument('table')
+    export_parser.add_argument('--output', '-o', help='output file (stdout by default)')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    export_parser.add_argument('--order-by', help='ORDER BY expression')
+    export_parser.set_defaults(func=export)
+
+    maintenance_parser = commands.add_parser('maintenance', help='maintenance tasks')
+    maintenance_commands = maintenance_parser.add_subparsers(dest='task', required=True)
+    prune_parser = maintenance_commands.add_parser('cache-prune', help='delete expired pages from the page cache')
+    prune_parser.add_argument('--max-age', type=int, help='maximum age in seconds (largest TTL by default)')
+    prune_parser.set_defaults(func=cache_prune)
+    migrate_parser = maintenance_commands.add_parser('migrate', help='apply the pending schema migrations')
+    migrate_parser.add_argument('--target', type=int, help='last migration version to apply')
+    migrate_parser.set_defaults(func=migrate)
+    retire_parser = maintenance_commands.add_parser('retire-history', help='archive and drop old scrape history')
+    retire_parser.add_argument('--before', help='retire the history older than this date (YYYY-MM-DD)')
+    retire_parser.add_argument('--no-archive', action='store_true', help="don't archive the retired rows")
+    retire_parser.set_defaults(func=retire_history)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,170 @@
+import os
+from dataclasses import dataclass
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36',
     'Accept-Encoding': 'gzip, deflate',
     'Accept-Language': 'es-MX,en-US,en;q=0.5',
-}
\ No newline at end of file
+}
+
+# Crawl limits. HOST_LIMITS overrides the defaults (and the RATE_LIMIT settings)
+# for a specific host. Requests are paced by the adaptive rate limiters, a fixed
+# DEFAULT_REQUESTS_PER_SECOND adds a static pacing to the async crawler.
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_REQUESTS_PER_SECOND = None
+HOST_LIMITS = {
+    'www.kavak.com': {'max_concurrency': 4, 'initial_rate': 0.5, 'max_rate': 4.0},
+}
+
+# Adaptive rate limiter of every host (rate_limit.AdaptiveRateLimiter): rates in
+# requests per second. The rate grows by `increase` after every fast response, and
+# is multiplied by `decrease` on 429/503 responses, errors, or latencies above
+# `latency_target` seconds.
+RATE_LIMIT = {
+    'initial_rate': 1.0,
+    'min_rate': 0.1,
+    'max_rate': 10.0,
+    'burst': 1,
+    'increase': 0.05,
+    'decrease': 0.5,
+    'latency_target': 3.0,
+}
+
+# HTTP client. Timeouts in seconds, backoff delay is RETRY_BACKOFF * 2 ** attempt.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_MAXSIZE = 10
+
+# Discover the pages of results concurrently (after reading the number of pages
+# from the first one) instead of one after another, yielding them as they are
+# fetched, or in page order if DISCOVERY_ORDERED.
+PARALLEL_DISCOVERY = False
+DISCOVERY_ORDERED = False
+
+# Staged pipeline (Main.run_pipeline): worker threads per stage, maximum items
+# waiting in the queue before every stage, and seconds between queue reports
+# (None to disable them). The persist stage always runs on a single thread.
+PIPELINE_WORKERS = {'discover': 1, 'fetch': 4, 'parse': 2}
+PIPELINE_QUEUE_SIZE = 100
+PIPELINE_REPORT_INTERVAL = 30
+# Worker processes parsing the detail pages in the pipeline (0 parses them in the
+# parse threads instead)
+PARSE_PROCESSES = 0
+
+# Distributed crawl (work_queue.py): seconds a claimed item is leased to a worker
+# (extended by its heartbeats), claims of an item before it is marked as failed,
+# items claimed at once, and seconds between polls of an idle worker.
+WORK_QUEUE_LEASE = 300
+WORK_QUEUE_MAX_ATTEMPTS = 3
+WORK_QUEUE_BATCH_SIZE = 20
+WORK_QUEUE_POLL_INTERVAL = 5
+
+# On-disk page cache. TTLs in seconds per page type; stale pages are revalidated
+# with a conditional GET before being downloaded again.
+PAGE_CACHE_ENABLED = True
+PAGE_CACHE_DIR = 'data/cache/pages'
+PAGE_CACHE_TTL = {
+    'listing': 60 * 60,
+    'detail': 7 * 24 * 60 * 60,
+}
+
+# BeautifulSoup parser backend of the scrapers: 'html.parser', 'lxml', 'html5lib'
+# or 'selectolax' (requires the optional lxml / html5lib / selectolax packages).
+PARSER_BACKEND = 'html.parser'
+
+# Read fields from the JSON application state embedded in the pages when present,
+# falling back to the CSS/regex extraction for every missing field.
+USE_EMBEDDED_STATE = False
+
+# Write ORM objects with INSERT ... ON CONFLICT upserts instead of checking first
+# whether their rows exist (only used if the database supports them).
+UPSERT_WRITES = True
+
+# Maximum number of versions and of cars kept in the ORM identity map
+IDENTITY_MAP_CAPACITY = 200000
+
+# Whether this process is the only one writing to the database. Only then does a
+# complete identity map prove that a version or car missing from it is new (rows
+# written by other processes, e.g. crawl workers, never reach the map).
+SINGLE_WRITER = False
+
+# Maximum number of PostgreSQL connections (one per thread using the database)
+DB_POOL_SIZE = 10
+
+
+# SQLite connection profile, used when PostgreSQL is unavailable. The pragmas run on
+# every new connection (with WAL and synchronous=NORMAL a crash can lose the last
+# transactions, but never corrupts the database). If SQLITE_BATCH_SYNCHRONOUS is
+# set, `synchronous` is changed to it inside Database.transaction(): 'OFF' writes
+# batches faster, but a power loss or OS crash during one can corrupt the database.
+# SQLITE_STATEMENT_CACHE is the number of prepared statements kept per connection.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,
+}
+SQLITE_BATCH_SYNCHRONOUS = None
+SQLITE_STATEMENT_CACHE = 512
+
+# Price history mode: 'full' writes a scrape_history row for every car on every
+# scrape, 'delta' only when its price or labels change, recording the cars seen in
+# every scrape as ranges of car ids in scrape_presence.
+HISTORY_MODE = 'full'
+
+# Apply the pending schema migrations when a scrape, enqueue or work command starts
+# (other commands never migrate). If False, they are applied with
+# `cli.py maintenance migrate`.
+AUTO_MIGRATE = True
+
+# Directory of the scrape_history rows archived before being retired
+# (migrations.retire_history), and age in days of the rows retired by
+# `cli.py maintenance retire-history` (None keeps the whole history).
+HISTORY_ARCHIVE_DIR = 'data/archive/scrape_history'
+HISTORY_RETENTION_DAYS = None
+
+# Environment file with the database credentials (DB_*) and the scraped website (WEBSITE1)
+ENV_FILE = '.env'
+_env_loaded = False
+
+
+def env(name, default=None):
+    """
+    Return the environment variable `name`, loading ENV_FILE the first time a
+    variable is read (instead of at import time).
+    """
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv(ENV_FILE)
+        _env_loaded = True
+    return os.getenv(name, default)
+
+
+@dataclass(frozen=True)
+class DatabaseConfig:
+    """
+    Connection settings of the database. `name` is the PostgreSQL database name,
+    and the SQLite file name (without the .sqlite suffix) of the fallback database.
+    """
+    name: str
+    user: str = None
+    password: str = None
+    host: str = None
+    port: str = None
+    schema_file: str = 'database_squema.sql'
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            name=env('DB_NAME'),
+            user=env('DB_USER'),
+            password=env('DB_PASSWORD'),
+            host=env('DB_HOST'),
+            port=env('DB_PORT'),
+        )
@@ -0,0 +1,67 @@
+"""
+Shared pytest fixtures. The modules of the scraper live at the root of the
+repository, which pytest adds to sys.path because this file is here.
+"""
+import os
+import pytest
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'tests', 'fixtures')
+
+
+@pytest.fixture
+def embedded_page():
+    """
+    Return a function building an HTML page embedding the JSON of a fixture file
+    as its __NEXT_DATA__ application state.
+    """
+    def build(fixture_name, body=''):
+        with open(os.path.join(FIXTURES_DIR, fixture_name), 'r', encoding='utf-8') as file:
+            state = file.read()
+        return (
+            f'<html><head><script id="__NEXT_DATA__" type="application/json">{state}</script></head>'
+            f'<body>{body}</body></html>'
+        ).encode()
+
+    return build
+
+
+@pytest.fixture
+def empty_database(tmp_path, monkeypatch):
+    """
+    Fresh SQLite database without any migration applied, used by the shared `db`.
+    """
+    import configurations
+    from database import Database, db
+
+    monkeypatch.setattr(Database, '_instance', None)
+    instance = Database(use_postgres=False, config=configurations.DatabaseConfig(
+        name=str(tmp_path / 'cars'),
+        schema_file=os.path.join(os.path.dirname(__file__), 'database_squema.sql'),
+    ))
+    monkeypatch.setattr(db, '_database', instance)
+    yield instance
+    instance.release()
+
+
+@pytest.fixture
+def database(empty_database):
+    """
+    Fresh SQLite database with every migration applied, used by the shared `db`.
+    """
+    empty_database.migrate()
+    return empty_database
+
+
+@pytest.fixture
+def orm(database, monkeypatch):
+    """
+    The ORM module, with its id allocator, identity map and dimension caches reset.
+    """
+    import ORM
+
+    monkeypatch.setattr(ORM, 'id_allocator', ORM.IdAllocator())
+    monkeypatch.setattr(ORM, 'identity_map', ORM.IdentityMap())
+    monkeypatch.setattr(ORM, 'cities', ORM.Dimension('cities', 'city_id'))
+    monkeypatch.setattr(ORM, 'label_sets', ORM.LabelSets(ORM.Dimension('labels', 'label_id')))
+    ORM.Version._allocated_ids.clear()
+    return ORM
@@ -1,23 +1,35 @@
+import asyncio
+import csv
+import io
 import sqlite3
+import threading
 import psycopg2
-import os
-from dotenv import load_dotenv
-load_dotenv('.env')
-
-DATABASE_NAME = os.getenv('DB_NAME')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_HOST = os.getenv('DB_HOST')
-DB_PORT = os.getenv('DB_PORT')
-
-with open('database_squema.sql', 'r') as sql_file:
-    DATABASE_SCHEMA = sql_file.read()
+import psycopg2.extras
+import psycopg2.pool
+from contextlib import contextmanager
+import configurations
+from migrations import Migrator
+
+# Unique index on the natural key of versions, used as conflict target by the upserts.
+# Nullable columns are coalesced so versions with missing values are unique too.
+VERSIONS_NATURAL_KEY = [
+    'brand', 'model', 'version_name', 'year_prod', "COALESCE(body_style, '')",
+    'COALESCE(engine_displacement, -1)', "COALESCE(transmission_type, '')"
+]
+UPSERT_INDEXES = (
+    f'CREATE UNIQUE INDEX IF NOT EXISTS versions_natural_key ON versions ({", ".join(VERSIONS_NATURAL_KEY)});'
+)
 
 
 class Database:
     """
     Singleton class that handles database connections and
     database functionality.
+
+    Every thread gets its own connection and cursor: on PostgreSQL they are taken
+    from a pool of `configurations.DB_POOL_SIZE` connections, and on SQLite each
+    thread opens the database file with the `configurations.SQLITE_PRAGMAS` profile
+    (WAL mode, so readers don't block the writer).
     """
     _instance = None
 
@@ -34,37 +46,56 @@ class Database:
         else:
             return cls._instance
 
-    def __init__(self, use_postgres=False):
+    def __init__(self, use_postgres=False, config=None):
         """
         If the database instance (singleton) is instantiated, it creates the database
         connection and cursor. If the database file doesn't exist already, create the
         database and its schema.
+
+        :param config: configurations.DatabaseConfig, read from the environment by default.
         """
         if self.__initialized:
             return
 
+        self.config = config or configurations.DatabaseConfig.from_env()
+
         # Initialize chosen database (postgres or sqlite)
         self._initialized = False
+        self._local = threading.local()
+        self._pool = None
+        self._pool_slots = threading.BoundedSemaphore(configurations.DB_POOL_SIZE)
+        self._sqlite_path = None
+        self._synced_sequences = set()
         self.use_postgres = use_postgres
         if use_postgres:
             self._initialize_db_postgres()
         if not self._initialized:
-            self._initialize_db_sqlite()
             self.use_postgres = False
+            self._initialize_db_sqlite()
+        self.migrator = Migrator(self)
+        self.supports_upsert = self.migrator.is_applied('versions_natural_key')
+
+    def migrate(self, target=None):
+        """
+        Apply the pending schema migrations up to version `target` (all by default).
+        Connecting doesn't migrate the database: the scraping entry points call this
+        when configurations.AUTO_MIGRATE is set.
+
+        :return: list of the names of the migrations applied.
+        """
+        applied = self.migrator.migrate(target)
+        self.supports_upsert = self.migrator.is_applied('versions_natural_key')
+        return applied
 
     def _initialize_db_sqlite(self):
         """
         Initializes the SQLite database, connection and cursor.
-        Creates the database if it doesn't already exist.'
+        The database file is created on the first connection, and its schema by
+        the migrations.
 
         :return: None
         """
-        db_fullname = f'{DATABASE_NAME}.sqlite'
-        db_exists = os.path.exists(db_fullname)
-        self._connection = sqlite3.connect(db_fullname)
-        self._cursor = self._connection.cursor()
-        if not db_exists:
-            self._create_schema()
+        self._sqlite_path = f'{self.config.name}.sqlite'
         self._initialized = True
         print('Using DB SQLite')
 
@@ -79,34 +110,33 @@ class Database:
         try:
             conn = psycopg2.connect(
                 dbname='postgres',
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT
+                user=self.config.user,
+                password=self.config.password,
+                host=self.config.host,
+                port=self.config.port
             )
             conn.autocommit = True
             with conn.cursor() as cursor:
-                cursor.execute(f'SELECT 1 FROM pg_database WHERE datname ILIKE \'{DATABASE_NAME}\';')
+                cursor.execute(f'SELECT 1 FROM pg_database WHERE datname ILIKE \'{self.config.name}\';')
                 already_exists = len(cursor.fetchall()) > 0
                 if not already_exists:
-                    cursor.execute(f'CREATE DATABASE {DATABASE_NAME};')
+                    cursor.execute(f'CREATE DATABASE {self.config.name};')
                     print('PostgreSQL Database Created')
             conn.close()
         except psycopg2.OperationalError:
             print('PostgreSQL connection failed. Using SQLite instead')
             return
 
-        self._connection = psycopg2.connect(
-            dbname=DATABASE_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=configurations.DB_POOL_SIZE,
+            dbname=self.config.name,
+            user=self.config.user,
+            password=self.config.password,
+            host=self.config.host,
+            port=self.config.port
         )
-        self._cursor = self._connection.cursor()
         self._initialized = True
-        if not already_exists:
-            self._create_schema()
 
 
     def query(self, sql, params):
@@ -114,13 +144,82 @@ class Database:
             sql = sql.replace('?', '%s')
 
         self.cursor.execute(sql, params)
-        self.connection.commit()
+        if not self._in_transaction:
+            self.connection.commit()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Context manager grouping every query executed inside it in a single
+        transaction: committed on exit, or rolled back if an exception is raised.
+        Nested transactions are merged into the outermost one. The callbacks
+        registered with `on_commit` run after the commit, and those registered
+        with `on_rollback` after a rollback.
+
+        :param immediate: on SQLite, open the transaction at once with BEGIN
+                          IMMEDIATE, taking the write lock. Otherwise the sqlite3
+                          module only opens it before the first INSERT, UPDATE or
+                          DELETE, and the DDL statements executed before commit
+                          on their own (they are not rolled back).
+        """
+        if self._in_transaction:
+            yield self
+            return
+
+        relax_sync = not self.use_postgres and configurations.SQLITE_BATCH_SYNCHRONOUS
+        if relax_sync:
+            self.connection.execute(f'PRAGMA synchronous = {configurations.SQLITE_BATCH_SYNCHRONOUS}')
+        if immediate and not self.use_postgres and not self.connection.in_transaction:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+        self._in_transaction = True
+        self._local.commit_callbacks = []
+        self._local.rollback_callbacks = []
+        try:
+            yield self
+        except BaseException:
+            self.connection.rollback()
+            self._in_transaction = False
+            for callback in self._local.rollback_callbacks:
+                callback()
+            raise
+        else:
+            self.connection.commit()
+            self._in_transaction = False
+            for callback in self._local.commit_callbacks:
+                callback()
+        finally:
+            self._in_transaction = False
+            self._local.commit_callbacks = []
+            self._local.rollback_callbacks = []
+            if relax_sync:
+                synchronous = configurations.SQLITE_PRAGMAS.get('synchronous', 'FULL')
+                self.connection.execute(f'PRAGMA synchronous = {synchronous}')
+
+    def on_commit(self, callback):
+        """
+        Call `callback` (without arguments) once the transaction of the current
+        thread is committed, or right away outside of a transaction.
+        """
+        if self._in_transaction:
+            self._local.commit_callbacks.append(callback)
+        else:
+            callback()
+
+    def on_rollback(self, callback):
+        """
+        Call `callback` (without arguments) if the transaction of the current thread
+        is rolled back. Outside of a transaction it is never called.
+        """
+        if self._in_transaction:
+            self._local.rollback_callbacks.append(callback)
 
     def select_query(self, query):
         res = self.cursor.execute(query)
         return res.fetchall()
 
-    def select(self, table, columns='*', where_clause=None, where_params=None, verbose=False, return_column_names=False):
+    def select(self, table, columns='*', where_clause=None, where_params=None, verbose=False, return_column_names=False,
+               order_by=None, limit=None):
         """
            Executes a safe SELECT query on the database.
 
@@ -129,6 +228,8 @@ class Database:
                columns (list): List of columns to select.
                where_clause (str, optional): WHERE condition with placeholders.
                where_params (tuple or list, optional): Parameters for the WHERE clause.
+               order_by (str, optional): ORDER BY expression.
+               limit (int, optional): Maximum number of rows to return.
 
            Returns:
                list: Query results.
@@ -138,6 +239,10 @@ class Database:
 
         if where_clause:
             query += f" WHERE {where_clause}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
 
         if self.use_postgres:
             query = query.replace('?', '%s')
@@ -150,6 +255,37 @@ class Database:
             return column_names, self.cursor.fetchall()
         return self.cursor.fetchall()
 
+    def iter_select(self, table, columns='*', order_by=None, batch_size=1000):
+        """
+        Stream the rows of `table` in batches of `batch_size`, without loading the
+        whole table in memory (on PostgreSQL a server-side cursor is used).
+
+        :return: (column names, iterator of rows) tuple.
+        """
+        query = f"SELECT {', '.join(columns)} FROM {table}"
+        if order_by:
+            query += f" ORDER BY {order_by}"
+
+        if self.use_postgres:
+            cursor = self.connection.cursor(name=f'iter_{table}')
+            cursor.itersize = batch_size
+        else:
+            cursor = self.connection.cursor()
+        cursor.execute(query)
+        first_rows = cursor.fetchmany(batch_size)
+        column_names = [desc[0] for desc in cursor.description]
+
+        def rows():
+            batch = first_rows
+            try:
+                while batch:
+                    yield from batch
+                    batch = cursor.fetchmany(batch_size)
+            finally:
+                cursor.close()
+
+        return column_names, rows()
+
     def insert(self, table, values, ignore_protected=True):
         if ignore_protected:
             values = values.copy()
@@ -158,9 +294,12 @@ class Database:
                 if key.startswith('_'):
                     values.pop(key)
 
-        n_values = len(values)
-        columns = ', '.join(values.keys())
-        params = list(values.values())
+        sql = self._insert_sql(table, list(values.keys()))
+        self.query(sql, list(values.values()))
+
+    def _insert_sql(self, table, columns):
+        n_values = len(columns)
+        columns = ', '.join(columns)
         sql = (
             f'INSERT INTO {table}\n'
             f'({columns})\nVALUES '
@@ -169,8 +308,108 @@ class Database:
 
         if self.use_postgres:
             sql = sql.replace('?', '%s')
+        return sql
 
-        self.query(sql, params)
+    def upsert(self, table, values, conflict_columns, returning=None, ignore_protected=True):
+        """
+        Insert a row relying on a unique constraint instead of checking first if it
+        exists: `INSERT ... ON CONFLICT (conflict_columns) DO NOTHING`, or, when a
+        column to return is requested, a no-op `DO UPDATE ... RETURNING` so the key of
+        the existing row is returned on conflict.
+
+        Args:
+            table (str): Name of the table.
+            values (dict): Column values of the row.
+            conflict_columns (list): Columns (or index expressions) of the unique constraint.
+            returning (str, optional): Column to return from the inserted or existing row.
+
+        Returns:
+            The value of the `returning` column, or None.
+        """
+        if ignore_protected:
+            values = {key: value for key, value in values.items() if not key.startswith('_')}
+
+        sql = self._insert_sql(table, list(values.keys())) + self._conflict_clause(conflict_columns, returning)
+        self.cursor.execute(sql, list(values.values()))
+        result = self.cursor.fetchone()[0] if returning else None
+        if not self._in_transaction:
+            self.connection.commit()
+        return result
+
+    @staticmethod
+    def _conflict_clause(conflict_columns, returning=None):
+        target = ', '.join(conflict_columns)
+        if returning:
+            # The first conflict column must be a plain column
+            first_column = conflict_columns[0]
+            return (
+                f'\nON CONFLICT ({target}) DO UPDATE SET {first_column} = excluded.{first_column}'
+                f'\nRETURNING {returning}'
+            )
+        return f'\nON CONFLICT ({target}) DO NOTHING'
+
+    def insert_many(self, table, rows, conflict_columns=None):
+        """
+        Insert several rows in a single statement execution: `executemany` on SQLite,
+        and a multi-row VALUES list (`execute_values`) on PostgreSQL.
+
+        Args:
+            table (str): Name of the table.
+            rows (list[dict]): Rows to insert, all with the same columns.
+            conflict_columns (list, optional): If given, rows conflicting with this
+                unique constraint are skipped (ON CONFLICT DO NOTHING).
+        """
+        if not rows:
+            return
+        columns = list(rows[0].keys())
+        params = [[row[column] for column in columns] for row in rows]
+        conflict_clause = self._conflict_clause(conflict_columns) if conflict_columns else ''
+        if self.use_postgres:
+            sql = f'INSERT INTO {table} ({", ".join(columns)}) VALUES %s' + conflict_clause
+            psycopg2.extras.execute_values(self.cursor, sql, params, page_size=1000)
+        else:
+            self.cursor.executemany(self._insert_sql(table, columns) + conflict_clause, params)
+        if not self._in_transaction:
+            self.connection.commit()
+
+    def copy_rows(self, table, rows, conflict_columns=None):
+        """
+        Bulk load rows with PostgreSQL's COPY (falls back to `insert_many` on SQLite).
+
+        Args:
+            table (str): Name of the table.
+            rows (list[dict]): Rows to insert, all with the same columns.
+            conflict_columns (list, optional): If given, rows conflicting with this
+                unique constraint are skipped: the rows are copied into a temporary
+                staging table, then moved with INSERT ... ON CONFLICT DO NOTHING.
+        """
+        if not rows:
+            return
+        if not self.use_postgres:
+            return self.insert_many(table, rows, conflict_columns)
+
+        columns = list(rows[0].keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+        buffer.seek(0)
+        target = table
+        if conflict_columns:
+            target = f'copy_staging_{table}'
+            self.cursor.execute(f'CREATE TEMP TABLE {target} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP')
+        self.cursor.copy_expert(
+            f"COPY {target} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer
+        )
+        if conflict_columns:
+            self.cursor.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {target}"
+                + self._conflict_clause(conflict_columns)
+            )
+            self.cursor.execute(f'DROP TABLE {target}')
+        if not self._in_transaction:
+            self.connection.commit()
 
     def update(self, table, values, ignore_protected=True, where_clause=None, where_params=None):
         if ignore_protected:
@@ -180,7 +419,7 @@ class Database:
                 if key.startswith('_'):
                     values.pop(key)
 
-        sets_clauses = ', '.join([f'{col} = \'{value}\'' for col, value in values.items()])
+        sets_clauses = ', '.join([f'{col} = ?' for col in values.keys()])
 
         sql = (
             f'UPDATE {table}\n' 
@@ -191,7 +430,69 @@ class Database:
         if self.use_postgres:
             sql = sql.replace('?', '%s')
 
-        self.query(sql, where_params or [])
+        self.query(sql, list(values.values()) + list(where_params or []))
+
+    def reserve_ids(self, table, column, count=1):
+        """
+        Reserve `count` unused values for the primary key `column` of `table`. The
+        values are unique across processes: on PostgreSQL they come from the SERIAL
+        sequence of the column, and on SQLite from the `id_sequences` table, updated
+        under a write lock. On SQLite, values reserved inside a transaction are only
+        reserved once it commits (see `on_rollback`).
+
+        :return: list of reserved ids, in increasing order.
+        """
+        if self.use_postgres:
+            return self._reserve_ids_postgres(table, column, count)
+        return self._reserve_ids_sqlite(table, column, count)
+
+    def _reserve_ids_postgres(self, table, column, count):
+        self.cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', (table, column))
+        sequence = self.cursor.fetchone()[0]
+        if (table, column) not in self._synced_sequences:
+            # Rows inserted with explicit ids don't advance the sequence: move it past
+            # the current maximum once, holding a lock so concurrent scrapers agree.
+            self.cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (sequence,))
+            self.cursor.execute(
+                f'SELECT setval(%s, m) FROM (SELECT MAX({column}) AS m FROM {table}) t '
+                f'WHERE m >= (SELECT last_value FROM {sequence})',
+                (sequence,)
+            )
+            if not self._in_transaction:
+                self.connection.commit()
+            self._synced_sequences.add((table, column))
+
+        self.cursor.execute('SELECT nextval(%s) FROM generate_series(1, %s)', (sequence, count))
+        ids = [row[0] for row in self.cursor.fetchall()]
+        if not self._in_transaction:
+            self.connection.commit()
+        return sorted(ids)
+
+    def _reserve_ids_sqlite(self, table, column, count):
+        began = not self.connection.in_transaction
+        if began:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self.cursor.execute(
+                'CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)'
+            )
+            name = f'{table}.{column}'
+            self.cursor.execute('SELECT next_id FROM id_sequences WHERE name = ?', (name,))
+            row = self.cursor.fetchone()
+            self.cursor.execute(f'SELECT COALESCE(MAX({column}) + 1, 0) FROM {table}')
+            next_id = max(row[0] if row else 0, self.cursor.fetchone()[0])
+            self.cursor.execute(
+                'INSERT INTO id_sequences (name, next_id) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET next_id = excluded.next_id',
+                (name, next_id + count)
+            )
+        except BaseException:
+            if began:
+                self.connection.rollback()
+            raise
+        if began:
+            self.connection.commit()
+        return list(range(next_id, next_id + count))
 
     def get_item_match(self, table_name, item_values):
         columns = list(item_values.keys())
@@ -209,27 +510,149 @@ class Database:
 
     @property
     def cursor(self):
-        return self._cursor
+        if getattr(self._local, 'cursor', None) is None:
+            self._local.cursor = self.connection.cursor()
+        return self._local.cursor
 
     @property
     def connection(self):
-        return self._connection
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = self._open_connection()
+        return self._local.connection
+
+    @property
+    def _in_transaction(self):
+        return getattr(self._local, 'in_transaction', False)
+
+    @_in_transaction.setter
+    def _in_transaction(self, value):
+        self._local.in_transaction = value
+
+    def _open_connection(self):
+        """
+        Open the connection of the current thread: taken from the pool on
+        PostgreSQL (waiting for a free one if all are in use), or a new connection
+        to the database file on SQLite.
+        """
+        if self.use_postgres:
+            self._pool_slots.acquire()
+            try:
+                return self._pool.getconn()
+            except BaseException:
+                self._pool_slots.release()
+                raise
+
+        connection = sqlite3.connect(
+            self._sqlite_path, timeout=30, cached_statements=configurations.SQLITE_STATEMENT_CACHE
+        )
+        for pragma, value in configurations.SQLITE_PRAGMAS.items():
+            connection.execute(f'PRAGMA {pragma} = {value}')
+        return connection
+
+    def release(self):
+        """
+        Give back the connection of the current thread (to the pool on PostgreSQL,
+        closing it on SQLite). The thread opens a new one on its next query.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is not None:
+            cursor.close()
+        if self.use_postgres:
+            connection.rollback()
+            self._pool.putconn(connection)
+            self._pool_slots.release()
+        else:
+            connection.close()
+        self._local.connection = None
+        self._local.cursor = None
+        self._local.in_transaction = False
+
+    @contextmanager
+    def connection_scope(self):
+        """
+        Context manager for worker threads: the thread's connection is released at
+        exit, unless the thread already held one when entering.
+        """
+        held = getattr(self._local, 'connection', None) is not None
+        try:
+            yield self
+        finally:
+            if not held:
+                self.release()
+
+    async def run_async(self, func, *args, **kwargs):
+        """
+        Run a blocking database call (e.g. `db.select`, or a function doing several
+        queries) in a worker thread with its own pooled connection, so coroutines
+        can use the database without blocking the event loop or sharing a cursor.
+        """
+        def run_scoped():
+            with self.connection_scope():
+                return func(*args, **kwargs)
+
+        return await asyncio.to_thread(run_scoped)
 
     def _create_schema(self, cursor=None):
         """
-        If the database is being created, it executes the SQL code to create
-        the database schema.
+        Executes the SQL code creating the baseline database schema (the first
+        migration).
         :return:
         """
         print('Initializing Database!')
+        with open(self.config.schema_file, 'r') as sql_file:
+            schema = sql_file.read()
         cursor = cursor or self.cursor
         if self.use_postgres:
-            cursor.execute(DATABASE_SCHEMA)
+            cursor.execute(schema)
         else:
-            cursor.executescript(DATABASE_SCHEMA)
-        self._connection.commit()
+            # executescript would commit the running transaction first
+            for statement in schema.split(';'):
+                if statement.strip():
+                    cursor.execute(statement)
+        if not self._in_transaction:
+            self.connection.commit()
+
+
+class LazyDatabase:
+    """
+    Stand-in for the Database singleton that only connects (and creates the schema)
+    the first time one of its attributes is used, so importing the modules that
+    share `db` costs no connection attempt and works without a database.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._database = None
+        self._lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        """
+        Change the Database arguments (use_postgres, config) before its first use.
+        """
+        if self._database is not None:
+            raise RuntimeError('The database is already initialized')
+        self._kwargs.update(kwargs)
+
+    @property
+    def initialized(self):
+        return self._database is not None
+
+    def get(self):
+        """
+        Return the Database instance, initializing it on the first call.
+        """
+        if self._database is None:
+            with self._lock:
+                if self._database is None:
+                    self._database = Database(**self._kwargs)
+        return self._database
 
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
 
 
-db = Database(use_postgres=True)
+db = LazyDatabase(use_postgres=True)
 
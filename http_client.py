@@ -0,0 +1,180 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import configurations
+from page_cache import PageCache
+from rate_limit import rate_limiters as shared_rate_limiters
+
+
+class RequestStats:
+    """
+    Thread-safe latency accounting of the requests sent by an HttpClient.
+    Keeps the totals and the latencies of the last `window` requests per host.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, url, status_code, elapsed):
+        """
+        Register a request attempt.
+
+        :param url: requested url.
+        :param status_code: status code of the response, or None if the request failed.
+        :param elapsed: seconds elapsed between sending the request and receiving the response.
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            stats = self._hosts.setdefault(host, {
+                'requests': 0, 'errors': 0, 'total_time': 0.0, 'latencies': deque(maxlen=self.window)
+            })
+            stats['requests'] += 1
+            stats['total_time'] += elapsed
+            stats['latencies'].append(elapsed)
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+
+    def summary(self):
+        """
+        Return a dictionary per host with the number of requests and errors, and the
+        mean, p50, p95 and max latency (in seconds) of the recent requests.
+        """
+        summary = {}
+        with self._lock:
+            for host, stats in self._hosts.items():
+                latencies = sorted(stats['latencies'])
+                n = len(latencies)
+                summary[host] = {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'mean': stats['total_time'] / stats['requests'],
+                    'p50': latencies[n // 2],
+                    'p95': latencies[min(n - 1, int(n * 0.95))],
+                    'max': latencies[-1],
+                }
+        return summary
+
+
+class HttpClient:
+    """
+    HTTP client every page fetch goes through. It keeps a pooled keep-alive session
+    sending `configurations.HEADERS` (so responses come compressed), applies
+    connect/read timeouts, retries failed requests and 429/5xx responses with
+    exponential backoff, and records the latency of every attempt in `stats`.
+    Every request waits for the adaptive rate limiter of its host, which adapts
+    to the latency and status of the responses.
+    """
+
+    def __init__(self, headers=None, timeout=None, max_retries=None, backoff=None, pool_maxsize=None, cache=None,
+                 rate_limiters=None):
+        self.timeout = timeout or (configurations.CONNECT_TIMEOUT, configurations.READ_TIMEOUT)
+        self.max_retries = configurations.MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = configurations.RETRY_BACKOFF if backoff is None else backoff
+        self.stats = RequestStats()
+        self.rate_limiters = rate_limiters or shared_rate_limiters
+        if cache is None and configurations.PAGE_CACHE_ENABLED:
+            cache = PageCache()
+        self.cache = cache or None
+
+        pool_maxsize = pool_maxsize or configurations.POOL_MAXSIZE
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session = requests.Session()
+        self.session.headers.update(headers or configurations.HEADERS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, params=None, **kwargs):
+        """
+        Send a GET request, retrying connection errors, timeouts and responses with a
+        status in `configurations.RETRY_STATUSES`.
+
+        :param url: url to request.
+        :param params: query string parameters.
+        :param kwargs: additional arguments for `requests.Session.get`.
+        :return: requests.Response of the last attempt.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        limiter = self.rate_limiters.for_url(url)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.stats.record(url, None, time.perf_counter() - start)
+                limiter.on_error()
+                if attempt == self.max_retries:
+                    raise
+                limiter.pause(self._retry_delay(attempt))
+                continue
+
+            elapsed = time.perf_counter() - start
+            self.stats.record(url, response.status_code, elapsed)
+            limiter.on_response(response.status_code, elapsed)
+            if response.status_code not in configurations.RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            # Every request to the host waits, not only this retry
+            limiter.pause(self._retry_delay(attempt, response))
+
+    def get_page(self, url, params=None, page_type='detail'):
+        """
+        GET an HTML page through the page cache: fresh cached pages are served from
+        disk, stale ones are revalidated with a conditional GET, and new 200
+        responses are stored.
+
+        :param url: url of the page.
+        :param params: query string parameters.
+        :param page_type: key of `configurations.PAGE_CACHE_TTL` ('listing' or 'detail').
+        :return: requests.Response, or page_cache.CachedResponse when served from the cache.
+        """
+        if not self.cache:
+            return self.get(url, params=params)
+
+        url = requests.Request('GET', url, params=params).prepare().url
+        entry = self.cache.lookup(url)
+        if entry and self.cache.is_fresh(entry, page_type):
+            cached = self.cache.response(entry)
+            if cached is not None:
+                return cached
+            entry = None
+
+        response = self.get(url, headers=self.cache.validators(entry) if entry else None)
+        if response.status_code == 304 and entry:
+            self.cache.touch(entry)
+            cached = self.cache.response(entry)
+            if cached is not None:
+                return cached
+            # The page was pruned since it was looked up
+            response = self.get(url)
+        if response.status_code == 200:
+            self.cache.store(url, response, page_type)
+        return response
+
+    def _retry_delay(self, attempt, response=None):
+        """
+        Seconds to wait before retrying: the Retry-After header of the response when
+        it is given in seconds, otherwise an exponential backoff.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff * 2 ** attempt
+
+    def metrics(self):
+        """
+        Return the latency summary of every host (see RequestStats.summary), with
+        the current state of its rate limiter.
+        """
+        limits = self.rate_limiters.metrics()
+        return {host: {**summary, **limits.get(host, {})} for host, summary in self.stats.summary().items()}
+
+    def close(self):
+        self.session.close()
+
+
+client = HttpClient()
@@ -1,9 +1,14 @@
-import requests
-from bs4 import BeautifulSoup
-from scraping import Scraper, PageIterator
+from scraping import Scraper, PageIterator, AsyncPageIterator, lookup_path
+from async_scraping import AsyncCrawler
+from http_client import client
 from webpage_parsers import KavakItem
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit, parse_qs
+import configurations
 import time
 import re
+from dataclasses import dataclass
 
 
 regex_odometer = re.compile('(\d+)\s?km')
@@ -27,20 +32,183 @@ class KavakPageIterator(PageIterator):
         :return: KavakPageScraper instance
         """
 
-        req = requests.get(self.base_url, params={'page': self.next_iteration})
-        self.url = req.request.url
+        number = self.next_iteration
+        page = self.fetch_page(number)
         self.next_iteration += 1
-        pagination_buttons = (
-            BeautifulSoup(req.content, 'html.parser')
-            .select('a.results_results__pagination-nav__Qcftr')
-        )
-
-        if len(pagination_buttons) < 2 and self.next_iteration > 1:
+        if not self.is_results_page(page, number):
             raise StopIteration
+
+        self.url = page.url
+        return page
+
+    @staticmethod
+    def is_results_page(page, number):
+        """
+        Whether the fetched page `number` is a page of results: it was fetched and,
+        past the first page, it still shows the pagination (the website serves
+        pages beyond the last one, without it).
+
+        :param page: KavakPageScraper instance, or None if the page couldn't be fetched.
+        """
+        if page is None:
+            return False
+        pagination_buttons = page.soup.select('a.results_results__pagination-nav__Qcftr')
+        return number == 0 or len(pagination_buttons) >= 2
+
+    def fetch_page(self, number):
+        """
+        Fetch and parse the page of results `number` (starting at 0). Safe to call
+        from several threads.
+
+        :return: KavakPageScraper instance, or None if the page couldn't be fetched.
+        """
+        req = client.get_page(self.base_url, params={'page': number}, page_type='listing')
         if req.status_code != 200:
-            raise StopIteration
+            return None
+        # The page is parsed once, and handed to the page scraper with its response
+        return KavakPageScraper(req.url, response=req)
+
+
+class ParallelKavakPageIterator(PageIterator):
+    """
+    Discovers every page of results concurrently: the number of pages is read
+    from the first page (or probed, see `count_pages`), then the pages are fetched
+    by `max_workers` threads and yielded as they complete, or in page order if
+    `ordered`. At most twice `max_workers` pages are fetched ahead of the consumer.
+    """
+    # Upper bound of the page numbers probed by count_pages
+    max_pages = 5000
+
+    def __init__(self, base_url, max_workers=None, ordered=None):
+        self.base_url = base_url
+        host_limits = configurations.HOST_LIMITS.get(urlsplit(base_url).netloc, {})
+        self.max_workers = max_workers or host_limits.get('max_concurrency', configurations.DEFAULT_MAX_CONCURRENCY)
+        self.ordered = configurations.DISCOVERY_ORDERED if ordered is None else ordered
+        self.url = None
+        self._pages = KavakPageIterator(base_url)
+        self._generator = None
+
+    def __iter__(self):
+        super().__iter__()
+        self._generator = self._discover()
+        return self
+
+    def __next__(self):
+        page = next(self._generator)
+        self.next_iteration += 1
+        self.url = page.url
+        return page
+
+    def count_pages(self, first_page, executor):
+        """
+        Return the number of pages of results: the total given by the first page,
+        or else the number of the last page of results found by probing page
+        numbers, `max_workers` at a time with `executor`: exponentially from the
+        last page linked by the first one, then by splitting the range between the
+        last page found and the first missing one.
+        """
+        total_pages = first_page.total_pages()
+        if total_pages:
+            return total_pages
+
+        def probe(numbers):
+            numbers = sorted(numbers)
+            results = executor.map(
+                lambda number: KavakPageIterator.is_results_page(self._pages.fetch_page(number), number), numbers
+            )
+            return dict(zip(numbers, results))
+
+        found, missing = 0, None
+        start = min(first_page.last_linked_page() or 1, self.max_pages)
+        numbers = {min(start * 2 ** power, self.max_pages) for power in range(self.max_workers)}
+        while numbers:
+            for number, exists in probe(numbers).items():
+                if not exists:
+                    missing = number
+                    break
+                found = number
+
+            if missing is None:
+                if found >= self.max_pages:
+                    break
+                numbers = {min(found * 2 ** power, self.max_pages) for power in range(1, self.max_workers + 1)}
+            else:
+                step = max((missing - found) / (self.max_workers + 1), 1)
+                numbers = {round(found + step * i) for i in range(1, self.max_workers + 1)}
+                numbers = {number for number in numbers if found < number < missing}
+        return found + 1
+
+    def _discover(self):
+        first_page = self._pages.fetch_page(0)
+        if first_page is None:
+            return
+        yield first_page
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            numbers = iter(range(1, self.count_pages(first_page, executor)))
+            window = 2 * self.max_workers
+            pending = deque(
+                executor.submit(self._pages.fetch_page, number) for _, number in zip(range(window), numbers)
+            )
+            while pending:
+                if self.ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending = deque(future for future in pending if future not in done)
+                for future in done:
+                    page = future.result()
+                    next_number = next(numbers, None)
+                    if next_number is not None:
+                        pending.append(executor.submit(self._pages.fetch_page, next_number))
+                    if page is not None:
+                        yield page
+
+
+class AsyncKavakPageIterator(AsyncPageIterator):
+    """
+    Async counterpart of KavakPageIterator. Each page is fetched in a worker thread
+    under the crawler's per-host limits, so the event loop stays free to fetch the
+    detail pages of the previous listing page meanwhile.
+    """
+    def __init__(self, base_url, crawler=None):
+        self.base_url = base_url
+        self.crawler = crawler or AsyncCrawler()
+        self._pages = None
+
+    @property
+    def url(self):
+        return self._pages.url if self._pages else None
+
+    def __aiter__(self):
+        super().__aiter__()
+        self._pages = iter(KavakPageIterator(self.base_url))
+        return self
+
+    async def __anext__(self):
+        """
+        Fetch the next page of results.
 
-        return KavakPageScraper(req.url)
+        :return: KavakPageScraper instance
+        """
+        page = await self.crawler.run_limited(self.base_url, next, self._pages, None)
+        if page is None:
+            raise StopAsyncIteration
+        self.next_iteration += 1
+        return page
+
+
+@dataclass(slots=True)
+class KavakCard:
+    """
+    Data of a car card in a Kavak page of results.
+    """
+    id: str
+    url: str
+    labels: tuple[str, ...] | None
+    price: str | None
+    city: str | None
+    odometer: str | None
 
 
 class KavakPageScraper(Scraper):
@@ -48,90 +216,182 @@ class KavakPageScraper(Scraper):
     A class providing the functionality to scrap a Kavak page of results
     (from pages of the website's pagination).
     """
+    page_type = 'listing'
+    parse_subtrees = (
+        'div.results_results__container__tcF4_',
+        'a.results_results__pagination-nav__Qcftr',
+    )
+    restrict_parsing = True
+    embedded_state_script_id = '__NEXT_DATA__'
+    # Key paths of the list of cards in the embedded state, and of each card field within a card
+    embedded_cards_paths = ('props.pageProps.results.cars', 'props.pageProps.cars')
+    # Key paths of the number of pages of results in the embedded state
+    embedded_total_pages_paths = ('props.pageProps.results.totalPages', 'props.pageProps.totalPages')
+    embedded_card_fields = {
+        'id': ('stockId', 'id'),
+        'url': 'url',
+        'labels': 'labels',
+        'price': 'price',
+        'city': ('location.city', 'city'),
+        'odometer': 'km',
+    }
 
-    def __init__(self, url):
-        super().__init__(url)
+    def __init__(self, url=None, **kwargs):
+        super().__init__(url, **kwargs)
+        self._cards = None
         self.div_items = self._scrape_css_selector(
-            '#main-content .results_results__container__tcF4_',
+            'div.results_results__container__tcF4_',
             as_string=False,
             found_many='first',
         )
 
-    def url_all_items(self):
+    def extract_cards(self):
         """
-        Return a list of CarIte instances found on the pagination page.
+        Extract every car card of the page, from the embedded state if enabled and
+        present, otherwise in a single pass over the results container. The result
+        is computed once per page and reused by the *_all_items views.
 
-        :return: list of CarItem instances
+        :return: list of KavakCard instances, in page order.
         """
+        if self._cards is not None:
+            return self._cards
 
-        dict_all_items = {}
-        for item in self.div_items.children:
-            if 'Vende tu auto' in item.text:
-                continue
-            url = item.a.attrs['href']
-            id = item.a.attrs['data-testid'].split('-')[-1]
-            dict_all_items[id] = url
-        return dict_all_items
+        if self.embedded_state_enabled():
+            cards = self._embedded_cards()
+            if cards:
+                self._cards = cards
+                return cards
 
-    def labels_all_items(self):
-        dict_all_items = {}
-        for item in self.div_items.children:
-            if 'Vende tu auto' in item.text:
-                continue
-            itme_id = item.a.attrs['data-testid'].split('-')[-1]
-            div_labels = item.img.find_next_sibling('div')
-            if div_labels:
-                labels = div_labels.text
-            else:
-                labels = None
+        self._cards = self._dom_cards()
+        return self._cards
 
-            dict_all_items[itme_id] = labels
-        return dict_all_items
+    def total_pages(self):
+        """
+        Return the number of pages of results given by the embedded state, or None.
+        """
+        state = self.embedded_state()
+        for path in self.embedded_total_pages_paths:
+            total_pages = lookup_path(state, path) if state is not None else None
+            if total_pages:
+                return int(total_pages)
+        return None
 
-    def prices_all_items(self):
-        dict_all_items = {}
-        for item in self.div_items.children:
-            if 'Vende tu auto' in item.text: continue
-            item_id = item.a.attrs['data-testid'].split('-')[-1]
-            div_price = item.select_one('span.amount_uki-amount__large__price__2NvVx')
+    def last_linked_page(self):
+        """
+        Return the highest page number linked from the pagination of the page, or None.
+        """
+        numbers = []
+        for anchor in self.soup.select('a.results_results__pagination-nav__Qcftr'):
+            page = parse_qs(urlsplit(anchor.get('href', '')).query).get('page')
+            if page and page[0].isdigit():
+                numbers.append(int(page[0]))
+        return max(numbers) if numbers else None
 
-            if div_price:
-                dict_all_items[item_id] = div_price.text.strip().replace(',', '')
-            else:
-                dict_all_items[item_id] = None
-        return dict_all_items
+    def _embedded_cards(self):
+        """
+        Build the cards of the page from the embedded state. Fields missing from
+        the JSON are taken from the cards extracted from the DOM.
 
-    def cities_all_items(self):
-        dict_all_items = {}
-        for item in self.div_items.children:
-            if 'Vende tu auto' in item.text:
-                continue
-            item_id = item.a.attrs['data-testid'].split('-')[-1]
-            div_city = item.select_one('span.card-product_cardProduct__footerInfo__HrxVa')
-            if div_city:
-                dict_all_items[item_id] = div_city.text.strip().capitalize()
-            else:
-                dict_all_items[item_id] = None
-        return dict_all_items
+        :return: list of KavakCard instances, or None if the state has no cards.
+        """
+        state = self.embedded_state()
+        items = None
+        for path in self.embedded_cards_paths:
+            items = lookup_path(state, path) if state is not None else None
+            if items:
+                break
+        if not items:
+            return None
 
-    def odometer_all_items(self):
-        dict_all_items = {}
+        cards = []
+        for item in items:
+            values = {}
+            for field, paths in self.embedded_card_fields.items():
+                values[field] = None
+                for path in ((paths,) if isinstance(paths, str) else paths):
+                    value = lookup_path(item, path)
+                    if value is not None:
+                        values[field] = value
+                        break
+            if values['id'] is None:
+                return None
+            labels = values['labels']
+            if isinstance(labels, list):
+                labels = tuple(label.get('text', '') if isinstance(label, dict) else str(label) for label in labels)
+            elif labels is not None:
+                labels = (str(labels),) if labels else ()
+            cards.append(KavakCard(
+                id=str(values['id']),
+                url=values['url'],
+                labels=labels,
+                price=str(values['price']).replace(',', '') if values['price'] is not None else None,
+                city=str(values['city']).strip().capitalize() if values['city'] is not None else None,
+                odometer=str(values['odometer']) if values['odometer'] is not None else None,
+            ))
+
+        fields = ('url', 'labels', 'price', 'city', 'odometer')
+        if any(getattr(card, field) is None for card in cards for field in fields):
+            dom_cards = {card.id: card for card in self._dom_cards()}
+            for card in cards:
+                dom_card = dom_cards.get(card.id)
+                if dom_card is None:
+                    continue
+                for field in fields:
+                    if getattr(card, field) is None:
+                        setattr(card, field, getattr(dom_card, field))
+        return cards
+
+    def _dom_cards(self):
+        """
+        Build the cards of the page from the results container of the DOM.
+
+        :return: list of KavakCard instances.
+        """
+        cards = []
+        if self.div_items is None:
+            return cards
         for item in self.div_items.children:
-            if 'Vende tu auto' in item.text:
+            if item.name is None or 'Vende tu auto' in item.get_text():
                 continue
-            item_id = item.a.attrs['data-testid'].split('-')[-1]
+            anchor = item.a
+            div_labels = item.img.find_next_sibling('div')
+            div_price = item.select_one('span.amount_uki-amount__large__price__2NvVx')
+            div_city = item.select_one('span.card-product_cardProduct__footerInfo__HrxVa')
             div_odometer = item.select_one('p.card-product_cardProduct__subtitle__hbN2a')
+            odometer = None
             if div_odometer:
                 odometer = re.findall(regex_odometer, div_odometer.text.replace(',', ''))
-                if odometer:
-                    dict_all_items[item_id] = odometer[0].strip()
-                else:
-                    dict_all_items[item_id] = None
-            else:
-                dict_all_items[item_id] = None
-        return dict_all_items
+                odometer = odometer[0].strip() if odometer else None
 
+            cards.append(KavakCard(
+                id=anchor.attrs['data-testid'].split('-')[-1],
+                url=anchor.attrs['href'],
+                labels=tuple(div_labels.stripped_strings) if div_labels else None,
+                price=div_price.text.strip().replace(',', '') if div_price else None,
+                city=div_city.text.strip().capitalize() if div_city else None,
+                odometer=odometer,
+            ))
+        return cards
 
+    def url_all_items(self):
+        """
+        Return a dictionary with the url of every item on the pagination page.
+
+        :return: dictionary {item id: url}
+        """
+        return {card.id: card.url for card in self.extract_cards()}
+
+    def labels_all_items(self):
+        return {card.id: card.labels for card in self.extract_cards()}
+
+    def prices_all_items(self):
+        return {card.id: card.price for card in self.extract_cards()}
+
+    def cities_all_items(self):
+        return {card.id: card.city for card in self.extract_cards()}
+
+    def odometer_all_items(self):
+        return {card.id: card.odometer for card in self.extract_cards()}
 
     def __str__(self):
         return self.url
@@ -1,19 +1,41 @@
+import asyncio
+import sys
 import time
-import random
+from dataclasses import asdict
 from webpage_parsers import KavakItem
-from kavak_webpage import KavakPageIterator
+from kavak_webpage import KavakPageIterator, ParallelKavakPageIterator, AsyncKavakPageIterator, KavakCard
+from async_scraping import AsyncCrawler
+from http_client import client
+from rate_limit import rate_limiters
+from pipeline import Pipeline, Stage
+from parser_pool import ParserPool
+from work_queue import WorkQueue, default_worker_id
+import configurations
 import ORM
-from database import Database
+from database import db
 
 
-kavak_sleep_time = 5
+kavak_base_url = 'https://www.kavak.com/mx/seminuevos'
+kavak_website = 'kavak'
 
 
 class Main:
+    # Fields of a detail page read by `parse_new_record`: the ones `parse_new_item`
+    # extracts through the from_parser of every ORM class
+    record_fields = list(dict.fromkeys(
+        ORM.Version.table_columns + ORM.Car.table_columns + ORM.VersionDetails.table_columns
+    ))
+
     def __init__(self):
-        self.DB = Database(use_postgres=True)
-        self.PageIterator = KavakPageIterator('https://www.kavak.com/mx/seminuevos')
+        self.DB = db.get()
+        if configurations.AUTO_MIGRATE:
+            self.DB.migrate()
+        if configurations.PARALLEL_DISCOVERY:
+            self.PageIterator = ParallelKavakPageIterator(kavak_base_url)
+        else:
+            self.PageIterator = KavakPageIterator(kavak_base_url)
         self.identifier_items_scraped = []
+        self.writer = ORM.BatchWriter()
 
     def parse_new_item(self, item_parser):
         car_version = ORM.Version.from_parser(item_parser)
@@ -22,55 +44,295 @@ class Main:
 
         return car, car_version, version_details
 
-    def parse_existing_item(self, db_item):
-        car_version = ORM.Version.from_db(db_item['version_id'])
-        car = ORM.Car.from_db(db_item['car_id'], version_object=car_version)
-        version_details = ORM.VersionDetails.from_db(db_item['version_id'], version_object=car_version)
+    def parse_new_record(self, record):
+        """
+        Same as `parse_new_item`, from the field dict of an item parsed in a
+        ParserPool (which must hold every field of `record_fields`).
+        """
+        car_version = ORM.Version.from_record(record)
+        car = ORM.Car.from_record(record, version_object=car_version)
+        version_details = ORM.VersionDetails.from_record(record, version_object=car_version)
+
         return car, car_version, version_details
 
     def dump_item_objects(self, objects):
-        for object in objects:
-            object.dump()
+        self.writer.add(*[object for object in objects if object is not None])
+
+    def dump_page_item(self, scrape, card, objects):
+        """
+        Write the objects of an item found on a listing page, together with its
+        scrape history and car info rows.
+
+        :param scrape: ORM.Scrape instance of the running scrape.
+        :param card: kavak_webpage.KavakCard of the item on the listing page.
+        :param objects: (car, car_version, version_details) tuple of the item.
+        """
+        car, car_version, version_details = objects
+        scrape_history = ORM.ScrapeHistory.record(
+            car_object=car, scrape_object=scrape, labels=card.labels or (),
+            price=int(card.price) if card.price else None)
+        car_info = ORM.CarInfo(car, city=card.city, odometer=card.odometer)
+        self.dump_item_objects(
+            [car_version, car, version_details, scrape_history, car_info]
+        )
+
+        self.identifier_items_scraped.append(card.id)
+
+    def flush(self, scrape):
+        """
+        Write the pending objects, then the cars seen in the scrape so far.
+        """
+        self.writer.flush()
+        scrape.dump_presence()
 
     def run(self):
         with (ORM.Scrape() as scrape):
             for i, page in enumerate(self.PageIterator):
-                page_urls = page.url_all_items()
-                page_labels = page.labels_all_items()
-                page_prices = page.prices_all_items()
-                page_cities = page.cities_all_items()
-                page_odometers = page.odometer_all_items()
+                page_cards = page.extract_cards()
 
-                estimated_time = kavak_sleep_time * len(page_urls)
-                print(f'f[{i}] Scraping data for {len(page_urls)} items ({estimated_time:.0f} s est).')
+                estimated_time = len(page_cards) / rate_limiters.for_url(kavak_base_url).rate
+                print(f'f[{i}] Scraping data for {len(page_cards)} items ({estimated_time:.0f} s est).')
 
-                for id, url in page_urls.items():
-                    if id in self.identifier_items_scraped:
+                known_items = ORM.resolve_known_cars([card.id for card in page_cards], kavak_website)
+                for card in page_cards:
+                    if card.id in self.identifier_items_scraped:
                         continue
 
-                    db_item = self.DB.get_item_match('cars', {'identifier': id})
-                    if not db_item:
-                        item_parser = KavakItem(url + f'?id={id}')
-                        car, car_version, version_details = self.parse_new_item(item_parser)
-                        time.sleep(kavak_sleep_time)
+                    if card.id not in known_items:
+                        item_parser = KavakItem(card.url + f'?id={card.id}')
+                        objects = self.parse_new_item(item_parser)
                     else:
-                        car, car_version, version_details = self.parse_existing_item(db_item)
-                    scrape_history = ORM.ScrapeHistory(
-                        car_object=car, scrape_object=scrape, labels=page_labels[id] or '',
-                        price=int(page_prices[id]) if page_prices[id] else None)
-                    car_info = ORM.CarInfo(car, city=page_cities[id], odometer=page_odometers[id])
-                    self.dump_item_objects(
-                        [car_version, car, version_details, scrape_history, car_info]
-                    )
+                        objects = known_items[card.id]
+                    self.dump_page_item(scrape, card, objects)
+                self.flush(scrape)
 
-                    self.identifier_items_scraped.append(id)
+    async def run_async(self, crawler=None):
+        """
+        Same as `run`, but the detail pages of the new items of every listing page
+        are fetched concurrently, within the per-host limits of the crawler, instead
+        of one at a time, while the next listing page is fetched. The database work
+        runs in worker threads (see Database.run_async), one call at a time, so it
+        never blocks the event loop nor uses the database concurrently.
+        """
+        crawler = crawler or AsyncCrawler()
+        with (ORM.Scrape() as scrape):
+            pages = aiter(AsyncKavakPageIterator(kavak_base_url, crawler=crawler))
+            next_page = asyncio.ensure_future(anext(pages, None))
+            try:
+                i = 0
+                while (page := await next_page) is not None:
+                    next_page = asyncio.ensure_future(anext(pages, None))
+                    page_cards = {card.id: card for card in page.extract_cards()}
+                    print(f'f[{i}] Scraping data for {len(page_cards)} items.')
+                    i += 1
+
+                    new_urls = await db.run_async(self.dump_known_items, scrape, page_cards)
+                    async for id, item_parser in crawler.fetch_many(KavakItem, new_urls):
+                        await db.run_async(self.dump_new_item, scrape, page_cards[id], item_parser)
+                    await db.run_async(self.flush, scrape)
+            finally:
+                next_page.cancel()
+
+    def dump_known_items(self, scrape, page_cards):
+        """
+        Write the items of a listing page already in the database.
 
+        :param page_cards: dictionary {item id: KavakCard} of the page.
+        :return: dictionary {item id: detail page url} of the new items.
+        """
+        new_urls = {}
+        known_items = ORM.resolve_known_cars(list(page_cards), kavak_website)
+        for card in page_cards.values():
+            if card.id in self.identifier_items_scraped:
+                continue
 
+            if card.id not in known_items:
+                new_urls[card.id] = card.url + f'?id={card.id}'
+            else:
+                self.dump_page_item(scrape, card, known_items[card.id])
+        self.flush(scrape)
+        return new_urls
 
+    def dump_new_item(self, scrape, card, item_parser):
+        self.dump_page_item(scrape, card, self.parse_new_item(item_parser))
 
+    def run_pipeline(self, workers=None, queue_size=None, report_interval=None, parse_processes=None):
+        """
+        Same as `run`, as a pipeline of stages running concurrently, connected by
+        bounded queues: listing pages are discovered while detail pages are fetched,
+        parsed and written.
+            - discover: cards of every listing page, with the objects of known cars.
+            - fetch: detail page of every new car.
+            - parse: detail page parsing and field extraction (in threads, or in a
+              pool of processes).
+            - persist: ORM objects of the new cars, and writes (single thread).
 
+        :param workers: worker threads by stage, overriding configurations.PIPELINE_WORKERS.
+        :param queue_size: queue size before every stage (configurations.PIPELINE_QUEUE_SIZE).
+        :param report_interval: seconds between queue reports (configurations.PIPELINE_REPORT_INTERVAL).
+        :param parse_processes: if > 0, pages are parsed by a ParserPool of that many
+                                processes instead of by the parse threads
+                                (configurations.PARSE_PROCESSES).
+        """
+        workers = {**configurations.PIPELINE_WORKERS, **(workers or {})}
+        queue_size = queue_size or configurations.PIPELINE_QUEUE_SIZE
+        if report_interval is None:
+            report_interval = configurations.PIPELINE_REPORT_INTERVAL
+        if parse_processes is None:
+            parse_processes = configurations.PARSE_PROCESSES
+
+        parser_pool = None
+        if parse_processes:
+            parser_pool = ParserPool(KavakItem, processes=parse_processes, fields=self.record_fields)
+            # Parse threads only wait for the processes, one per process keeps them busy
+            workers['parse'] = max(workers['parse'], parser_pool.processes)
+
+        with (ORM.Scrape() as scrape):
+            def discover(page):
+                page_cards = page.extract_cards()
+                known_items = ORM.resolve_known_cars([card.id for card in page_cards], kavak_website)
+                for card in page_cards:
+                    yield card, known_items.get(card.id)
 
+            def fetch(item):
+                card, objects = item
+                if objects is not None:
+                    return card, objects, None
+                response = client.get_page(card.url + f'?id={card.id}')
+                return card, None, response
+
+            def parse(item):
+                card, objects, response = item
+                if objects is not None:
+                    return card, objects
+                if parser_pool is not None:
+                    return card, parser_pool.parse(response.url, response.content)
+                item_parser = KavakItem(response.url, response=response)
+                item_parser.extract_record()
+                return card, item_parser
+
+            def persist(item):
+                card, objects = item
+                if card.id in self.identifier_items_scraped:
+                    return
+                if isinstance(objects, KavakItem):
+                    objects = self.parse_new_item(objects)
+                elif isinstance(objects, dict):
+                    objects = self.parse_new_record(objects)
+                self.dump_page_item(scrape, card, objects)
+                if len(self.identifier_items_scraped) % self.writer.batch_size == 0:
+                    self.flush(scrape)
+
+            pipeline = Pipeline(
+                source=self.PageIterator,
+                stages=[
+                    Stage('discover', discover, workers['discover'], queue_size),
+                    Stage('fetch', fetch, workers['fetch'], queue_size),
+                    Stage('parse', parse, workers['parse'], queue_size),
+                    Stage('persist', persist, 1, queue_size),
+                ],
+                worker_context=db.connection_scope,
+                report_interval=report_interval,
+            )
+            try:
+                pipeline.run()
+            finally:
+                if parser_pool is not None:
+                    parser_pool.close()
+            self.flush(scrape)
+            for stats in pipeline.stats():
+                print(stats)
+            print(client.metrics())
+
+    def enqueue_scrape(self, queue=None, wait=True):
+        """
+        Start a distributed scrape: discover the listing pages, write the cars
+        already known, and queue the detail pages of the new ones, to be processed
+        by `work` processes (on this or other machines). The workers of the scrape
+        keep waiting for items until every listing page was queued.
+
+        :param queue: WorkQueue of the scrape.
+        :param wait: keep the scrape open until every queued item is processed.
+        """
+        queue = queue or WorkQueue(db)
+        with (ORM.Scrape() as scrape):
+            print(f'Scrape {scrape.scrape_id}: queueing the new items')
+            queue.open(scrape.scrape_id)
+            try:
+                for i, page in enumerate(self.PageIterator):
+                    page_cards = page.extract_cards()
+                    known_items = ORM.resolve_known_cars([card.id for card in page_cards], kavak_website)
+                    known_cards = []
+                    new_items = []
+                    for card in page_cards:
+                        if card.id in self.identifier_items_scraped:
+                            continue
+                        if card.id in known_items:
+                            known_cards.append(card)
+                        else:
+                            new_items.append((card.id, card.url + f'?id={card.id}', asdict(card)))
+                            self.identifier_items_scraped.append(card.id)
+                    with db.transaction():
+                        for card in known_cards:
+                            self.dump_page_item(scrape, card, known_items[card.id])
+                        self.flush(scrape)
+                        queue.enqueue(scrape.scrape_id, kavak_website, new_items)
+                    print(f'[{i}] {len(page_cards)} items, {len(new_items)} queued.')
+            finally:
+                queue.close(scrape.scrape_id)
+            if wait:
+                queue.wait(scrape.scrape_id)
+
+    def work(self, queue=None, scrape_id=None, worker=None, batch_size=None):
+        """
+        Process the items queued for a scrape (see `enqueue_scrape`) until every
+        item was queued and none is left: claim a batch, fetch and parse the detail
+        page of every item, and write its objects and mark the batch as done in a
+        single transaction. Several workers can work the same scrape concurrently.
+
+        :param scrape_id: scrape to work on, by default the last one still being
+                          queued or with items left (waiting for one to start).
+        :param worker: id of the worker, its host and process id by default.
+        :param batch_size: items claimed at once (configurations.WORK_QUEUE_BATCH_SIZE).
+        """
+        queue = queue or WorkQueue(db)
+        if scrape_id is None:
+            scrape_id = queue.active_scrape()
+            if scrape_id is None:
+                print('Waiting for a scrape to be queued')
+            while scrape_id is None:
+                time.sleep(queue.poll_interval)
+                scrape_id = queue.active_scrape()
+        worker = worker or default_worker_id()
+        batch_size = batch_size or configurations.WORK_QUEUE_BATCH_SIZE
+
+        scrape = ORM.Scrape.attach(scrape_id)
+        with queue.heartbeats(scrape_id, worker):
+            while True:
+                items = queue.claim(scrape_id, worker, batch_size)
+                if not items:
+                    if queue.finished(scrape_id):
+                        break
+                    time.sleep(queue.poll_interval)
+                    continue
+
+                parsed = []
+                for item in items:
+                    card = KavakCard(**item['card'])
+                    card.labels = tuple(card.labels) if card.labels is not None else None
+                    try:
+                        objects = self.parse_new_item(KavakItem(item['url']))
+                    except Exception as error:
+                        queue.fail(scrape_id, kavak_website, item['identifier'], worker, error)
+                        continue
+                    parsed.append((card, objects))
+                with db.transaction():
+                    for card, objects in parsed:
+                        self.dump_page_item(scrape, card, objects)
+                    self.flush(scrape)
+                    queue.complete(scrape_id, kavak_website, [card.id for card, _ in parsed], worker)
+                print(f'[{worker}] {len(parsed)}/{len(items)} items done, {queue.remaining(scrape_id)} left.')
 
 if __name__ == '__main__':
-    main = Main()
-    main.run()
\ No newline at end of file
+    import cli
+    cli.main(['scrape', *sys.argv[1:]])
\ No newline at end of file
@@ -0,0 +1,473 @@
+"""
+Versioned schema migrations. Every migration runs once per database, in version
+order, and is recorded in the `schema_migrations` table. The scraping entry
+points apply the pending migrations when they start (configurations.AUTO_MIGRATE),
+so a new database is created by running all of them and an existing one only
+runs the ones added since its last start. Every migration runs in its own
+transaction, DDL included, and its steps can be run again on a database left
+half-migrated by an older version of the migration.
+
+On PostgreSQL `scrape_history` is range-partitioned by month on `scrape_date`.
+Partitions are created ahead of every scrape (`ensure_history_partitions`), and
+old ones are archived and dropped by `retire_history`.
+"""
+import csv
+import datetime
+import gzip
+import os
+import sqlite3
+from contextlib import contextmanager
+import configurations
+
+# Key of the PostgreSQL advisory lock held while migrating
+MIGRATION_LOCK_KEY = 727001
+
+
+class Migration:
+    """
+    A schema change: `apply(database)` runs its statements inside a transaction.
+    If an optional migration fails, it is skipped (and retried on the next start)
+    instead of stopping the migrations that follow it.
+    """
+
+    def __init__(self, version, name, apply, optional=False):
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.optional = optional
+
+
+def table_exists(database, table):
+    if database.use_postgres:
+        database.cursor.execute('SELECT to_regclass(%s)', [table])
+        return database.cursor.fetchone()[0] is not None
+    database.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", [table])
+    return database.cursor.fetchone() is not None
+
+
+def column_exists(database, table, column):
+    if database.use_postgres:
+        database.cursor.execute(
+            'SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s',
+            [table, column]
+        )
+        return database.cursor.fetchone() is not None
+    database.cursor.execute(f'PRAGMA table_info({table})')
+    return any(row[1] == column for row in database.cursor.fetchall())
+
+
+def _execute(database, *statements):
+    for statement in statements:
+        database.query(statement, [])
+
+
+def _baseline(database):
+    """
+    Schema of `database_squema.sql`. Databases created before the migrations
+    already have it, so it is only recorded as applied.
+    """
+    if not table_exists(database, 'versions'):
+        database._create_schema()
+
+
+def _partition_history(database):
+    """
+    Add the `scrape_date` of every row to scrape_history, and on PostgreSQL rebuild
+    the table partitioned by month on it. The conflict target of the history rows
+    becomes (scrape_date, scrape_id, car_id), since the unique keys of a
+    partitioned table must include its partition key.
+    """
+    if not database.use_postgres:
+        if not column_exists(database, 'scrape_history', 'scrape_date'):
+            _execute(database, 'ALTER TABLE scrape_history ADD COLUMN scrape_date DATE')
+        _execute(
+            database,
+            'UPDATE scrape_history SET scrape_date = '
+            '(SELECT date(datetime_start) FROM scrapes s WHERE s.scrape_id = scrape_history.scrape_id)',
+            'CREATE UNIQUE INDEX IF NOT EXISTS history_date_key ON scrape_history (scrape_date, scrape_id, car_id)',
+        )
+        return
+
+    _execute(
+        database,
+        'ALTER TABLE scrape_history RENAME TO scrape_history_unpartitioned',
+        'ALTER TABLE scrape_history_unpartitioned RENAME CONSTRAINT history_pkey TO history_unpartitioned_pkey',
+        'CREATE TABLE scrape_history ('
+        ' scrape_id INT REFERENCES scrapes (scrape_id),'
+        ' car_id INT REFERENCES cars (car_id),'
+        ' labels TEXT,'
+        ' price INT,'
+        ' scrape_date DATE NOT NULL,'
+        ' CONSTRAINT history_pkey PRIMARY KEY (scrape_date, scrape_id, car_id)'
+        ') PARTITION BY RANGE (scrape_date)',
+        'CREATE TABLE scrape_history_default PARTITION OF scrape_history DEFAULT',
+    )
+    database.cursor.execute("SELECT DISTINCT date_trunc('month', datetime_start)::date FROM scrapes")
+    for (month,) in database.cursor.fetchall():
+        ensure_history_partition(database, month)
+    _execute(
+        database,
+        'INSERT INTO scrape_history (scrape_id, car_id, labels, price, scrape_date) '
+        'SELECT h.scrape_id, h.car_id, h.labels, h.price, s.datetime_start::date '
+        'FROM scrape_history_unpartitioned h JOIN scrapes s ON s.scrape_id = h.scrape_id',
+        'DROP TABLE scrape_history_unpartitioned',
+    )
+
+
+def _history_indexes(database):
+    """
+    Indexes for the price history of a car and for the cars of a version.
+    """
+    _execute(
+        database,
+        'CREATE INDEX IF NOT EXISTS scrape_history_car_id ON scrape_history (car_id, scrape_id)',
+        'CREATE INDEX IF NOT EXISTS cars_version_id ON cars (version_id)',
+    )
+
+
+def _versions_natural_key(database):
+    """
+    Unique index on the natural key of versions: it supports the lookups of
+    `Version._get_id` and is the conflict target of the version upserts. Fails
+    if the table already holds duplicated versions, or SQLite is older than 3.35.
+    """
+    from database import UPSERT_INDEXES
+
+    if not database.use_postgres and sqlite3.sqlite_version_info < (3, 35):
+        raise RuntimeError(f'SQLite {sqlite3.sqlite_version} does not support upserts')
+    _execute(database, UPSERT_INDEXES)
+
+
+def _scrape_presence(database):
+    """
+    Cars seen in every scrape, as ranges of consecutive car ids (delta history mode).
+    """
+    _execute(
+        database,
+        'CREATE TABLE IF NOT EXISTS scrape_presence ('
+        ' scrape_id INT REFERENCES scrapes (scrape_id),'
+        ' first_car_id INT NOT NULL,'
+        ' last_car_id INT NOT NULL,'
+        ' CONSTRAINT presence_pkey PRIMARY KEY (scrape_id, first_car_id))',
+        'CREATE INDEX IF NOT EXISTS scrape_presence_car_range ON scrape_presence (first_car_id, last_car_id)',
+    )
+
+
+def _dimension_tables(database):
+    """
+    Intern the labels of the history rows and the cities of the car info rows in
+    dimension tables with integer keys. A label set is stored once, keyed by the
+    sorted ids of its labels, with its labels in label_set_labels. The labels
+    already stored were joined card texts, so each becomes a single label.
+    """
+    if not database.use_postgres and sqlite3.sqlite_version_info < (3, 35):
+        raise RuntimeError(
+            f'SQLite {sqlite3.sqlite_version} does not support ALTER TABLE ... DROP COLUMN, '
+            'needed by the dimension_tables migration: upgrade to SQLite 3.35 or later'
+        )
+    _execute(
+        database,
+        'CREATE TABLE IF NOT EXISTS labels (label_id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS label_sets (label_set_id SERIAL PRIMARY KEY, label_key TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS label_set_labels ('
+        ' label_set_id INT REFERENCES label_sets (label_set_id),'
+        ' label_id INT REFERENCES labels (label_id),'
+        ' CONSTRAINT label_set_labels_pkey PRIMARY KEY (label_set_id, label_id))',
+        'CREATE INDEX IF NOT EXISTS label_set_labels_label_id ON label_set_labels (label_id)',
+        'CREATE TABLE IF NOT EXISTS cities (city_id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+    )
+
+    # The old text columns are dropped last, so their values are only moved once.
+    # Rows left by a previous run are skipped (WHERE TRUE lets SQLite parse the
+    # ON CONFLICT clause after a SELECT).
+    if column_exists(database, 'scrape_history', 'labels'):
+        _execute(
+            database,
+            'INSERT INTO labels (label_id, name) '
+            'SELECT ROW_NUMBER() OVER (ORDER BY labels), labels '
+            "FROM (SELECT DISTINCT labels FROM scrape_history WHERE labels IS NOT NULL AND labels <> '') l "
+            'WHERE TRUE ON CONFLICT DO NOTHING',
+            'INSERT INTO label_sets (label_set_id, label_key) SELECT label_id, CAST(label_id AS TEXT) FROM labels '
+            'WHERE TRUE ON CONFLICT DO NOTHING',
+            'INSERT INTO label_set_labels (label_set_id, label_id) SELECT label_id, label_id FROM labels '
+            'WHERE TRUE ON CONFLICT DO NOTHING',
+        )
+        if not column_exists(database, 'scrape_history', 'label_set_id'):
+            _execute(
+                database,
+                'ALTER TABLE scrape_history ADD COLUMN label_set_id INT REFERENCES label_sets (label_set_id)',
+            )
+        _execute(
+            database,
+            'UPDATE scrape_history SET label_set_id = '
+            '(SELECT label_id FROM labels WHERE name = scrape_history.labels)',
+            'ALTER TABLE scrape_history DROP COLUMN labels',
+        )
+
+    if column_exists(database, 'car_info', 'city'):
+        _execute(
+            database,
+            'INSERT INTO cities (city_id, name) '
+            'SELECT ROW_NUMBER() OVER (ORDER BY city), city '
+            'FROM (SELECT DISTINCT city FROM car_info WHERE city IS NOT NULL) c '
+            'WHERE TRUE ON CONFLICT DO NOTHING',
+        )
+        if not column_exists(database, 'car_info', 'city_id'):
+            _execute(database, 'ALTER TABLE car_info ADD COLUMN city_id INT REFERENCES cities (city_id)')
+        _execute(
+            database,
+            'UPDATE car_info SET city_id = (SELECT city_id FROM cities WHERE name = car_info.city)',
+            'ALTER TABLE car_info DROP COLUMN city',
+        )
+    _execute(database, 'CREATE INDEX IF NOT EXISTS car_info_city_id ON car_info (city_id)')
+
+
+def _crawl_queue(database):
+    """
+    Detail pages of every scrape to be processed by the crawl workers (see work_queue.py).
+    """
+    _execute(
+        database,
+        'CREATE TABLE IF NOT EXISTS crawl_queue ('
+        ' scrape_id INT REFERENCES scrapes (scrape_id),'
+        ' identifier TEXT NOT NULL,'
+        ' website TEXT NOT NULL,'
+        ' url TEXT NOT NULL,'
+        ' card TEXT,'
+        " status VARCHAR(10) NOT NULL DEFAULT 'pending',"
+        ' attempts INT NOT NULL DEFAULT 0,'
+        ' worker TEXT,'
+        ' lease_until DOUBLE PRECISION,'
+        ' error TEXT,'
+        ' CONSTRAINT crawl_queue_pkey PRIMARY KEY (scrape_id, identifier, website))',
+        'CREATE INDEX IF NOT EXISTS crawl_queue_claimable ON crawl_queue (scrape_id, status, lease_until)',
+    )
+
+
+def _crawl_enqueues(database):
+    """
+    Enqueueing state of the scrapes worked through the crawl queue: workers keep
+    polling a scrape until its enqueuer marks it as done.
+    """
+    _execute(
+        database,
+        'CREATE TABLE IF NOT EXISTS crawl_enqueues ('
+        ' scrape_id INT PRIMARY KEY REFERENCES scrapes (scrape_id),'
+        ' enqueue_done BOOLEAN NOT NULL DEFAULT FALSE)',
+    )
+
+
+MIGRATIONS = [
+    Migration(1, 'baseline', _baseline),
+    Migration(2, 'partition_scrape_history', _partition_history),
+    Migration(3, 'history_indexes', _history_indexes),
+    Migration(4, 'versions_natural_key', _versions_natural_key, optional=True),
+    Migration(5, 'scrape_presence', _scrape_presence),
+    Migration(6, 'dimension_tables', _dimension_tables),
+    Migration(7, 'crawl_queue', _crawl_queue),
+    Migration(8, 'crawl_enqueues', _crawl_enqueues),
+]
+
+
+class Migrator:
+    """
+    Applies the pending MIGRATIONS of a database and keeps track of them.
+    """
+
+    def __init__(self, database, migrations=None):
+        self.database = database
+        self.migrations = sorted(migrations or MIGRATIONS, key=lambda migration: migration.version)
+
+    def applied(self):
+        """
+        Return the names of the applied migrations, by version.
+        """
+        if not table_exists(self.database, 'schema_migrations'):
+            return {}
+        rows = self.database.select('schema_migrations', ['version', 'name'])
+        return dict(rows)
+
+    def is_applied(self, name):
+        return name in self.applied().values()
+
+    def pending(self):
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def migrate(self, target=None):
+        """
+        Apply the pending migrations up to version `target` (all by default).
+        Processes starting at the same time apply every migration once: the
+        applied versions are read again inside the transaction of each migration,
+        once it holds the migration lock (see `_lock`).
+
+        :return: list of the names of the migrations applied.
+        """
+        done = []
+        with self._lock():
+            _execute(
+                self.database,
+                'CREATE TABLE IF NOT EXISTS schema_migrations ('
+                ' version INT PRIMARY KEY,'
+                ' name TEXT NOT NULL,'
+                ' applied_at TIMESTAMP NOT NULL)'
+            )
+            for migration in self.migrations:
+                if target is not None and migration.version > target:
+                    break
+                try:
+                    with self.database.transaction(immediate=True):
+                        if migration.version in self.applied():
+                            # Applied meanwhile by another process
+                            continue
+                        migration.apply(self.database)
+                        self.database.insert('schema_migrations', {
+                            'version': migration.version,
+                            'name': migration.name,
+                            'applied_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        })
+                except Exception as error:
+                    if not migration.optional:
+                        raise
+                    print(f'Migration {migration.version} ({migration.name}) skipped: {error}')
+                    continue
+                print(f'Migration {migration.version} ({migration.name}) applied')
+                done.append(migration.name)
+        return done
+
+    @contextmanager
+    def _lock(self):
+        """
+        Hold the migration lock of the database for a whole run: a session-level
+        advisory lock on PostgreSQL. On SQLite, the BEGIN IMMEDIATE of every
+        migration transaction takes the write lock instead, before the applied
+        versions are read.
+        """
+        if not self.database.use_postgres:
+            yield
+            return
+        connection = self.database.connection
+        self.database.cursor.execute('SELECT pg_advisory_lock(%s)', [MIGRATION_LOCK_KEY])
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.rollback()
+            self.database.cursor.execute('SELECT pg_advisory_unlock(%s)', [MIGRATION_LOCK_KEY])
+            connection.commit()
+
+
+def _month_start(day):
+    if isinstance(day, str):
+        day = datetime.date.fromisoformat(day[:10])
+    return day.replace(day=1)
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def history_partition_name(month):
+    return f'scrape_history_y{month.year}m{month.month:02d}'
+
+
+def ensure_history_partition(database, day):
+    """
+    Create the monthly partition of scrape_history holding `day`, if missing
+    (PostgreSQL only).
+    """
+    if not database.use_postgres:
+        return
+    month = _month_start(day)
+    _execute(
+        database,
+        f'CREATE TABLE IF NOT EXISTS {history_partition_name(month)} PARTITION OF scrape_history '
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_next_month(month).isoformat()}')"
+    )
+
+
+def ensure_history_partitions(database, day, months_ahead=1):
+    """
+    Create the partition of `day` and of the following `months_ahead` months, so
+    history rows never land in the default partition.
+    """
+    month = _month_start(day)
+    for _ in range(months_ahead + 1):
+        ensure_history_partition(database, month)
+        month = _next_month(month)
+
+
+def retire_history(database, before, archive=True, archive_dir=None, hooks=()):
+    """
+    Remove the scrape_history rows older than `before`. On PostgreSQL whole
+    monthly partitions are retired (those ending on or before `before`), on SQLite
+    the rows are deleted.
+
+    :param archive: whether to export the retired rows first, as gzipped CSV files
+                    in `archive_dir` (configurations.HISTORY_ARCHIVE_DIR by default).
+    :param hooks: callables `hook(name, archive_path)` run for every retired
+                  partition (or batch of rows, on SQLite) before it is removed;
+                  archive_path is None when not archiving.
+    :return: names of the retired partitions.
+
+    In delta history mode the retired rows may hold the last price of cars whose
+    price didn't change since, so `before` should precede the history still needed.
+    """
+    before = _month_start(before) if database.use_postgres else datetime.date.fromisoformat(str(before)[:10])
+    archive_dir = archive_dir or configurations.HISTORY_ARCHIVE_DIR
+    if archive:
+        os.makedirs(archive_dir, exist_ok=True)
+
+    if database.use_postgres:
+        database.cursor.execute(
+            'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+            "WHERE i.inhparent = 'scrape_history'::regclass ORDER BY c.relname"
+        )
+        retired = []
+        for (name,) in database.cursor.fetchall():
+            if name == 'scrape_history_default':
+                continue
+            month = datetime.date(int(name[-7:-3]), int(name[-2:]), 1)
+            if _next_month(month) > before:
+                continue
+            with database.transaction():
+                path = _archive_table(database, name, archive_dir) if archive else None
+                for hook in hooks:
+                    hook(name, path)
+                _execute(
+                    database,
+                    f'ALTER TABLE scrape_history DETACH PARTITION {name}',
+                    f'DROP TABLE {name}',
+                )
+            retired.append(name)
+        return retired
+
+    name = f'scrape_history_before_{before.isoformat()}'
+    with database.transaction():
+        path = None
+        if archive:
+            path = _archive_rows(database, name, archive_dir, before)
+        for hook in hooks:
+            hook(name, path)
+        database.query('DELETE FROM scrape_history WHERE scrape_date < ?', [before.isoformat()])
+    return [name]
+
+
+def _archive_table(database, table, archive_dir):
+    path = os.path.join(archive_dir, f'{table}.csv.gz')
+    with gzip.open(path, 'wt', newline='') as file:
+        database.cursor.copy_expert(f'COPY {table} TO STDOUT WITH (FORMAT csv, HEADER)', file)
+    return path
+
+
+def _archive_rows(database, name, archive_dir, before):
+    path = os.path.join(archive_dir, f'{name}.csv.gz')
+    column_names, rows = database.select(
+        'scrape_history', where_clause='scrape_date < ?', where_params=[before.isoformat()],
+        return_column_names=True
+    )
+    with gzip.open(path, 'wt', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(column_names)
+        writer.writerows(rows)
+    return path
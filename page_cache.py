@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+import configurations
+
+
+class CachedResponse:
+    """
+    Minimal stand-in for a requests.Response served from the PageCache.
+    """
+
+    def __init__(self, url, content, encoding=None, status_code=200):
+        self.url = url
+        self.content = content
+        self.encoding = encoding
+        self.headers = {}
+        self.status_code = status_code
+        self.from_cache = True
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class PageCache:
+    """
+    Persistent cache of raw HTML pages. Pages are stored gzip-compressed under the
+    SHA-256 of their content (identical pages are stored once), and an index entry
+    per url keeps the content hash together with the ETag and Last-Modified
+    validators used to revalidate the page once its TTL expires.
+
+    Layout:
+        <directory>/index/<sha256(url)>.json
+        <directory>/blobs/<hash[:2]>/<hash>.html.gz
+    """
+
+    def __init__(self, directory=None, ttl=None):
+        self.directory = directory or configurations.PAGE_CACHE_DIR
+        self.ttl = ttl or configurations.PAGE_CACHE_TTL
+
+    @staticmethod
+    def _hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def _index_path(self, url):
+        return os.path.join(self.directory, 'index', self._hash(url.encode()) + '.json')
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.directory, 'blobs', content_hash[:2], content_hash + '.html.gz')
+
+    @staticmethod
+    def _write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def lookup(self, url):
+        """
+        Return the index entry of `url`, or None if the page is not cached.
+        """
+        try:
+            with open(self._index_path(url), 'r') as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if not os.path.exists(self._blob_path(entry['content_hash'])):
+            return None
+        return entry
+
+    def is_fresh(self, entry, page_type):
+        """
+        Whether the cached page can be served without revalidation. Pages of an
+        unknown type are always revalidated.
+        """
+        ttl = self.ttl.get(page_type, 0)
+        return time.time() - entry['fetched_at'] < ttl
+
+    def response(self, entry):
+        """
+        Build a CachedResponse with the content of the cache entry, or return None
+        if its page was pruned meanwhile.
+        """
+        try:
+            with gzip.open(self._blob_path(entry['content_hash']), 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        return CachedResponse(entry['url'], content, encoding=entry.get('encoding'))
+
+    def validators(self, entry):
+        """
+        Conditional request headers to revalidate the cached page.
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, response, page_type=None):
+        """
+        Save the content and validators of a 200 response.
+
+        :return: the new index entry.
+        """
+        content_hash = self._hash(response.content)
+        blob_path = self._blob_path(content_hash)
+        try:
+            # A blob reused by the new entry must not look older than a running prune
+            os.utime(blob_path)
+        except FileNotFoundError:
+            self._write_atomic(blob_path, gzip.compress(response.content))
+
+        entry = {
+            'url': url,
+            'page_type': page_type,
+            'content_hash': content_hash,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'encoding': response.encoding,
+            'fetched_at': time.time(),
+        }
+        self._write_atomic(self._index_path(url), json.dumps(entry).encode())
+        return entry
+
+    def touch(self, entry):
+        """
+        Mark a cached page as fresh again after a 304 Not Modified response.
+        """
+        entry['fetched_at'] = time.time()
+        self._write_atomic(self._index_path(entry['url']), json.dumps(entry).encode())
+
+    def prune(self, max_age=None):
+        """
+        Delete the index entries older than `max_age` seconds (the largest TTL by
+        default) and every blob no longer referenced by an index entry. Other
+        processes may use the cache meanwhile: files written after the prune
+        started are kept, and files already removed are skipped.
+
+        :return: number of pages removed from the index.
+        """
+        max_age = max_age if max_age is not None else max(self.ttl.values())
+        index_dir = os.path.join(self.directory, 'index')
+        blobs_dir = os.path.join(self.directory, 'blobs')
+        if not os.path.isdir(index_dir):
+            return 0
+
+        removed = 0
+        referenced = set()
+        now = time.time()
+        for file_name in os.listdir(index_dir):
+            path = os.path.join(index_dir, file_name)
+            try:
+                with open(path, 'r') as file:
+                    entry = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                continue
+            if now - entry['fetched_at'] > max_age:
+                if self._remove_older(path, now):
+                    removed += 1
+            else:
+                referenced.add(entry['content_hash'])
+
+        for prefix in os.listdir(blobs_dir) if os.path.isdir(blobs_dir) else []:
+            try:
+                file_names = os.listdir(os.path.join(blobs_dir, prefix))
+            except FileNotFoundError:
+                continue
+            for file_name in file_names:
+                if file_name.split('.')[0] not in referenced:
+                    self._remove_older(os.path.join(blobs_dir, prefix, file_name), now)
+        return removed
+
+    @staticmethod
+    def _remove_older(path, start):
+        """
+        Delete the file at `path` unless it was written after `start` (a timestamp).
+
+        :return: whether the file was deleted.
+        """
+        try:
+            if os.path.getmtime(path) >= start:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
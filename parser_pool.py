@@ -0,0 +1,66 @@
+"""
+Parsing in a pool of worker processes: HTML parsing and field extraction are
+CPU-bound pure Python, so threads parsing pages are limited to one core by the
+GIL. The pages are sent as raw bytes to the worker processes, which return the
+extracted fields as plain dicts.
+
+Worker processes are started with forkserver (spawn where it isn't available),
+never forked from the scraper: they start lazily from its fetch threads, and
+forking a multi-threaded process holding database connections, pooled HTTP
+sockets and locks can deadlock the child or share those sockets with it.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def extract_page_record(scraper_cls, url, content, fields=None):
+    """
+    Parse a page and extract its fields (runs in the worker processes).
+
+    :param scraper_cls: Scraper subclass parsing the page.
+    :param url: url of the page.
+    :param content: raw bytes of the page.
+    :param fields: fields to extract, every field of the class by default.
+    :return: dictionary {field name: value}.
+    """
+    return scraper_cls(url, content=content).extract_record(fields)
+
+
+class ParserPool:
+    """
+    Pool of `processes` worker processes (one per core by default) parsing pages
+    of `scraper_cls` into field dicts.
+    """
+
+    def __init__(self, scraper_cls, processes=None, fields=None):
+        self.scraper_cls = scraper_cls
+        self.processes = processes or os.cpu_count()
+        self.fields = fields
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context(start_method)
+        )
+
+    def submit(self, url, content):
+        """
+        Queue a page to be parsed.
+
+        :return: concurrent.futures.Future of the field dict of the page.
+        """
+        return self._executor.submit(extract_page_record, self.scraper_cls, url, content, self.fields)
+
+    def parse(self, url, content):
+        """
+        Parse a page in a worker process, waiting for its field dict.
+        """
+        return self.submit(url, content).result()
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,187 @@
+"""
+Streaming pipeline: a source iterable feeds a chain of stages, each run by its
+own pool of worker threads and connected to the next one by a bounded queue.
+When a stage falls behind, the queue before it fills up and the stages upstream
+block (backpressure), so a slow stage never makes memory grow without bound.
+"""
+import contextlib
+import inspect
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    """
+    Raised in the worker threads when the pipeline is stopped after an error.
+    """
+
+
+class Stage:
+    """
+    A step of a Pipeline. Its `workers` threads call `func(item)` for every item of
+    its input queue (holding at most `queue_size` items), and put every value
+    yielded by `func` (or the value returned, unless None) in the next stage queue.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=100):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.busy_time = 0.0
+        self.max_depth = 0
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def outputs(self, item):
+        if inspect.isgeneratorfunction(self.func):
+            yield from self.func(item)
+            return
+        result = self.func(item)
+        if result is not None:
+            yield result
+
+    def stats(self):
+        """
+        Return the queue depth (current and maximum), processed items and busy time
+        (summed over its workers) of the stage.
+        """
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'queue_size': self.queue.maxsize,
+            'processed': self.processed,
+            'busy_time': round(self.busy_time, 3),
+        }
+
+
+class Pipeline:
+    """
+    Runs `source` through `stages`, in order. Every worker thread runs inside
+    `worker_context()` if given (e.g. `db.connection_scope`, to give back its
+    database connection when it ends). The first exception raised by a stage
+    stops the pipeline and is raised again by `run`.
+    """
+
+    def __init__(self, source, stages, worker_context=None, report_interval=None):
+        self.source = source
+        self.stages = stages
+        self.worker_context = worker_context or contextlib.nullcontext
+        self.report_interval = report_interval
+        self._stop = threading.Event()
+        self._error = None
+
+    def run(self):
+        """
+        Process every item of the source, returning once all the stages are done.
+        """
+        threads = [threading.Thread(target=self._feed, name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads += [
+                threading.Thread(target=self._work, args=(index,), name=f'pipeline-{stage.name}-{n}', daemon=True)
+                for n in range(stage.workers)
+            ]
+        for thread in threads:
+            thread.start()
+
+        finished = threading.Event()
+        if self.report_interval:
+            threading.Thread(target=self._report, args=(finished,), daemon=True).start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            finished.set()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def _feed(self):
+        try:
+            for item in self.source:
+                self._put(0, item)
+            self._finish(0)
+        except PipelineStopped:
+            pass
+        except BaseException as error:
+            self._fail(error)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        try:
+            with self.worker_context():
+                while True:
+                    item = self._get(stage)
+                    if item is _DONE:
+                        break
+                    start = time.perf_counter()
+                    for output in stage.outputs(item):
+                        self._put(index + 1, output)
+                    with stage._lock:
+                        stage.processed += 1
+                        stage.busy_time += time.perf_counter() - start
+        except PipelineStopped:
+            return
+        except BaseException as error:
+            self._fail(error)
+            return
+
+        with stage._lock:
+            stage._running -= 1
+            last_worker = stage._running == 0
+        if last_worker:
+            try:
+                self._finish(index + 1)
+            except PipelineStopped:
+                pass
+
+    def _finish(self, index):
+        """
+        Tell every worker of stage `index` that no more items are coming.
+        """
+        if index < len(self.stages):
+            for _ in range(self.stages[index].workers):
+                self._put(index, _DONE)
+
+    def _put(self, index, item):
+        if index >= len(self.stages):
+            return
+        stage = self.stages[index]
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped
+            try:
+                stage.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            stage.max_depth = max(stage.max_depth, stage.queue.qsize())
+            return
+
+    def _get(self, stage):
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped
+            try:
+                return stage.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _report(self, finished):
+        while not finished.wait(self.report_interval):
+            print(' | '.join(
+                f"{stats['stage']}: {stats['depth']}/{stats['queue_size']} queued, {stats['processed']} done"
+                for stats in self.stats()
+            ))
@@ -0,0 +1,138 @@
+import threading
+import time
+from urllib.parse import urlsplit
+import configurations
+
+
+class AdaptiveRateLimiter:
+    """
+    Thread-safe token bucket pacing the requests to a host, with a rate adapted
+    by AIMD: every fast successful response increases the rate by `increase`
+    requests per second (up to `max_rate`), and every sign of congestion (a
+    throttling status, a failed request or a latency above `latency_target`
+    seconds) multiplies it by `decrease` (down to `min_rate`), at most once per
+    `cooldown` seconds so a burst of errors counts once.
+    """
+
+    def __init__(self, initial_rate, min_rate, max_rate, burst=1, increase=0.1, decrease=0.5,
+                 latency_target=2.0, cooldown=1.0, throttle_statuses=(429, 503)):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.throttle_statuses = throttle_statuses
+        self.throttled = 0
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request can be sent to the host.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_response(self, status_code, latency):
+        """
+        Adapt the rate to a response: decrease it if the host throttled the request
+        or answered slower than `latency_target`, increase it otherwise.
+        """
+        if status_code in self.throttle_statuses:
+            with self._lock:
+                self.throttled += 1
+            self._slow_down()
+        elif latency > self.latency_target or status_code >= 500:
+            self._slow_down()
+        else:
+            with self._lock:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_error(self):
+        """
+        Adapt the rate to a request that failed (connection error or timeout).
+        """
+        self._slow_down()
+
+    def pause(self, seconds):
+        """
+        Send no request to the host for `seconds` (e.g. the Retry-After of a response).
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'rate': round(self.rate, 3),
+                'throttled': self.throttled,
+                'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 3),
+            }
+
+    def _slow_down(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._refill(now)
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class HostRateLimiters:
+    """
+    The AdaptiveRateLimiter of every host, shared by all the fetchers of the
+    process. Limiters are configured by `configurations.RATE_LIMIT`, overridden by
+    the entries of `configurations.HOST_LIMITS` for their host.
+    """
+
+    def __init__(self, settings=None, host_limits=None):
+        self.settings = settings if settings is not None else configurations.RATE_LIMIT
+        self.host_limits = host_limits if host_limits is not None else configurations.HOST_LIMITS
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url):
+        """
+        Return the limiter of the host of `url`.
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                overrides = self.host_limits.get(host, {})
+                settings = {key: overrides.get(key, value) for key, value in self.settings.items()}
+                self._limiters[host] = AdaptiveRateLimiter(**settings)
+            return self._limiters[host]
+
+    def metrics(self):
+        """
+        Return the current rate (requests per second), the throttled responses and
+        the pause left of every host.
+        """
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.metrics() for host, limiter in limiters.items()}
+
+
+rate_limiters = HostRateLimiters()
@@ -1,14 +1,105 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from abc import ABC, abstractmethod
+import json
 import re
-import requests
+import warnings
+from http_client import client
+import configurations
+
+
+_REGEX_METACHARACTERS = set('.^$*+?{}[]\\|()')
+
+
+def lookup_path(data, path):
+    """
+    Return the value at the dotted key path `path` ('a.b.0.c') of decoded JSON
+    data, or None if any key along the path is missing.
+    """
+    for key in path.split('.'):
+        if isinstance(data, dict):
+            data = data.get(key)
+        elif isinstance(data, list) and key.isdigit() and int(key) < len(data):
+            data = data[int(key)]
+        else:
+            return None
+        if data is None:
+            return None
+    return data
+
+
+class SubtreeStrainer(SoupStrainer):
+    """
+    SoupStrainer keeping the tags that match one of the (tag name, class) pairs of
+    the parsed subtrees. A None name or class matches any. The name and class
+    lists given to SoupStrainer only prefilter the tags, since they match every
+    combination of a name and a class.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = tuple(pairs)
+        names = {name for name, _ in self.pairs}
+        classes = {class_name for _, class_name in self.pairs}
+        super().__init__(
+            name=None if None in names else sorted(names),
+            class_=None if None in classes else sorted(classes),
+        )
+
+    def matches_pair(self, name, attrs):
+        classes = attrs.get('class') if attrs else None
+        if isinstance(classes, str):
+            classes = classes.split()
+        classes = set(classes or ())
+        return any(
+            (pair_name is None or pair_name == name) and (pair_class is None or pair_class in classes)
+            for pair_name, pair_class in self.pairs
+        )
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        # BeautifulSoup >= 4.13
+        return super().allow_tag_creation(nsprefix, name, attrs) and self.matches_pair(name, attrs)
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        # BeautifulSoup < 4.13
+        found = super().search_tag(markup_name, markup_attrs)
+        if found is None:
+            return None
+        if hasattr(markup_name, 'attrs'):
+            markup_name, markup_attrs = markup_name.name, markup_name.attrs
+        elif not isinstance(markup_attrs, dict):
+            markup_attrs = dict(markup_attrs)
+        return found if self.matches_pair(markup_name, markup_attrs) else None
 
 
 class Scraper:
     """
     A base web scraping class that provides utilities to extract HTML elements
     from a BeautifulSoup-parsed document created during initialization.
+
+    Fields declared with the `css_extract_text` and `re_extract_text` decorators are
+    registered on the class as FieldSpec objects, and compiled into an
+    ExtractionPlan on first use. Their values are memoized per instance.
     """
+    _field_specs = {}
+    _record_fields = []
+    _extraction_plan = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        specs = {}
+        record_fields = {}
+        for klass in reversed(cls.__mro__):
+            if klass is Scraper or not issubclass(klass, Scraper):
+                continue
+            for name, value in vars(klass).items():
+                if isinstance(value, FieldProperty):
+                    specs[name] = value.spec
+                else:
+                    specs.pop(name, None)
+                if isinstance(value, property):
+                    record_fields[name] = None
+        cls._field_specs = specs
+        cls._record_fields = list(record_fields)
+        cls._extraction_plan = None
 
     @staticmethod
     def css_extract_text(which='first', join_character='\n'):
@@ -32,26 +123,8 @@ class Scraper:
             raise ValueError('Invalid argument: "which" must be one of "first", "last", or "all".')
 
         def extract_content(func):
-            @property
-            def extract(self):
-                """
-                Extracts the text content based on the provided CSS selector and options.
-
-                Returns:
-                    str | list[str] | None: Extracted text(s) from the HTML content.
-                """
-                selector = func(self)
-                tags_selected = self.soup.select(selector)
-                if not tags_selected:
-                    return None
-                if which == 'first':
-                    return tags_selected[0].text
-                elif which == 'last':
-                    return tags_selected[-1].text
-                elif which == 'all':
-                    return join_character.join([tag.text for tag in tags_selected])
-
-            return extract
+            spec = FieldSpec(func.__name__, 'css', func, which=which, join_character=join_character)
+            return FieldProperty(spec)
 
         return extract_content
 
@@ -73,31 +146,12 @@ class Scraper:
         """
 
         def extract_content(func):
-            @property
-            def extract(self):
-                """
-                Extracts the desired content using the regex pattern provided by the decorated method.
-
-                Returns:
-                    str | list[str] | None: The extracted text(s) from the HTML content.
-                """
-                pattern = func(self)
-                if outer_tag is not None:
-                    html_text = self.soup.select(outer_tag)[0].text
-                else:
-                    html_text = self.soup.text
-
-                matches = re.findall(pattern, html_text, flags)
-
-                if not matches:
-                    return None
+            spec = FieldSpec(
+                func.__name__, 're', func, group=group, flags=flags, all_matches=all_matches,
+                outer_tag=outer_tag, join_character=join_character
+            )
+            return FieldProperty(spec)
 
-                if not all_matches:
-                    return matches[group - 1] if isinstance(matches[0], tuple) else matches[0]
-
-                return join_character.join(m[group - 1] if isinstance(m, tuple) else m for m in matches)
-
-            return extract
         return extract_content
 
     @staticmethod
@@ -130,32 +184,230 @@ class Scraper:
             def wrapped(self):
                 """
                 Property method that performs the regex match against the text of HTML elements
-                using BeautifulSoup's `find` or `select` method, depending on the `multiple` flag.
+                through the label index of the document, depending on the `multiple` flag.
                 """
-                # Compile the regex pattern returned by the decorated method
-                pattern = re.compile(method(self))
+                pattern = method(self)
 
                 if not multiple:
                     # Return the first matching tag element
-                    matched_tag = self.soup.find(tag_name, string=pattern)
-                    return matched_tag
+                    return self.find_labels(tag_name, pattern, multiple=False)
                 else:
                     # Return all matching tag elements
-                    matched_tags = self.soup.select(tag_name, string=pattern)
-                    return matched_tags
+                    return self.find_labels(tag_name, pattern, multiple=True)
 
             return wrapped
 
         return decorator
 
 
-    def __init__(self, url):
-        self.url = url
-        self.req = requests.get(url)
-        self.req_ok = (self.req.status_code == 200)
-        if self.req_ok:
-            self.soup = BeautifulSoup(self.req.content, 'html.parser')
+    # Page cache TTL policy applied to the pages of the class (see configurations.PAGE_CACHE_TTL)
+    page_type = 'detail'
+    # Parser used to build the soup: 'html.parser', 'lxml', 'html5lib' or 'selectolax'
+    # (configurations.PARSER_BACKEND if None)
+    parser_backend = None
+    # Subtrees of the page the class reads, as 'tag.class' CSS selectors. When
+    # `restrict_parsing` is True, only these subtrees are parsed into the soup.
+    parse_subtrees = ()
+    restrict_parsing = False
+    # Embedded application state: id of the <script> holding the JSON, and key paths
+    # ('a.b.0.c') of the fields it provides, tried in order. The state is only read
+    # if `use_embedded_state` (configurations.USE_EMBEDDED_STATE if None).
+    use_embedded_state = None
+    embedded_state_script_id = None
+    embedded_fields = {}
+
+    def __init__(self, url=None, response=None, content=None, soup=None, parser_backend=None, restrict_parsing=None):
+        """
+        The page is fetched from `url` unless it is given already fetched, as a
+        response, as the raw page bytes or as a parsed BeautifulSoup document.
+
+        :param url: url of the page.
+        :param response: response (requests.Response or CachedResponse) of the page.
+        :param content: raw bytes of the page.
+        :param soup: BeautifulSoup document of the page.
+        :param parser_backend: overrides the `parser_backend` of the class.
+        :param restrict_parsing: overrides the `restrict_parsing` of the class.
+        """
+        self._field_values = {}
+        self._outer_texts = {}
+        self._label_nodes = None
+        if parser_backend is not None:
+            self.parser_backend = parser_backend
+        if restrict_parsing is not None:
+            self.restrict_parsing = restrict_parsing
+        if response is None and content is None and soup is None:
+            response = client.get_page(url, page_type=self.page_type)
+        self.url = url or (response.url if response is not None else None)
+        self.req = response
+        self.req_ok = (response.status_code == 200) if response is not None else True
+        self.content = response.content if response is not None else content
+        self._embedded_state = None
+        self._embedded_state_parsed = False
+        if soup is not None:
+            self.soup = soup
+        elif self.req_ok:
+            self.soup = self.parse(self.content)
+
+    def parse(self, content):
+        """
+        Parse the raw bytes of a page into a BeautifulSoup document, with the parser
+        backend of the scraper. If parsing is restricted, only the `parse_subtrees`
+        are kept: BeautifulSoup's parsers skip the rest of the markup through a
+        SoupStrainer, while selectolax cuts the subtrees out of the page and only
+        those fragments are parsed by BeautifulSoup. Selectolax can't build the soup
+        itself, so without restricted parsing the page is parsed by 'html.parser'
+        (with a warning).
+        """
+        backend = self.parser_backend or configurations.PARSER_BACKEND
+        subtrees = self.parse_subtrees if self.restrict_parsing else ()
+        if backend == 'selectolax':
+            if subtrees:
+                content = ''.join(node.html for node in self.select_subtrees(content, subtrees))
+                subtrees = ()
+            else:
+                warnings.warn(
+                    f"{type(self).__name__} doesn't restrict parsing to subtrees, so its pages are "
+                    "parsed with 'html.parser' instead of selectolax", RuntimeWarning, stacklevel=2
+                )
+            backend = 'html.parser'
+
+        parse_only = None
+        if subtrees:
+            parse_only = self.subtree_strainer(subtrees)
+        return BeautifulSoup(content, backend, parse_only=parse_only)
+
+    @staticmethod
+    def select_subtrees(content, selectors):
+        """
+        Return the selectolax nodes of the subtrees matching `selectors`, in document
+        order. A node inside a subtree already selected (matched by the same or by
+        another selector) is skipped, so its markup is only kept once.
+        """
+        from selectolax.lexbor import LexborHTMLParser
+        tree = LexborHTMLParser(content)
+        selected = []
+        selected_ids = set()
+        # A selector group is matched in a single pass, in document order
+        for node in tree.css(', '.join(selectors)):
+            ancestor = node.parent
+            while ancestor is not None and ancestor.mem_id not in selected_ids:
+                ancestor = ancestor.parent
+            if ancestor is None:
+                selected.append(node)
+                selected_ids.add(node.mem_id)
+        return selected
+
+    @staticmethod
+    def subtree_strainer(selectors):
+        """
+        Return the SoupStrainer of the 'tag.class' selectors of the parsed subtrees:
+        it keeps the tags matching the tag name and the class of one of them.
+        """
+        pairs = []
+        for selector in selectors:
+            name, _, class_name = selector.strip().partition('.')
+            pairs.append((name or None, class_name or None))
+        return SubtreeStrainer(pairs)
+
+    @classmethod
+    def extraction_plan(cls, scraper):
+        """
+        Return the ExtractionPlan of the class, compiling it with `scraper` the
+        first time it is needed.
+        """
+        if cls._extraction_plan is None:
+            cls._extraction_plan = ExtractionPlan(cls._field_specs, scraper)
+        return cls._extraction_plan
+
+    def outer_text(self, outer_tag=None):
+        """
+        Return the text of the first tag matching the CSS selector `outer_tag`
+        (or of the whole document if None), computed once per document.
+        """
+        if outer_tag not in self._outer_texts:
+            if outer_tag is not None:
+                self._outer_texts[outer_tag] = self.soup.select(outer_tag)[0].text
+            else:
+                self._outer_texts[outer_tag] = self.soup.text
+        return self._outer_texts[outer_tag]
+
+    def extract_record(self, fields=None):
+        """
+        Extract several fields at once.
+
+        :param fields: names of the fields (or attributes) to extract. Defaults to
+                       every property declared by the scraper class.
+        :return: dictionary {field name: value}.
+        """
+        plan = self.extraction_plan(self)
+        use_embedded_state = self.embedded_state_enabled()
+        record = {}
+        for name in (fields if fields is not None else self._record_fields):
+            if use_embedded_state and name in self.embedded_fields:
+                value = self.embedded_value(name)
+                if value is not None:
+                    record[name] = value
+                    continue
+            if name in plan.fields:
+                record[name] = plan.value(self, name)
+            else:
+                record[name] = getattr(self, name)
+        return record
+
+    def embedded_state_enabled(self):
+        """
+        Whether fields are read from the embedded state of the page.
+        """
+        if self.use_embedded_state is None:
+            return configurations.USE_EMBEDDED_STATE
+        return self.use_embedded_state
+
+    def embedded_state(self):
+        """
+        Decode, once per document, the JSON application state embedded in the
+        <script id=`embedded_state_script_id`> tag of the page. The JSON is cut out
+        of the raw page when available, so it doesn't need to be in the soup.
+
+        :return: decoded JSON, or None if the page has no (valid) embedded state.
+        """
+        if self._embedded_state_parsed:
+            return self._embedded_state
+        self._embedded_state_parsed = True
+        if not self.embedded_state_script_id:
+            return None
 
+        raw_json = None
+        if self.content:
+            match = re.search(
+                rb'<script[^>]*id=["\']' + re.escape(self.embedded_state_script_id.encode()) + rb'["\'][^>]*>(.*?)</script>',
+                self.content, re.DOTALL
+            )
+            raw_json = match.group(1) if match else None
+        elif self.soup is not None:
+            script = self.soup.find('script', id=self.embedded_state_script_id)
+            raw_json = script.string if script else None
+
+        if raw_json:
+            try:
+                self._embedded_state = json.loads(raw_json)
+            except ValueError:
+                self._embedded_state = None
+        return self._embedded_state
+
+    def embedded_value(self, name):
+        """
+        Return the value of the field `name` from the embedded state: the value of
+        the first of its `embedded_fields` key paths present in the JSON.
+        """
+        state = self.embedded_state()
+        if state is None:
+            return None
+        paths = self.embedded_fields.get(name, ())
+        for path in ((paths,) if isinstance(paths, str) else paths):
+            value = lookup_path(state, path)
+            if value is not None:
+                return value
+        return None
 
     def _scrape_sibling(self, re_pattern, tag_type='p'):
         """
@@ -166,7 +418,7 @@ class Scraper:
         :param tag_type: type of the tag to find.
         :return: text of the sibling tag found, or None if not found.
         """
-        tag_element = self.soup.find(tag_type, string=re.compile(re_pattern))
+        tag_element = self.find_labels(tag_type, re_pattern)
         if not tag_element:
             return None
         sibling_element = tag_element.find_next_sibling() or tag_element.find_previous_sibling()
@@ -174,6 +426,57 @@ class Scraper:
             return sibling_element.text
         return None
 
+    def label_index(self):
+        """
+        Index of the document built on first use, in a single traversal: maps each tag
+        name to a dictionary {text: [(position, tag), ...]} of the tags with a single
+        string (the ones BeautifulSoup's `find(..., string=...)` can match), keyed by
+        that string as is. Texts are kept in the document order of their first tag,
+        and tags in document order.
+        """
+        if self._label_nodes is None:
+            index = {}
+            for position, tag in enumerate(self.soup.find_all(True)):
+                if tag.string is None:
+                    continue
+                index.setdefault(tag.name, {}).setdefault(str(tag.string), []).append((position, tag))
+            self._label_nodes = index
+        return self._label_nodes
+
+    def find_labels(self, tag_name, re_pattern, multiple=False):
+        """
+        Find the tags of type `tag_name` which text matches `re_pattern`, as
+        `soup.find(tag_name, string=re.compile(re_pattern))` does: the first match is
+        the first matching tag in document order, even when a later tag has the
+        pattern as its whole text. Patterns are matched against the distinct texts of
+        the tag type, in document order, and literal patterns (without regex
+        metacharacters) with a substring test instead of a regex.
+
+        :param tag_name: type of the tags to find.
+        :param re_pattern: regex pattern searched in the text of the tags, or
+                           callable taking the text of a tag.
+        :param multiple: if True, return every matching tag instead of the first one.
+        :return: first matching tag (or None), or list of matching tags.
+        """
+        texts = self.label_index().get(tag_name, {})
+        if callable(re_pattern):
+            search = re_pattern
+        elif _REGEX_METACHARACTERS.intersection(re_pattern):
+            search = re.compile(re_pattern).search
+        else:
+            def search(text):
+                return re_pattern in text
+
+        matches = []
+        for text, nodes in texts.items():
+            if search(text):
+                if not multiple:
+                    return nodes[0][1]
+                matches.extend(nodes)
+        if not multiple:
+            return None
+        return [tag for _, tag in sorted(matches, key=lambda node: node[0])]
+
     def __getattr__(self, attr):
         return None
 
@@ -211,6 +514,88 @@ class Scraper:
                     return all_tags
 
 
+class FieldSpec:
+    """
+    Declaration of a field extracted by a Scraper decorator: the decorated method
+    (which returns the CSS selector or regex pattern of the field), the kind of
+    extraction ('css' or 're') and the options given to the decorator.
+    """
+    __slots__ = ('name', 'kind', 'source', 'options')
+
+    def __init__(self, name, kind, source, **options):
+        self.name = name
+        self.kind = kind
+        self.source = source
+        self.options = options
+
+
+class FieldProperty(property):
+    """
+    Property returned by the Scraper extraction decorators. It keeps its FieldSpec,
+    so the class can register it, and reads the value through the extraction plan.
+    """
+
+    def __init__(self, spec):
+        def extract(scraper):
+            return type(scraper).extraction_plan(scraper).value(scraper, spec.name)
+
+        super().__init__(extract, doc=spec.source.__doc__)
+        self.spec = spec
+
+
+class ExtractionPlan:
+    """
+    The FieldSpecs of a Scraper class compiled once: CSS selectors are resolved and
+    regex patterns precompiled. The selectors and patterns returned by the decorated
+    methods must not depend on the instance.
+    """
+
+    def __init__(self, specs, scraper):
+        self.fields = {}
+        for name, spec in specs.items():
+            source = spec.source(scraper)
+            if spec.kind == 're':
+                source = re.compile(source, spec.options['flags'])
+            self.fields[name] = (spec, source)
+
+    def value(self, scraper, name):
+        """
+        Return the value of the field `name` for `scraper`, extracting it only
+        the first time it is requested.
+        """
+        values = scraper._field_values
+        if name not in values:
+            spec, compiled = self.fields[name]
+            if spec.kind == 're':
+                values[name] = self._extract_re(scraper, spec.options, compiled)
+            else:
+                values[name] = self._extract_css(scraper, spec.options, compiled)
+        return values[name]
+
+    @staticmethod
+    def _extract_css(scraper, options, selector):
+        tags_selected = scraper.soup.select(selector)
+        if not tags_selected:
+            return None
+        if options['which'] == 'first':
+            return tags_selected[0].text
+        elif options['which'] == 'last':
+            return tags_selected[-1].text
+        return options['join_character'].join([tag.text for tag in tags_selected])
+
+    @staticmethod
+    def _extract_re(scraper, options, pattern):
+        matches = pattern.findall(scraper.outer_text(options['outer_tag']))
+        if not matches:
+            return None
+
+        group = options['group']
+        if not options['all_matches']:
+            return matches[group - 1] if isinstance(matches[0], tuple) else matches[0]
+
+        return options['join_character'].join(m[group - 1] if isinstance(m, tuple) else m for m in matches)
+
+
 class PageIterator(ABC):
     """
     This abstract base class provides a foundation for scraping paginated lists of items from webpages.
@@ -235,6 +620,27 @@ class PageIterator(ABC):
         pass
 
 
+class AsyncPageIterator(ABC):
+    """
+    Asynchronous counterpart of PageIterator. Concrete subclasses implement the
+    async iteration protocol (through the __anext__ magic method), yielding a
+    PlatformPageScraper instance for each page of results.
+    """
+    def __aiter__(self):
+        self.next_iteration = 0
+        return self
+
+    @abstractmethod
+    async def __anext__(self):
+        """
+        All classes must implement this coroutine to iterate over the pages
+        of the current website, raising StopAsyncIteration after the last one.
+
+        :return: PlatformWebScraper instance
+        """
+        pass
+
+
 if __name__ == '__main__':
     pass
 
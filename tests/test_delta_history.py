@@ -0,0 +1,74 @@
+import pytest
+import configurations
+
+
+class FlushFailed(Exception):
+    pass
+
+
+@pytest.fixture
+def delta_orm(orm, monkeypatch):
+    monkeypatch.setattr(configurations, 'HISTORY_MODE', 'delta')
+    return orm
+
+
+@pytest.fixture
+def scrape(delta_orm):
+    scrape = delta_orm.Scrape()
+    scrape.__enter__()
+    return scrape
+
+
+@pytest.fixture
+def car(delta_orm):
+    version = delta_orm.Version('Nissan', 'Versa', 'Sense', 2021, 'Sedan', 1.6, 'Manual')
+    car = delta_orm.Car('451230', version, url='https://www.kavak.com/mx/usado/nissan-versa', image_url='a.jpg',
+                        website='kavak')
+    writer = delta_orm.BatchWriter()
+    writer.add(version, car)
+    writer.flush()
+    return car
+
+
+def write_history(orm, writer, scrape, car, price):
+    history = orm.ScrapeHistory.record(car_object=car, scrape_object=scrape, labels=('Precio bajo',), price=price)
+    if history is not None:
+        writer.add(history)
+    writer.flush()
+    return history
+
+
+def test_unchanged_observations_are_skipped(delta_orm, scrape, car):
+    writer = delta_orm.BatchWriter()
+
+    assert write_history(delta_orm, writer, scrape, car, 1000) is not None
+    assert write_history(delta_orm, writer, scrape, car, 1000) is None
+    assert write_history(delta_orm, writer, scrape, car, 900) is not None
+
+
+def test_observation_is_written_again_after_a_failed_flush(delta_orm, database, scrape, car, monkeypatch):
+    writer = delta_orm.BatchWriter()
+
+    def fail(*args, **kwargs):
+        raise FlushFailed
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, 'copy_rows', fail)
+        with pytest.raises(FlushFailed):
+            write_history(delta_orm, writer, scrape, car, 1000)
+
+    # The scrape goes on with a new writer, without the objects of the failed batch
+    assert write_history(delta_orm, delta_orm.BatchWriter(), scrape, car, 1000) is not None
+    assert database.select('scrape_history', ['car_id', 'price']) == [(car.car_id, 1000)]
+
+
+def test_observation_is_written_again_after_the_outer_transaction_rolls_back(delta_orm, database, scrape, car):
+    writer = delta_orm.BatchWriter()
+
+    with pytest.raises(FlushFailed):
+        with database.transaction():
+            write_history(delta_orm, writer, scrape, car, 1000)
+            raise FlushFailed
+
+    assert write_history(delta_orm, writer, scrape, car, 1000) is not None
+    assert database.select('scrape_history', ['car_id', 'price']) == [(car.car_id, 1000)]
@@ -0,0 +1,103 @@
+"""
+Reading of the embedded application state. The fixtures are made-up examples of
+the __NEXT_DATA__ JSON of a listing page and of a detail page, written from the
+key paths of KavakPageScraper and KavakItem: they are not captures of the site,
+so these paths are assumptions that no test can verify. What is tested is how
+the paths are read, and that the HTML extraction takes over where they miss.
+"""
+import json
+import pytest
+import configurations
+from kavak_webpage import KavakPageScraper, KavakCard
+from webpage_parsers import KavakItem
+
+
+@pytest.fixture
+def listing_page(embedded_page):
+    return KavakPageScraper('https://www.kavak.com/mx/seminuevos', content=embedded_page('example_listing_state.json'))
+
+
+@pytest.fixture
+def detail_page(embedded_page):
+    return KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=embedded_page('example_detail_state.json'))
+
+
+def test_listing_cards_from_embedded_state(listing_page, monkeypatch):
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', True)
+
+    assert listing_page.extract_cards() == [
+        KavakCard(
+            id='451230', url='https://www.kavak.com/mx/usado/nissan-versa-sense-sedan-2021',
+            labels=('Precio bajo', 'Llega hoy'), price='289999', city='Ciudad de méxico', odometer='35120',
+        ),
+        KavakCard(
+            id='451231', url='https://www.kavak.com/mx/usado/mazda-3-i_sport-hatchback-2020',
+            labels=('Garantía',), price='315000', city='Monterrey', odometer='48007',
+        ),
+    ]
+
+
+def test_listing_total_pages(listing_page):
+    assert listing_page.total_pages() == 12
+
+
+def test_embedded_state_disabled(listing_page, monkeypatch):
+    # The setting is read when the cards are extracted, not when the class is defined
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', False)
+
+    assert listing_page.extract_cards() == []
+
+
+def test_detail_fields_from_embedded_state(detail_page, monkeypatch):
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', True)
+
+    assert detail_page.extract_record(list(KavakItem.embedded_fields)) == {
+        'identifier': 451230,
+        'brand': 'Nissan',
+        'model': 'Versa',
+        'year_prod': 2021,
+        'version_name': 'Sense',
+        'price': 289999,
+        'original_price': 309999,
+        'body_style': 'Sedan',
+        'transmission_type': 'Manual',
+        'engine_displacement': 1.6,
+        'city': 'Ciudad de México',
+        'image_url': 'https://images.kavak.services/451230/front.jpg',
+    }
+
+
+def state_page(state, body=''):
+    return (
+        f'<html><head><script id="__NEXT_DATA__" type="application/json">{json.dumps(state)}</script></head>'
+        f'<body>{body}</body></html>'
+    ).encode()
+
+
+def test_alternative_paths_are_tried_in_order(monkeypatch):
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', True)
+    state = {'props': {'pageProps': {'car': {'id': 451230, 'images': [{'url': 'https://images.kavak.services/a.jpg'}]}}}}
+    page = KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=state_page(state))
+
+    assert page.embedded_value('identifier') == 451230
+    assert page.embedded_value('image_url') == 'https://images.kavak.services/a.jpg'
+    assert page.embedded_value('brand') is None
+
+
+def test_fields_missing_from_the_state_are_extracted_from_the_html(monkeypatch):
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', True)
+    # A state whose shape differs from the assumed one
+    state = {'props': {'pageProps': {'vehicle': {'stockId': 451230, 'originalPrice': 309999}}}}
+    body = '<span class="price_amount__dRxZ8">$309,999</span>'
+    page = KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=state_page(state, body))
+
+    assert page.extract_record(['original_price']) == {'original_price': '$309,999'}
+
+
+def test_page_without_state_is_extracted_from_the_html(monkeypatch):
+    monkeypatch.setattr(configurations, 'USE_EMBEDDED_STATE', True)
+    body = '<span class="price_amount__dRxZ8">$309,999</span>'
+    page = KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=f'<html><body>{body}</body></html>'.encode())
+
+    assert page.embedded_state() is None
+    assert page.extract_record(['original_price']) == {'original_price': '$309,999'}
@@ -0,0 +1,40 @@
+import re
+import pytest
+from webpage_parsers import KavakItem
+
+PAGE = b'''<html><body>
+<div><p>Stock ID del auto</p><p>451230-A</p></div>
+<div><p>Tipo de Carroceria</p><p>Sedan</p></div>
+<div><p>Stock ID</p><p>451230</p></div>
+<table><tr><td>Combustible</td><td>Gasolina</td></tr><tr><td>Quemacocos</td><td>X</td></tr></table>
+<p>Stock ID</p>
+</body></html>'''
+
+
+@pytest.fixture
+def page():
+    return KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=PAGE)
+
+
+@pytest.mark.parametrize('tag_name, pattern', [
+    ('p', 'Stock ID'),
+    ('p', 'Stock ID$'),
+    ('p', 'Carroceria'),
+    ('td', 'Combustible'),
+    ('td', 'Kilometraje'),
+    ('span', 'Stock ID'),
+])
+def test_first_label_is_the_one_soup_find_returns(page, tag_name, pattern):
+    assert page.find_labels(tag_name, pattern) is page.soup.find(tag_name, string=re.compile(pattern))
+
+
+def test_earlier_tag_containing_the_label_wins_over_a_later_exact_one(page):
+    assert page.find_labels('p', 'Stock ID').string == 'Stock ID del auto'
+    assert page._scrape_sibling('Stock ID') == '451230-A'
+
+
+@pytest.mark.parametrize('pattern', ['Stock ID', 'ID$', lambda text: text.startswith('451230')])
+def test_multiple_labels_are_in_document_order(page, pattern):
+    expected = page.soup.find_all('p', string=re.compile(pattern) if isinstance(pattern, str) else pattern)
+
+    assert list(map(id, page.find_labels('p', pattern, multiple=True))) == list(map(id, expected))
@@ -0,0 +1,23 @@
+import pytest
+
+
+def test_reserved_ids_are_unique(orm):
+    allocator = orm.IdAllocator(block_size=3)
+
+    ids = [allocator.next_id('scrapes', 'scrape_id') for _ in range(7)]
+
+    assert ids == sorted(set(ids))
+    assert orm.db.reserve_ids('scrapes', 'scrape_id', 1)[0] > ids[-1]
+
+
+def test_block_reserved_in_a_rolled_back_transaction_is_dropped(orm, database):
+    allocator = orm.IdAllocator(block_size=10)
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.insert('cities', {'city_id': 1, 'name': 'Monterrey'})
+            first = allocator.next_id('scrapes', 'scrape_id')
+            raise RuntimeError('batch failed')
+
+    # The reservation was rolled back, so another process gets the same block
+    assert database.reserve_ids('scrapes', 'scrape_id', 10) == list(range(first, first + 10))
+    assert allocator.next_id('scrapes', 'scrape_id') >= first + 10
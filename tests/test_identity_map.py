@@ -0,0 +1,88 @@
+import pytest
+import configurations
+
+
+class FlushFailed(Exception):
+    pass
+
+
+def new_version(orm, version_name='Sense', year=2021):
+    return orm.Version('Nissan', 'Versa', version_name, year, 'Sedan', 1.6, 'Manual')
+
+
+def new_car(orm, version, identifier='451230'):
+    return orm.Car(identifier, version, url=f'https://www.kavak.com/mx/usado/{identifier}', image_url='a.jpg',
+                   website='kavak')
+
+
+def test_lru_cache_evicts_the_least_recently_used_entry(orm):
+    cache = orm.LRUCache(capacity=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.evicted
+    cache.clear()
+    assert len(cache) == 0 and not cache.evicted
+
+
+def test_identity_map_is_incomplete_once_it_evicts(orm, monkeypatch):
+    monkeypatch.setattr(configurations, 'SINGLE_WRITER', True)
+    identity_map = orm.IdentityMap(capacity=3)
+    monkeypatch.setattr(orm, 'identity_map', identity_map)
+    versions = [new_version(orm, year=year) for year in (2018, 2019)]
+    writer = orm.BatchWriter()
+    writer.add(*versions)
+    writer.flush()
+
+    identity_map.load()
+    assert identity_map.versions_complete
+    assert identity_map.version_id(versions[0].natural_key()) == versions[0].version_id
+
+    versions += [new_version(orm, year=year) for year in (2020, 2021)]
+    writer.add(*versions[2:])
+    writer.flush()
+    # The 2018 version was used last, so the 2019 one is evicted
+    assert not identity_map.versions_complete
+    assert identity_map.version_id(versions[1].natural_key()) is None
+    assert identity_map.version_id(versions[0].natural_key()) == versions[0].version_id
+
+    # Loading keeps the most recent rows, and knows the table didn't fit
+    identity_map.load()
+    assert not identity_map.versions_complete
+    assert identity_map.version_id(versions[0].natural_key()) is None
+    assert identity_map.version_id(versions[3].natural_key()) == versions[3].version_id
+
+
+def test_failed_flush_clears_the_caches_of_rolled_back_rows(orm, database, monkeypatch):
+    version = new_version(orm)
+    car = new_car(orm, version)
+    car_info = orm.CarInfo(car, city='Monterrey', odometer=15000)
+    writer = orm.BatchWriter()
+    writer.add(version, car, car_info)
+
+    def fail(*args, **kwargs):
+        raise FlushFailed
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, 'copy_rows', fail)
+        with pytest.raises(FlushFailed):
+            writer.flush()
+
+    assert database.select('cities', ['name']) == []
+    assert not orm.cities._ids
+    assert orm.identity_map.version_id(version.natural_key()) is None
+    assert orm.identity_map.car(car.identifier, car.website) is None
+    assert not getattr(version, '_already_exists', False)
+
+    # A new batch writes the city again instead of referencing the rolled back one
+    writer = orm.BatchWriter()
+    car = new_car(orm, new_version(orm), identifier='451231')
+    writer.add(car._version_object, car, orm.CarInfo(car, city='Monterrey'))
+    writer.flush()
+    (city_id,) = database.select('car_info', ['city_id'])[0]
+    assert database.select('cities', ['name'], 'city_id = ?', [city_id]) == [('Monterrey',)]
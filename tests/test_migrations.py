@@ -0,0 +1,183 @@
+import threading
+import pytest
+from migrations import MIGRATIONS, Migration, Migrator, column_exists, table_exists
+
+
+def failing_after(migration):
+    """
+    Copy of `migration` failing once all its statements were executed.
+    """
+    def apply(database):
+        migration.apply(database)
+        raise RuntimeError(f'{migration.name} failed')
+
+    return Migration(migration.version, migration.name, apply)
+
+
+def migrations_named(*names):
+    return [migration for migration in MIGRATIONS if migration.name in names]
+
+
+def test_connecting_doesnt_migrate(empty_database):
+    assert not table_exists(empty_database, 'versions')
+    assert not table_exists(empty_database, 'schema_migrations')
+    assert not empty_database.supports_upsert
+
+
+def test_fresh_database(empty_database):
+    applied = empty_database.migrate()
+
+    assert applied == [migration.name for migration in MIGRATIONS]
+    assert empty_database.migrator.pending() == []
+    assert empty_database.supports_upsert
+    for table in ('versions', 'cars', 'scrape_history', 'scrape_presence', 'labels', 'cities', 'crawl_queue'):
+        assert table_exists(empty_database, table)
+    assert empty_database.migrate() == []
+
+
+def test_failed_migration_is_rolled_back_and_rerun(empty_database):
+    empty_database.migrate(target=1)
+    empty_database.insert('scrapes', {'scrape_id': 1, 'datetime_start': '2024-03-05 10:00:00'})
+    empty_database.insert('versions', {
+        'version_id': 1, 'brand': 'Nissan', 'model': 'Versa', 'version_name': 'Sense', 'year_prod': 2021,
+    })
+    empty_database.insert('cars', {
+        'car_id': 1, 'identifier': 7, 'website': 'kavak', 'url': 'https://kavak.com/7', 'version_id': 1,
+    })
+    empty_database.insert('scrape_history', {'scrape_id': 1, 'car_id': 1, 'labels': 'Precio bajo', 'price': 1000})
+
+    partition = migrations_named('partition_scrape_history')[0]
+    with pytest.raises(RuntimeError):
+        Migrator(empty_database, MIGRATIONS[:1] + [failing_after(partition)]).migrate()
+
+    assert not column_exists(empty_database, 'scrape_history', 'scrape_date')
+    assert empty_database.migrator.pending()[0].name == 'partition_scrape_history'
+
+    empty_database.migrate()
+    assert empty_database.migrator.pending() == []
+    assert empty_database.select('scrape_history', ['scrape_date', 'price']) == [('2024-03-05', 1000)]
+
+
+def test_steps_of_a_half_migrated_database_are_rerun(empty_database):
+    # Schema changes committed by a failed run of the migration, before it was atomic
+    empty_database.migrate(target=1)
+    empty_database.query('ALTER TABLE scrape_history ADD COLUMN scrape_date DATE', [])
+
+    empty_database.migrate()
+
+    assert empty_database.migrator.pending() == []
+
+
+def test_ddl_is_rolled_back_with_the_transaction(empty_database):
+    with pytest.raises(RuntimeError):
+        with empty_database.transaction(immediate=True):
+            empty_database.query('CREATE TABLE t (x INT)', [])
+            raise RuntimeError
+
+    assert not table_exists(empty_database, 't')
+
+
+def test_export_doesnt_migrate(empty_database, tmp_path):
+    import cli
+
+    empty_database.migrate(target=1)
+    cli.main(['export', 'scrapes', '--output', str(tmp_path / 'scrapes.csv')])
+
+    assert empty_database.migrator.pending()[0].name == 'partition_scrape_history'
+
+
+@pytest.fixture
+def database_before_dimensions(empty_database):
+    """
+    Database migrated up to the dimension tables, with a history row and a car info row.
+    """
+    dimension_tables = migrations_named('dimension_tables')[0]
+    empty_database.migrate(target=dimension_tables.version - 1)
+    empty_database.insert('scrapes', {'scrape_id': 1, 'datetime_start': '2024-03-05 10:00:00'})
+    empty_database.insert('versions', {
+        'version_id': 1, 'brand': 'Nissan', 'model': 'Versa', 'version_name': 'Sense', 'year_prod': 2021,
+    })
+    empty_database.insert('cars', {
+        'car_id': 1, 'identifier': 7, 'website': 'kavak', 'url': 'https://kavak.com/7', 'version_id': 1,
+    })
+    empty_database.insert('scrape_history', {
+        'scrape_id': 1, 'car_id': 1, 'labels': 'Precio bajo', 'price': 1000, 'scrape_date': '2024-03-05',
+    })
+    empty_database.insert('car_info', {'car_id': 1, 'city': 'Monterrey', 'odometer': 100})
+    return empty_database
+
+
+def assert_dimensions_migrated(database):
+    assert database.migrator.pending() == []
+    assert not column_exists(database, 'scrape_history', 'labels')
+    assert not column_exists(database, 'car_info', 'city')
+    assert database.select(
+        'scrape_history h JOIN label_set_labels s ON s.label_set_id = h.label_set_id '
+        'JOIN labels l ON l.label_id = s.label_id', ['l.name']
+    ) == [('Precio bajo',)]
+    assert database.select('car_info i JOIN cities c ON c.city_id = i.city_id', ['c.name']) == [('Monterrey',)]
+
+
+def test_failed_dimension_tables_migration_is_rerun(database_before_dimensions):
+    dimension_tables = migrations_named('dimension_tables')[0]
+    migrations = [migration for migration in MIGRATIONS if migration.version < dimension_tables.version]
+    with pytest.raises(RuntimeError):
+        Migrator(database_before_dimensions, migrations + [failing_after(dimension_tables)]).migrate()
+
+    assert not table_exists(database_before_dimensions, 'labels')
+    database_before_dimensions.migrate()
+    assert_dimensions_migrated(database_before_dimensions)
+
+
+def test_half_migrated_dimension_tables_are_completed(database_before_dimensions):
+    # Tables, rows and columns committed by a failed run, before migrations were atomic
+    database_before_dimensions.query(
+        'CREATE TABLE labels (label_id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE)', []
+    )
+    database_before_dimensions.query("INSERT INTO labels (label_id, name) VALUES (1, 'Precio bajo')", [])
+    database_before_dimensions.query('ALTER TABLE car_info ADD COLUMN city_id INT', [])
+
+    database_before_dimensions.migrate()
+    assert_dimensions_migrated(database_before_dimensions)
+
+
+def test_migration_applied_by_another_process_meanwhile_is_skipped(empty_database):
+    other = Migrator(empty_database, migrations_named('baseline', 'partition_scrape_history'))
+    migrator = Migrator(empty_database, migrations_named('baseline', 'partition_scrape_history'))
+    transaction = empty_database.transaction
+
+    def other_process_first(*args, **kwargs):
+        # The other process migrates after this one checked its pending migrations
+        empty_database.transaction = transaction
+        other.migrate()
+        return transaction(*args, **kwargs)
+
+    empty_database.transaction = other_process_first
+    try:
+        assert migrator.migrate() == []
+    finally:
+        del empty_database.transaction
+    assert migrator.applied() == {1: 'baseline', 2: 'partition_scrape_history'}
+
+
+def test_concurrent_migrations_apply_every_migration_once(empty_database):
+    results, errors = [], []
+    start = threading.Barrier(3)
+
+    def migrate():
+        with empty_database.connection_scope():
+            start.wait()
+            try:
+                results.append(Migrator(empty_database).migrate())
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=migrate) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(name for names in results for name in names) == sorted(migration.name for migration in MIGRATIONS)
+    assert len(empty_database.select('schema_migrations', ['version'])) == len(MIGRATIONS)
@@ -0,0 +1,184 @@
+import gzip
+import os
+import time
+import pytest
+import page_cache
+from http_client import HttpClient
+from page_cache import PageCache
+from rate_limit import HostRateLimiters
+
+URL = 'https://www.kavak.com/mx/usado/nissan-versa?id=451230'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+    def __init__(self, url, status_code=200, content=b'', headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = 'utf-8'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(page_cache.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PageCache(directory=str(tmp_path / 'pages'), ttl={'listing': 60, 'detail': 3600})
+
+
+def blob_files(cache):
+    blobs_dir = os.path.join(cache.directory, 'blobs')
+    return [name for _, _, names in os.walk(blobs_dir) for name in names]
+
+
+def test_ttl_depends_on_the_page_type(cache, clock):
+    entry = cache.store(URL, FakeResponse(URL, content=b'<html></html>'), 'detail')
+
+    clock.now += 120
+    assert cache.is_fresh(entry, 'detail')
+    assert not cache.is_fresh(entry, 'listing')
+    assert not cache.is_fresh(entry, 'unknown')
+    clock.now += 3600
+    assert not cache.is_fresh(entry, 'detail')
+
+
+def test_identical_pages_share_a_blob(cache, clock):
+    cache.store(URL, FakeResponse(URL, content=b'<html>same</html>'))
+    cache.store(URL + '&copy=1', FakeResponse(URL, content=b'<html>same</html>'))
+    cache.store(URL + '&other=1', FakeResponse(URL, content=b'<html>other</html>'))
+
+    assert len(blob_files(cache)) == 2
+    assert cache.response(cache.lookup(URL + '&copy=1')).content == b'<html>same</html>'
+
+
+def test_prune_removes_expired_entries_and_unreferenced_blobs(cache, clock):
+    cache.store(URL, FakeResponse(URL, content=b'<html>old</html>'))
+    cache.store(URL + '&shared=1', FakeResponse(URL, content=b'<html>shared</html>'))
+    clock.now += 1000
+    cache.store(URL + '&new=1', FakeResponse(URL, content=b'<html>new</html>'))
+    cache.touch(cache.lookup(URL + '&shared=1'))
+    clock.now += 10
+
+    assert cache.prune(max_age=100) == 1
+    assert cache.lookup(URL) is None
+    assert cache.lookup(URL + '&shared=1') is not None
+    assert cache.lookup(URL + '&new=1') is not None
+    assert len(blob_files(cache)) == 2
+
+
+def test_prune_keeps_files_written_after_it_started(cache, clock):
+    entry = cache.store(URL, FakeResponse(URL, content=b'<html></html>'))
+    clock.now += 1000
+    # Index entry and blob rewritten by another worker while the prune runs
+    for path in (cache._index_path(URL), cache._blob_path(entry['content_hash'])):
+        os.utime(path, (clock.now + 1, clock.now + 1))
+
+    assert cache.prune(max_age=100) == 0
+    assert len(blob_files(cache)) == 1
+
+
+def test_pruned_blob_is_not_served(cache, clock):
+    entry = cache.store(URL, FakeResponse(URL, content=b'<html></html>'))
+    os.remove(cache._blob_path(entry['content_hash']))
+
+    assert cache.response(entry) is None
+    assert cache.lookup(URL) is None
+
+
+class FakeSession:
+    """
+    Stand-in for requests.Session answering with queued responses.
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests.append((url, headers or {}))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def client(cache):
+    client = HttpClient(cache=cache, max_retries=0, rate_limiters=HostRateLimiters(
+        settings={'initial_rate': 1000.0, 'min_rate': 1000.0, 'max_rate': 1000.0, 'burst': 10},
+        host_limits={},
+    ))
+    return client
+
+
+def test_fresh_page_is_served_without_a_request(client, clock):
+    client.session = FakeSession(FakeResponse(URL, content=b'<html>v1</html>'))
+
+    assert client.get_page(URL).content == b'<html>v1</html>'
+    assert client.get_page(URL).from_cache
+    assert len(client.session.requests) == 1
+
+
+def test_stale_page_is_revalidated_and_304_reuses_the_blob(client, cache, clock):
+    client.session = FakeSession(
+        FakeResponse(URL, content=b'<html>v1</html>',
+                     headers={'ETag': '"v1"', 'Last-Modified': 'Tue, 05 Mar 2024 10:00:00 GMT'}),
+        FakeResponse(URL, status_code=304),
+    )
+    client.get_page(URL, page_type='listing')
+    blobs = blob_files(cache)
+    clock.now += 120
+
+    response = client.get_page(URL, page_type='listing')
+
+    assert response.content == b'<html>v1</html>'
+    assert client.session.requests[1][1] == {
+        'If-None-Match': '"v1"', 'If-Modified-Since': 'Tue, 05 Mar 2024 10:00:00 GMT',
+    }
+    assert blob_files(cache) == blobs
+    # The 304 made the page fresh again
+    assert cache.is_fresh(cache.lookup(URL), 'listing')
+
+
+def test_changed_page_replaces_the_cached_one(client, cache, clock):
+    client.session = FakeSession(
+        FakeResponse(URL, content=b'<html>v1</html>', headers={'ETag': '"v1"'}),
+        FakeResponse(URL, content=b'<html>v2</html>', headers={'ETag': '"v2"'}),
+    )
+    client.get_page(URL, page_type='listing')
+    clock.now += 120
+
+    assert client.get_page(URL, page_type='listing').content == b'<html>v2</html>'
+    assert cache.lookup(URL)['etag'] == '"v2"'
+    with gzip.open(cache._blob_path(cache.lookup(URL)['content_hash'])) as file:
+        assert file.read() == b'<html>v2</html>'
+
+
+def test_page_pruned_during_revalidation_is_downloaded_again(client, cache, clock):
+    client.session = FakeSession(
+        FakeResponse(URL, content=b'<html>v1</html>', headers={'ETag': '"v1"'}),
+        FakeResponse(URL, status_code=304),
+        FakeResponse(URL, content=b'<html>v1</html>'),
+    )
+    client.get_page(URL, page_type='listing')
+    clock.now += 120
+    original_touch = cache.touch
+
+    def touch_after_prune(entry):
+        os.remove(cache._blob_path(entry['content_hash']))
+        original_touch(entry)
+
+    cache.touch = touch_after_prune
+
+    assert client.get_page(URL, page_type='listing').content == b'<html>v1</html>'
+    assert client.session.requests[2][1] == {}
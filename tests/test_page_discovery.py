@@ -0,0 +1,65 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from kavak_webpage import KavakPageIterator, KavakPageScraper, ParallelKavakPageIterator
+
+BASE_URL = 'https://www.kavak.com/mx/seminuevos'
+
+
+def listing_page(number, last_page, last_linked_page):
+    """
+    Listing page `number` of a website with pages 0 to `last_page`, which keeps
+    serving pages beyond the last one without pagination.
+    """
+    pagination = ''
+    if number <= last_page:
+        linked = {min(number + 1, last_page), min(last_linked_page, last_page), max(number - 1, 0)}
+        pagination = ''.join(
+            f'<a class="results_results__pagination-nav__Qcftr" href="{BASE_URL}?page={linked_number}">'
+            f'{linked_number}</a>'
+            for linked_number in sorted(linked)
+        )
+    html = f'<div class="results_results__container__tcF4_"></div>{pagination}'
+    return KavakPageScraper(f'{BASE_URL}?page={number}', content=html.encode())
+
+
+@pytest.fixture
+def website(monkeypatch):
+    fetched = []
+    lock = threading.Lock()
+    site = {'last_page': 0, 'last_linked_page': 0}
+
+    def fetch_page(iterator, number):
+        with lock:
+            fetched.append(number)
+        return listing_page(number, site['last_page'], site['last_linked_page'])
+
+    monkeypatch.setattr(KavakPageIterator, 'fetch_page', fetch_page)
+    site['fetched'] = fetched
+    return site
+
+
+@pytest.mark.parametrize('last_page, last_linked_page', [(0, 0), (1, 1), (9, 3), (37, 2), (120, 120), (700, 5)])
+def test_parallel_discovery_finds_every_page(website, last_page, last_linked_page):
+    website.update(last_page=last_page, last_linked_page=last_linked_page)
+
+    pages = list(ParallelKavakPageIterator(BASE_URL, max_workers=4, ordered=True))
+
+    assert [page.url for page in pages] == [f'{BASE_URL}?page={number}' for number in range(last_page + 1)]
+    assert max(website['fetched']) <= ParallelKavakPageIterator.max_pages
+
+
+def test_sequential_iterator_stops_without_pagination(website):
+    website.update(last_page=3, last_linked_page=3)
+
+    assert [page.url for page in KavakPageIterator(BASE_URL)] == [f'{BASE_URL}?page={n}' for n in range(4)]
+
+
+def test_linked_page_beyond_the_last_one(website):
+    # The first page links a page which is no longer a page of results
+    website.update(last_page=2, last_linked_page=2)
+    first_page = listing_page(0, 10, 10)
+    iterator = ParallelKavakPageIterator(BASE_URL, max_workers=3)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        assert iterator.count_pages(first_page, executor) == 3
@@ -0,0 +1,44 @@
+import ORM
+from main import Main
+from parser_pool import ParserPool
+from webpage_parsers import KavakItem
+
+URL = 'https://www.kavak.com/mx/usado/nissan-versa-sense-sedan-2021?id=451230'
+PAGE = '''
+<html><body>
+<ul class="breadcrumb_breadcrumb__nPwIW">
+  <li><a>Autos</a></li><li><a>Nissan</a></li><li><a>Versa</a></li><li><a>2021</a></li><li><span>Sense</span></li>
+</ul>
+<div class="desktop_car-detail__start__BToHy">
+  <p>Stock ID</p><p>451230</p>
+  <p>1.6 Litros</p><p>4 Cilindros</p><p>118 Caballos de Fuerza</p><p>SiBluetooth</p>
+</div>
+<aside class="buy-box_wrapper__jCjj4">Transmisión Manual</aside>
+<div class="keen-slider__slide"><img src="https://images.kavak.services/451230/front.jpg"></div>
+</body></html>
+'''.encode()
+
+
+def test_pool_record_has_every_column_read_by_the_orm():
+    with ParserPool(KavakItem, processes=1, fields=Main.record_fields) as pool:
+        record = pool.parse(URL, PAGE)
+
+    assert record['url'] == URL
+    for cls in (ORM.Version, ORM.Car, ORM.VersionDetails):
+        # The values from_parser reads from an item parsed in this process
+        expected = KavakItem(URL, content=PAGE).extract_record(cls.table_columns)
+        assert {column: record[column] for column in cls.table_columns} == expected
+
+
+def test_record_builds_the_same_objects_as_the_parser(orm):
+    main = Main.__new__(Main)
+    record = KavakItem(URL, content=PAGE).extract_record(Main.record_fields)
+
+    car, version, details = main.parse_new_record(record)
+    parsed_car, parsed_version, parsed_details = main.parse_new_item(KavakItem(URL, content=PAGE))
+
+    assert car.url == URL
+    assert version.natural_key() == parsed_version.natural_key()
+    assert {key: value for key, value in car.row().items() if key != 'car_id'} == \
+        {key: value for key, value in parsed_car.row().items() if key != 'car_id'}
+    assert details.row() == parsed_details.row()
@@ -0,0 +1,111 @@
+import contextlib
+import itertools
+import threading
+import time
+import pytest
+from pipeline import Pipeline, Stage
+
+
+def test_items_flow_through_every_stage():
+    def split(n):
+        yield n
+        yield -n
+
+    def keep_positive(n):
+        return n if n > 0 else None
+
+    results = []
+    stages = [
+        Stage('split', split, workers=2),
+        Stage('filter', keep_positive, workers=3),
+        Stage('collect', results.append),
+    ]
+    Pipeline(range(1, 51), stages).run()
+
+    assert sorted(results) == list(range(1, 51))
+    assert [stats['processed'] for stats in Pipeline(None, stages).stats()] == [50, 100, 50]
+
+
+def test_full_queues_block_the_stages_upstream():
+    produced = []
+    release = threading.Event()
+
+    def source():
+        for n in range(100):
+            produced.append(n)
+            yield n
+
+    def slow_sink(n):
+        release.wait()
+
+    stages = [Stage('pass', lambda n: n, queue_size=2), Stage('sink', slow_sink, queue_size=2)]
+    pipeline = Pipeline(source(), stages)
+    thread = threading.Thread(target=pipeline.run)
+    thread.start()
+    time.sleep(0.5)
+
+    # 2 queued per stage, 1 held by each worker and 1 waiting in the source
+    assert len(produced) <= 7
+    release.set()
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert len(produced) == 100
+    assert all(stats['max_depth'] <= 2 for stats in pipeline.stats())
+
+
+def test_stages_shut_down_in_order():
+    events = []
+    lock = threading.Lock()
+
+    def source():
+        yield from range(20)
+        with lock:
+            events.append('source')
+
+    @contextlib.contextmanager
+    def worker_context():
+        yield
+        with lock:
+            events.append(threading.current_thread().name.split('-')[1])
+
+    stages = [Stage('fetch', lambda n: n, workers=3), Stage('parse', lambda n: None, workers=2)]
+    Pipeline(source(), stages, worker_context=worker_context).run()
+
+    assert events == ['source'] + ['fetch'] * 3 + ['parse'] * 2
+
+
+def test_worker_error_stops_the_pipeline_and_is_raised():
+    exited = []
+
+    def parse(n):
+        if n == 3:
+            raise ValueError('no price')
+        return n
+
+    @contextlib.contextmanager
+    def worker_context():
+        try:
+            yield
+        finally:
+            exited.append(threading.current_thread().name)
+
+    stages = [
+        Stage('fetch', lambda n: n, workers=2, queue_size=2),
+        Stage('parse', parse, workers=2, queue_size=2),
+        Stage('store', lambda n: None, queue_size=2),
+    ]
+    pipeline = Pipeline(itertools.count(), stages, worker_context=worker_context)
+
+    with pytest.raises(ValueError, match='no price'):
+        pipeline.run()
+    # Every worker left its context, so their resources were released
+    assert len(exited) == 5
+
+
+def test_source_error_is_raised():
+    def source():
+        yield 1
+        raise ConnectionError('listing page unavailable')
+
+    with pytest.raises(ConnectionError):
+        Pipeline(source(), [Stage('parse', lambda n: n, workers=2)]).run()
@@ -0,0 +1,121 @@
+import pytest
+import rate_limit
+from rate_limit import AdaptiveRateLimiter, HostRateLimiters
+
+
+class FakeClock:
+    """
+    Replaces time.monotonic and time.sleep: sleeping advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(rate_limit.time, 'sleep', clock.sleep)
+    return clock
+
+
+def limiter(**settings):
+    return AdaptiveRateLimiter(**{'initial_rate': 2.0, 'min_rate': 0.5, 'max_rate': 4.0, **settings})
+
+
+def test_fast_responses_increase_the_rate_additively(clock):
+    rate_limiter = limiter(increase=0.25)
+
+    for _ in range(3):
+        rate_limiter.on_response(200, latency=0.1)
+
+    assert rate_limiter.rate == pytest.approx(2.75)
+
+
+@pytest.mark.parametrize('status_code', [429, 503])
+def test_throttling_statuses_halve_the_rate(clock, status_code):
+    rate_limiter = limiter()
+
+    rate_limiter.on_response(status_code, latency=0.1)
+
+    assert rate_limiter.rate == pytest.approx(1.0)
+    assert rate_limiter.throttled == 1
+
+
+def test_errors_and_slow_responses_decrease_the_rate(clock):
+    rate_limiter = limiter(decrease=0.5, latency_target=2.0)
+
+    rate_limiter.on_error()
+    clock.now += 5
+    rate_limiter.on_response(200, latency=3.0)
+    clock.now += 5
+    rate_limiter.on_response(500, latency=0.1)
+
+    assert rate_limiter.rate == pytest.approx(0.5)
+    assert rate_limiter.throttled == 0
+
+
+def test_congestion_within_the_cooldown_counts_once(clock):
+    rate_limiter = limiter(cooldown=1.0)
+
+    rate_limiter.on_response(429, latency=0.1)
+    clock.now += 0.5
+    rate_limiter.on_error()
+    assert rate_limiter.rate == pytest.approx(1.0)
+
+    clock.now += 0.5
+    rate_limiter.on_error()
+    assert rate_limiter.rate == pytest.approx(0.5)
+
+
+def test_rate_stays_between_min_and_max_rate(clock):
+    rate_limiter = limiter()
+
+    for _ in range(100):
+        rate_limiter.on_response(200, latency=0.1)
+    assert rate_limiter.rate == 4.0
+
+    for _ in range(20):
+        clock.now += 5
+        rate_limiter.on_error()
+    assert rate_limiter.rate == 0.5
+
+
+def test_acquire_paces_requests_at_the_rate(clock):
+    rate_limiter = limiter(initial_rate=2.0, burst=1)
+
+    for _ in range(5):
+        rate_limiter.acquire()
+
+    # The first request uses the initial token, the other four wait 1/rate each
+    assert sum(clock.slept) == pytest.approx(2.0)
+
+
+def test_pause_delays_the_next_request(clock):
+    rate_limiter = limiter(burst=5)
+
+    rate_limiter.pause(30)
+    rate_limiter.acquire()
+
+    assert clock.slept == [30]
+    assert rate_limiter.metrics()['paused_for'] == 0.0
+
+
+def test_host_limits_override_the_settings(clock):
+    limiters = HostRateLimiters(
+        settings={'initial_rate': 2.0, 'min_rate': 0.5, 'max_rate': 4.0},
+        host_limits={'images.kavak.services': {'max_rate': 10.0}},
+    )
+
+    assert limiters.for_url('https://www.kavak.com/mx/usados').max_rate == 4.0
+    assert limiters.for_url('https://images.kavak.services/a.jpg').max_rate == 10.0
+    assert limiters.for_url('https://www.kavak.com/mx/usado/1') is limiters.for_url('https://www.kavak.com/')
@@ -0,0 +1,34 @@
+import pytest
+from webpage_parsers import KavakItem
+
+lexbor = pytest.importorskip('selectolax.lexbor')
+
+# The price is inside the car detail subtree, and the breadcrumb after the buy box
+PAGE = b'''<html><body>
+<nav>Kavak</nav>
+<div class="desktop_car-detail__start__BToHy">
+  <h1>Nissan Versa</h1>
+  <span class="price_amount__dRxZ8">$309,999</span>
+</div>
+<aside class="buy-box_wrapper__jCjj4"><p>Stock ID</p><p>451230</p></aside>
+<ul class="breadcrumb_breadcrumb__nPwIW"><li>Nissan</li><li>Versa</li></ul>
+<footer>Contacto</footer>
+</body></html>'''
+
+
+def test_nested_subtrees_are_selected_once_in_document_order():
+    nodes = KavakItem.select_subtrees(PAGE, KavakItem.parse_subtrees)
+
+    assert [node.tag for node in nodes] == ['div', 'aside', 'ul']
+
+
+@pytest.mark.parametrize('backend', ['selectolax', 'html.parser'])
+def test_restricted_page_keeps_every_subtree_once(backend):
+    page = KavakItem('https://www.kavak.com/mx/usado/nissan-versa', content=PAGE, parser_backend=backend,
+                     restrict_parsing=True)
+
+    assert len(page.soup.select('span.price_amount__dRxZ8')) == 1
+    assert [tag.name for tag in page.soup.find_all(recursive=False)] == ['div', 'aside', 'ul']
+    assert page.soup.find('nav') is None and page.soup.find('footer') is None
+    assert page.original_price == '$309,999'
+    assert page._scrape_sibling('Stock ID') == '451230'
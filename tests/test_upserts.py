@@ -0,0 +1,49 @@
+def new_version(orm, version_name='Sense', year=2021):
+    return orm.Version('Nissan', 'Versa', version_name, year, 'Sedan', 1.6, 'Manual')
+
+
+def new_car(orm, version, identifier='451230'):
+    return orm.Car(identifier, version, url=f'https://www.kavak.com/mx/usado/{identifier}', image_url='a.jpg',
+                   website='kavak')
+
+
+def test_upsert_returns_the_key_of_the_existing_row(database):
+    city_id = database.upsert('cities', {'city_id': 1, 'name': 'Monterrey'}, ['name'], returning='city_id')
+
+    assert database.upsert('cities', {'city_id': 2, 'name': 'Monterrey'}, ['name'], returning='city_id') == city_id
+    assert database.select('cities', ['city_id', 'name']) == [(1, 'Monterrey')]
+
+
+def test_upserted_object_takes_the_key_of_the_existing_row(orm):
+    version = new_version(orm)
+    writer = orm.BatchWriter()
+    writer.add(version)
+    writer.flush()
+
+    duplicate = new_version(orm)
+    duplicate.version_id = version.version_id + 100
+    duplicate.upsert()
+
+    assert duplicate.version_id == version.version_id
+    assert len(orm.db.select('versions', ['version_id'])) == 1
+
+
+def test_existing_car_unknown_to_the_identity_map_keeps_its_key(orm, monkeypatch):
+    version = new_version(orm)
+    car = new_car(orm, version)
+    writer = orm.BatchWriter()
+    writer.add(version, car)
+    writer.flush()
+
+    # Another process wrote the car, so this one doesn't know it
+    monkeypatch.setattr(orm, 'identity_map', orm.IdentityMap())
+    orm.Version._allocated_ids.clear()
+    version = new_version(orm)
+    duplicate = new_car(orm, version)
+    assert duplicate.car_id != car.car_id
+    writer.add(version, duplicate)
+    writer.flush()
+
+    assert duplicate.car_id == car.car_id
+    assert version.version_id == car.version_id
+    assert orm.db.select('cars', ['car_id']) == [(car.car_id,)]
@@ -0,0 +1,170 @@
+import threading
+import pytest
+import work_queue
+from work_queue import WorkQueue
+
+SCRAPE_ID = 1
+WEBSITE = 'kavak'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(work_queue.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue(database, clock):
+    queue = WorkQueue(database, lease_seconds=60, max_attempts=3, poll_interval=0.01)
+    queue.open(SCRAPE_ID)
+    queue.enqueue(SCRAPE_ID, WEBSITE, [
+        (identifier, f'https://www.kavak.com/mx/usado/{identifier}', {'price': identifier * 1000})
+        for identifier in (101, 102, 103)
+    ])
+    queue.close(SCRAPE_ID)
+    return queue
+
+
+def identifiers(items):
+    return [item['identifier'] for item in items]
+
+
+def test_items_are_claimed_once(queue):
+    first = queue.claim(SCRAPE_ID, 'worker-a', limit=2)
+    second = queue.claim(SCRAPE_ID, 'worker-b', limit=2)
+
+    assert identifiers(first) == ['101', '102']
+    assert identifiers(second) == ['103']
+    assert first[0]['card'] == {'price': 101000}
+    assert first[0]['attempts'] == 1
+    assert queue.claim(SCRAPE_ID, 'worker-c', limit=2) == []
+    assert queue.counts(SCRAPE_ID) == {'claimed': 3}
+
+
+def test_enqueueing_an_item_twice_keeps_its_state(queue):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=1)
+    queue.enqueue(SCRAPE_ID, WEBSITE, [(101, 'https://www.kavak.com/mx/usado/101', {})])
+
+    assert queue.counts(SCRAPE_ID) == {'claimed': 1, 'pending': 2}
+
+
+def test_expired_leases_are_claimed_again(queue, clock):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+
+    clock.now += 59
+    assert queue.claim(SCRAPE_ID, 'worker-b', limit=3) == []
+
+    clock.now += 2
+    reclaimed = queue.claim(SCRAPE_ID, 'worker-b', limit=3)
+    assert identifiers(reclaimed) == ['101', '102', '103']
+    assert {item['attempts'] for item in reclaimed} == {2}
+
+    # The items taken over are no longer completed by the worker that lost them
+    queue.complete(SCRAPE_ID, WEBSITE, ['101'], 'worker-a')
+    queue.complete(SCRAPE_ID, WEBSITE, ['102'], 'worker-b')
+    assert queue.counts(SCRAPE_ID) == {'claimed': 2, 'done': 1}
+
+
+def test_heartbeat_extends_the_lease(queue, clock):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+
+    clock.now += 50
+    queue.heartbeat(SCRAPE_ID, 'worker-a')
+    clock.now += 50
+
+    assert queue.claim(SCRAPE_ID, 'worker-b', limit=3) == []
+    clock.now += 11
+    assert len(queue.claim(SCRAPE_ID, 'worker-b', limit=3)) == 3
+
+
+def test_heartbeats_extend_the_lease_in_background(queue, clock, monkeypatch):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    beats = threading.Semaphore(0)
+    heartbeat = queue.heartbeat
+
+    def counted_heartbeat(scrape_id, worker):
+        heartbeat(scrape_id, worker)
+        beats.release()
+
+    monkeypatch.setattr(queue, 'heartbeat', counted_heartbeat)
+    clock.now += 50
+    with queue.heartbeats(SCRAPE_ID, 'worker-a', interval=0.01):
+        assert beats.acquire(timeout=5)
+    clock.now += 50
+
+    assert queue.claim(SCRAPE_ID, 'worker-b', limit=3) == []
+
+
+def test_failed_items_are_retried_until_max_attempts(queue, clock):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    queue.complete(SCRAPE_ID, WEBSITE, ['102', '103'], 'worker-a')
+    queue.fail(SCRAPE_ID, WEBSITE, '101', 'worker-a', ValueError('no price'))
+    for attempt in (2, 3):
+        claimed = queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+        assert identifiers(claimed) == ['101']
+        assert claimed[0]['attempts'] == attempt
+        queue.fail(SCRAPE_ID, WEBSITE, '101', 'worker-a', ValueError('no price'))
+
+    assert queue.claim(SCRAPE_ID, 'worker-a', limit=3) == []
+    assert queue.counts(SCRAPE_ID) == {'done': 2, 'failed': 1}
+    assert queue.database.select(
+        'crawl_queue', ['error'], 'identifier = ?', ['101']
+    ) == [('no price',)]
+
+
+def test_less_attempted_items_are_claimed_first(queue):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=1)
+    queue.fail(SCRAPE_ID, WEBSITE, '101', 'worker-a', 'timeout')
+
+    assert identifiers(queue.claim(SCRAPE_ID, 'worker-a', limit=3)) == ['102', '103', '101']
+
+
+def test_lease_expiring_on_the_last_attempt_fails_the_item(queue, clock):
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    queue.complete(SCRAPE_ID, WEBSITE, ['102', '103'], 'worker-a')
+    for _ in range(2):
+        clock.now += 61
+        assert identifiers(queue.claim(SCRAPE_ID, 'worker-a', limit=3)) == ['101']
+    clock.now += 61
+
+    assert queue.claim(SCRAPE_ID, 'worker-b', limit=3) == []
+    assert queue.database.select(
+        'crawl_queue', ['status', 'error'], 'identifier = ?', ['101']
+    ) == [('failed', 'lease expired')]
+    assert queue.finished(SCRAPE_ID)
+
+
+def test_scrape_finishes_when_every_item_is_done_or_failed(queue):
+    assert queue.active_scrape() == SCRAPE_ID
+    claimed = queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    assert queue.remaining(SCRAPE_ID) == 3
+
+    queue.complete(SCRAPE_ID, WEBSITE, identifiers(claimed[:2]), 'worker-a')
+    queue.fail(SCRAPE_ID, WEBSITE, '103', 'worker-a', 'timeout')
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    queue.fail(SCRAPE_ID, WEBSITE, '103', 'worker-a', 'timeout')
+    assert not queue.finished(SCRAPE_ID)
+    queue.claim(SCRAPE_ID, 'worker-a', limit=3)
+    queue.fail(SCRAPE_ID, WEBSITE, '103', 'worker-a', 'timeout')
+
+    assert queue.finished(SCRAPE_ID)
+    assert queue.wait(SCRAPE_ID, report=False) == {'done': 2, 'failed': 1}
+    assert queue.active_scrape() is None
+
+
+def test_open_scrape_is_not_finished_while_enqueueing(database, clock):
+    queue = WorkQueue(database)
+    queue.open(SCRAPE_ID)
+
+    assert queue.remaining(SCRAPE_ID) == 0
+    assert not queue.finished(SCRAPE_ID)
+    assert queue.active_scrape() == SCRAPE_ID
@@ -1,7 +1,30 @@
 from scraping import Scraper
-import re
 
 class KavakItem(Scraper):
+    # Parsing is not restricted by default, as `cylinders` reads the text of the whole page
+    parse_subtrees = (
+        'div.desktop_car-detail__start__BToHy',
+        'aside.buy-box_wrapper__jCjj4',
+        'ul.breadcrumb_breadcrumb__nPwIW',
+        'span.price_amount__dRxZ8',
+        'span.amount_uki-amount__extraLarge__price__ZMOLc',
+        'div.keen-slider__slide',
+    )
+    embedded_state_script_id = '__NEXT_DATA__'
+    embedded_fields = {
+        'identifier': ('props.pageProps.car.stockId', 'props.pageProps.car.id'),
+        'brand': ('props.pageProps.car.make', 'props.pageProps.car.brand'),
+        'model': 'props.pageProps.car.model',
+        'year_prod': 'props.pageProps.car.year',
+        'version_name': ('props.pageProps.car.trim', 'props.pageProps.car.version'),
+        'price': 'props.pageProps.car.price',
+        'original_price': 'props.pageProps.car.originalPrice',
+        'body_style': 'props.pageProps.car.bodyType',
+        'transmission_type': 'props.pageProps.car.transmission',
+        'engine_displacement': 'props.pageProps.car.engineDisplacement',
+        'city': 'props.pageProps.car.location.city',
+        'image_url': ('props.pageProps.car.mainImage', 'props.pageProps.car.images.0.url'),
+    }
 
     @property
     def website(self): return 'kavak'
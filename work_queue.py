@@ -0,0 +1,261 @@
+"""
+Queue of the detail pages of a scrape, shared through the database by every
+worker process (on any machine) working the scrape. Workers claim batches of
+items with a lease, extended by a heartbeat while they work on them. The items
+of a worker that stops are claimed again by the others once its lease expires.
+
+On PostgreSQL items are claimed with `SELECT ... FOR UPDATE SKIP LOCKED`, so
+concurrent workers never wait for each other. On SQLite (single node) claims are
+serialized by the database write lock.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+import configurations
+
+_CLAIMABLE = (
+    "scrape_id = ? AND attempts < ? AND (status = 'pending' OR (status = 'claimed' AND lease_until < ?))"
+)
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class WorkQueue:
+    """
+    The `crawl_queue` table: one row per (scrape_id, identifier, website), with
+    the url of the detail page and the card data (JSON) of the item, and its
+    status: 'pending', 'claimed' (by `worker` until `lease_until`), 'done' or
+    'failed' (after `max_attempts` claims).
+    """
+
+    def __init__(self, database, lease_seconds=None, max_attempts=None, poll_interval=None):
+        self.database = database
+        self.lease_seconds = lease_seconds or configurations.WORK_QUEUE_LEASE
+        self.max_attempts = max_attempts or configurations.WORK_QUEUE_MAX_ATTEMPTS
+        self.poll_interval = poll_interval or configurations.WORK_QUEUE_POLL_INTERVAL
+
+    def _sql(self, sql):
+        return sql.replace('?', '%s') if self.database.use_postgres else sql
+
+    def _execute(self, sql, params=()):
+        self.database.cursor.execute(self._sql(sql), params)
+
+    def _commit(self):
+        if not self.database._in_transaction:
+            self.database.connection.commit()
+
+    def open(self, scrape_id):
+        """
+        Record that the items of a scrape are being queued: its workers keep waiting
+        for more items until `close` is called.
+        """
+        self.database.insert_many(
+            'crawl_enqueues', [{'scrape_id': scrape_id, 'enqueue_done': False}], conflict_columns=['scrape_id']
+        )
+
+    def close(self, scrape_id):
+        """
+        Record that every item of a scrape was queued.
+        """
+        self._execute('UPDATE crawl_enqueues SET enqueue_done = ? WHERE scrape_id = ?', (True, scrape_id))
+        self._commit()
+
+    def enqueue_done(self, scrape_id):
+        rows = self.database.select('crawl_enqueues', ['enqueue_done'], 'scrape_id = ?', [scrape_id])
+        return not rows or bool(rows[0][0])
+
+    def finished(self, scrape_id):
+        """
+        Return whether every item of a scrape was queued and processed.
+        """
+        return self.enqueue_done(scrape_id) and self.remaining(scrape_id) == 0
+
+    def enqueue(self, scrape_id, website, items):
+        """
+        Queue detail pages of a scrape. Items already queued are ignored.
+
+        :param items: list of (identifier, url, card) tuples, card being a JSON
+                      serializable dict.
+        """
+        self.database.insert_many('crawl_queue', [
+            {
+                'scrape_id': scrape_id, 'identifier': str(identifier), 'website': website, 'url': url,
+                'card': json.dumps(card, ensure_ascii=False), 'status': 'pending', 'attempts': 0,
+            }
+            for identifier, url, card in items
+        ], conflict_columns=['scrape_id', 'identifier', 'website'])
+
+    def claim(self, scrape_id, worker, limit):
+        """
+        Claim up to `limit` pending items of a scrape (or items whose lease expired)
+        for `worker`, leased for `lease_seconds`.
+
+        :return: list of dicts with the identifier, website, url, card and attempts
+                 of the claimed items.
+        """
+        now = time.time()
+        lease_until = now + self.lease_seconds
+        columns = ['identifier', 'website', 'url', 'card', 'attempts']
+        if self.database.use_postgres:
+            self._expire(scrape_id, now)
+            self._execute(
+                "UPDATE crawl_queue q SET status = 'claimed', worker = ?, lease_until = ?, attempts = q.attempts + 1 "
+                f'FROM (SELECT scrape_id, identifier, website FROM crawl_queue WHERE {_CLAIMABLE} '
+                'ORDER BY attempts, identifier LIMIT ? FOR UPDATE SKIP LOCKED) c '
+                'WHERE q.scrape_id = c.scrape_id AND q.identifier = c.identifier AND q.website = c.website '
+                'RETURNING q.identifier, q.website, q.url, q.card, q.attempts',
+                (worker, lease_until, scrape_id, self.max_attempts, now, limit)
+            )
+            rows = self.database.cursor.fetchall()
+            self._commit()
+        else:
+            with self._sqlite_write_lock():
+                self._expire(scrape_id, now)
+                self._execute(
+                    f'SELECT identifier, website, url, card, attempts FROM crawl_queue WHERE {_CLAIMABLE} '
+                    'ORDER BY attempts, identifier LIMIT ?',
+                    (scrape_id, self.max_attempts, now, limit)
+                )
+                rows = [row[:4] + (row[4] + 1,) for row in self.database.cursor.fetchall()]
+                self.database.cursor.executemany(
+                    "UPDATE crawl_queue SET status = 'claimed', worker = ?, lease_until = ?, attempts = ? "
+                    'WHERE scrape_id = ? AND identifier = ? AND website = ?',
+                    [(worker, lease_until, row[4], scrape_id, row[0], row[1]) for row in rows]
+                )
+        return [
+            {**dict(zip(columns, row)), 'card': json.loads(row[3]) if row[3] else {}}
+            for row in rows
+        ]
+
+    def _expire(self, scrape_id, now):
+        """
+        Mark as failed the items whose last allowed claim expired.
+        """
+        self._execute(
+            "UPDATE crawl_queue SET status = 'failed', error = 'lease expired' "
+            "WHERE scrape_id = ? AND status = 'claimed' AND lease_until < ? AND attempts >= ?",
+            (scrape_id, now, self.max_attempts)
+        )
+
+    @contextmanager
+    def _sqlite_write_lock(self):
+        """
+        Transaction holding the SQLite write lock from its start (BEGIN IMMEDIATE),
+        the stand-in of SKIP LOCKED for the workers of a single node.
+        """
+        connection = self.database.connection
+        began = not connection.in_transaction
+        if began:
+            self.database.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            if began:
+                connection.rollback()
+            raise
+        if began:
+            connection.commit()
+
+    def heartbeat(self, scrape_id, worker):
+        """
+        Extend the lease of the items claimed by `worker`.
+        """
+        self._execute(
+            "UPDATE crawl_queue SET lease_until = ? WHERE scrape_id = ? AND worker = ? AND status = 'claimed'",
+            (time.time() + self.lease_seconds, scrape_id, worker)
+        )
+        self._commit()
+
+    @contextmanager
+    def heartbeats(self, scrape_id, worker, interval=None):
+        """
+        Context manager extending the leases of `worker` every `interval` seconds
+        (a third of the lease by default) from a background thread.
+        """
+        interval = interval or self.lease_seconds / 3
+        stopped = threading.Event()
+
+        def beat():
+            with self.database.connection_scope():
+                while not stopped.wait(interval):
+                    self.heartbeat(scrape_id, worker)
+
+        thread = threading.Thread(target=beat, name='work-queue-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, scrape_id, website, identifiers, worker):
+        """
+        Mark items claimed by `worker` as done. Items whose lease was taken over
+        by another worker are left to it.
+        """
+        if not identifiers:
+            return
+        self.database.cursor.executemany(
+            self._sql(
+                "UPDATE crawl_queue SET status = 'done', lease_until = NULL "
+                'WHERE scrape_id = ? AND identifier = ? AND website = ? AND worker = ?'
+            ),
+            [(scrape_id, str(identifier), website, worker) for identifier in identifiers]
+        )
+        self._commit()
+
+    def fail(self, scrape_id, website, identifier, worker, error):
+        """
+        Give back an item that couldn't be processed: it is claimed again later,
+        unless it already had `max_attempts` claims.
+        """
+        self._execute(
+            "UPDATE crawl_queue SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            'lease_until = NULL, error = ? '
+            'WHERE scrape_id = ? AND identifier = ? AND website = ? AND worker = ?',
+            (self.max_attempts, str(error)[:1000], scrape_id, str(identifier), website, worker)
+        )
+        self._commit()
+
+    def counts(self, scrape_id):
+        """
+        Return the number of items of a scrape by status.
+        """
+        return dict(self.database.select(
+            'crawl_queue', ['status', 'COUNT(*)'], 'scrape_id = ? GROUP BY status', [scrape_id]
+        ))
+
+    def remaining(self, scrape_id):
+        """
+        Return the number of items of a scrape still pending or claimed.
+        """
+        counts = self.counts(scrape_id)
+        return counts.get('pending', 0) + counts.get('claimed', 0)
+
+    def active_scrape(self):
+        """
+        Return the id of the last scrape still being queued or with items left, or None.
+        """
+        rows = self.database.select(
+            'crawl_enqueues', ['MAX(scrape_id)'],
+            'NOT enqueue_done OR scrape_id IN '
+            "(SELECT scrape_id FROM crawl_queue WHERE status IN ('pending', 'claimed'))"
+        )
+        return rows[0][0] if rows else None
+
+    def wait(self, scrape_id, report=True):
+        """
+        Block until every item of a scrape is done or failed.
+        """
+        while True:
+            counts = self.counts(scrape_id)
+            if report:
+                print(f'Scrape {scrape_id} queue: {counts}')
+            if counts.get('pending', 0) + counts.get('claimed', 0) == 0:
+                return counts
+            time.sleep(self.poll_interval)